@@ -2,18 +2,27 @@
 from collective.transmogrifier.interfaces import ISection
 from collective.transmogrifier.interfaces import ISectionBlueprint
 from collective.transmogrifier.utils import openFileReference
-from imio.helpers.transmogrifier import Condition
-from imio.helpers.transmogrifier import Expression
 from imio.helpers.transmogrifier import get_obj_from_path  # noqa
 from imio.pyutils.system import full_path
 from imio.transmogrifier.iadocs import ANNOTATION_KEY
 from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.csv_utils import CsvCache
+from imio.transmogrifier.iadocs.csv_utils import CsvIndex
+from imio.transmogrifier.iadocs.csv_utils import INDEX_STEP
+from imio.transmogrifier.iadocs.csv_utils import parallel_rows
+from imio.transmogrifier.iadocs.csv_utils import RowPlan
+from imio.transmogrifier.iadocs.csv_utils import split_chunks
+from imio.transmogrifier.iadocs.csv_utils import USELESS_KEY
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.expressions import Expression
+from imio.transmogrifier.iadocs.stores import get_normalizer
 from imio.transmogrifier.iadocs.utils import course_store
 from imio.transmogrifier.iadocs.utils import encode_list
 from imio.transmogrifier.iadocs.utils import get_related_parts
 from imio.transmogrifier.iadocs.utils import is_in_part
 from imio.transmogrifier.iadocs.utils import log_error
 from imio.transmogrifier.iadocs.utils import print_item  # noqa
+from itertools import izip
 from Products.CMFPlone.utils import safe_unicode
 from zope.annotation import IAnnotations
 from zope.interface import classProvides
@@ -25,6 +34,63 @@ import re
 import six
 
 
+def get_used_fieldnames(transmogrifier, name, fieldnames):
+    """Get fieldnames referenced in pipeline sections options or in package code.
+
+    Fieldnames not starting with _ are always considered as used because they are schema fields.
+
+    :param transmogrifier: transmogrifier object
+    :param name: csv reader section name (excluded of search)
+    :param fieldnames: fieldnames list
+    :return: used fieldnames list
+    """
+    texts = []
+    for section in transmogrifier["transmogrifier"]["pipeline"].splitlines():
+        section = section.strip()
+        if not section or section.startswith(("#", ";")) or section == name:
+            continue
+        if transmogrifier[section].get("blueprint") in (
+            "imio.transmogrifier.iadocs.csv_reader",
+            "imio.transmogrifier.iadocs.fwf_reader",
+        ):
+            continue
+        texts.extend([safe_unicode(value) for key, value in transmogrifier[section].items() if key != "blueprint"])
+    # fieldnames used directly in blueprints or utils code
+    pkg_dir = os.path.dirname(os.path.dirname(__file__))
+    for py_file in [os.path.join(pkg_dir, "utils.py")] + [
+        os.path.join(pkg_dir, "blueprints", fn) for fn in os.listdir(os.path.join(pkg_dir, "blueprints"))
+    ]:
+        if py_file.endswith(".py"):
+            with open(py_file) as fh:
+                texts.append(safe_unicode(fh.read()))
+    text = u"\n".join(texts)
+    return [
+        key
+        for key in fieldnames
+        if not key.startswith(u"_") or key == u"_eid" or re.search(r"(?<!\w){}(?!\w)".format(re.escape(key)), text)
+    ]
+
+
+def get_unused_fieldnames(transmogrifier, name, options, fieldnames):
+    """Get fieldnames removed by the projection option. They are logged to check an auto projection.
+
+    :param transmogrifier: transmogrifier object
+    :param name: reader section name
+    :param options: reader section options
+    :param fieldnames: fieldnames list
+    :return: unused fieldnames set
+    """
+    projection = safe_unicode(options.get("projection") or u"").split()
+    if not projection:
+        return set()
+    good_fieldnames = [key for key in fieldnames if not USELESS_KEY.match(key)]
+    if projection == [u"auto"]:
+        projection = get_used_fieldnames(transmogrifier, name, good_fieldnames)
+    unused = set([key for key in good_fieldnames if key not in projection and key != u"_eid"])
+    o_logger.info(u"{}: projection removes fieldnames {}".format(name, u", ".join(sorted(unused))))
+    return unused
+
+
 class CSVReader(object):
     """Reads a csv file.
 
@@ -40,6 +106,19 @@ class CSVReader(object):
         * fmtparam-strict = O, raises exception on row error. Default False.
         * none_value = O, value to replace by None.
         * raise_on_error = O, raises exception if 1. Default 1. Can be set to 0.
+        * cache = O, flag to read and store parsed rows in a columnar cache (0 or 1). Default: config csv_cache or 0.
+        * projection = O, fieldnames to keep in item (_eid is always kept). If "auto", fieldnames are kept if they
+          don't start with _ or if they are referenced in the other pipeline sections. Removed fieldnames are logged.
+          Default: all.
+        * workers = O, number of processes parsing the file by chunks (0 to parse here). Rows are yielded in the file
+          order. Default: config csv_workers or 0.
+        * index_step = O, number of records between two byte offsets stored in the persisted index, used to start
+          reading at a given record. Default: 10000
+        * start_at = O, expression giving the first record to read: its line number (int, as _ln) or its eid (unicode).
+        * cursor = O, flag to keep the last processed line number in storage["data"]["csv_cursors"][csv_key] and to
+          restart after it if no start_at is given (0 or 1). The cursors can be dumped with a pickle_data section
+          (store_key = csv_cursors). Default 0.
+        * intern_fields = O, fieldnames whose repeated values are shared (as codes or user ids).
     """
 
     classProvides(ISectionBlueprint)
@@ -51,6 +130,14 @@ class CSVReader(object):
         self.transmogrifier = transmogrifier
         self.storage = IAnnotations(transmogrifier).get(ANNOTATION_KEY)
         self.parts = get_related_parts(name)
+        self.cache = None
+        self.unused = set()
+        self.stopped = False
+        self.filling = False
+        self.index = None
+        self.start_at = None
+        self.cursor = False
+        self.normalizer = None
         if not is_in_part(self, self.parts):
             return
         self.csv_headers = Condition(options.get("csv_headers") or "python:True", transmogrifier, name, options)
@@ -60,6 +147,7 @@ class CSVReader(object):
         if transmogrifier["config"].get("csv_delimiter") and not options.get("fmtparam-delimiter"):
             options["fmtparam-delimiter"] = "python:'%s'" % transmogrifier["config"]["csv_delimiter"]
         self.roe = bool(int(options.get("raise_on_error") or "1"))
+        self.workers = int(options.get("workers") or transmogrifier["config"].get("csv_workers") or "0")
         self.fmtparam = dict(
             (
                 key[len("fmtparam-"):],
@@ -82,12 +170,39 @@ class CSVReader(object):
             raise Exception("Cannot open file '{}'".format(self.filename))
         self.bp_key = safe_unicode(options["bp_key"])
         self.csv_key = safe_unicode(options.get("csv_key", self.bp_key))
+        self.fieldnames = fieldnames
+        self.normalizer = get_normalizer(self.storage, self.csv_key, options, stored=False)
+        if options.get("projection"):
+            self.unused = get_unused_fieldnames(transmogrifier, name, options, fieldnames)
+            fieldnames = [key for key in fieldnames if not USELESS_KEY.match(key) and key not in self.unused]
         self.storage["csv"][self.csv_key] = {
             "fp": self.filename,
             "fh": file_,
             "fn": os.path.basename(self.filename),
             "fd": fieldnames,
         }
+        if bool(int(options.get("cache") or transmogrifier["config"].get("csv_cache") or "0")):
+            self.cache = CsvCache(
+                self.filename,
+                [key for key in self.fieldnames if not USELESS_KEY.match(key)],
+                {
+                    "csv_headers": options.get("csv_headers") or "",
+                    "dialect": self.dialect,
+                    "csv_encoding": self.csv_encoding,
+                    "none_value": self.none_value,
+                    "fmtparam": repr(sorted(self.fmtparam.items())),
+                },
+            )
+        if options.get("start_at"):
+            self.start_at = Expression(options["start_at"], transmogrifier, name, options)
+        self.cursor = bool(int(options.get("cursor") or "0"))
+        index_step = int(options.get("index_step") or "0")
+        if index_step or self.start_at is not None or self.cursor:
+            self.index = CsvIndex(
+                self.filename,
+                index_step or INDEX_STEP,
+                {"dialect": self.dialect, "fmtparam": repr(sorted(self.fmtparam.items()))},
+            )
 
     def __iter__(self):
         for item in self.previous:
@@ -95,65 +210,189 @@ class CSVReader(object):
         if not is_in_part(self, self.parts) or not self.filename:
             return
         csv_d = self.storage["csv"][self.csv_key]
-        fieldnames = csv_d["fd"]
-        o_logger.info(u"Reading '{}'".format(csv_d["fp"]))
-        reader = csv.DictReader(
-            csv_d["fh"],
-            dialect=self.dialect,
-            fieldnames=fieldnames,
-            restkey="_rest",
-            restval="__NO_CO_LU_MN__",
-            **self.fmtparam
+        cursors = self.storage["data"].setdefault("csv_cursors", {}) if self.cursor else {}
+        # checks registered by a CommonInputChecks section with in_reader option
+        self.checks = csv_d.get("checks")
+        checks = self.checks
+        start = self._get_start(cursors)
+        first_ln = start is not None and start[0] or 0
+        if self.cache is not None and self.cache.is_valid():
+            rows = self._cached_rows(csv_d)
+        else:
+            # a cache can only be filled from the file beginning
+            self.filling = self.cache is not None and (start is None or start[1] == 0)
+            if self.workers:
+                rows = self._parallel_rows(csv_d, start)
+                if not self.filling:  # checks are done by workers
+                    checks = None
+            else:
+                rows = self._csv_rows(csv_d, start)
+            if self.filling:
+                rows = self._cache_filling(rows)
+        for item in rows:
+            if item["_ln"] < first_ln:
+                continue
+            if checks is not None:
+                checks[0](item, checks[1])
+            if self.normalizer is not None:
+                self.normalizer(item)
+            course_store(self, item)
+            yield item
+            # item has been processed by the next sections
+            if self.cursor:
+                cursors[self.csv_key] = item["_ln"]
+
+        if csv_d["fh"] is not None:
+            csv_d["fh"].close()
+            csv_d["fh"] = None
+
+    def _get_start(self, cursors):
+        """Returns (line number, offset, lines before offset) of the first record to read, or None"""
+        start = self.start_at is not None and self.start_at(None, storage=self.storage) or None
+        if start is None and self.cursor and cursors.get(self.csv_key) is not None:
+            start = cursors[self.csv_key] + 1
+        if start is None:
+            return None
+        if not self.index.load():
+            o_logger.info(u"Indexing '{}'".format(self.filename))
+            eid_col = self.fieldnames.index(u"_eid") if u"_eid" in self.fieldnames else None
+            self.index.build(dict(self.fmtparam, dialect=self.dialect), eid_col=eid_col, encoding=self.csv_encoding)
+        ret = self.index.lookup(start)
+        if ret is None:
+            o_logger.warning(u"Start record '{}' not found in '{}': reading all".format(start, self.filename))
+            return None
+        o_logger.info(u"Starting '{}' at line {}".format(self.filename, ret[0]))
+        return ret
+
+    def _cached_rows(self, csv_d):
+        """Yields items from the columnar cache"""
+        o_logger.info(u"Reading '{}' from cache".format(csv_d["fp"]))
+        csv_d["fh"].close()
+        csv_d["fh"] = None
+        indexes = [i for i, key in enumerate(self.cache.fieldnames) if key not in self.unused]
+        fieldnames = [self.cache.fieldnames[i] for i in indexes]
+        csv_d["fd"] = fieldnames
+        for line_num, values, rest in self.cache.rows():
+            if self.unused:
+                values = [values[i] for i in indexes]
+            item = dict(izip(fieldnames, values))
+            item["_bpk"] = self.bp_key
+            item["_ln"] = line_num
+            if rest is not None:
+                item["_rest"] = rest
+            yield item
+
+    def _cache_filling(self, rows):
+        """Stores parsed items in the cache before removing not projected keys"""
+        self.cache.start()
+        complete = False
+        try:
+            for item in rows:
+                self.cache.add(item["_ln"], item)
+                for key in self.unused:
+                    del item[key]
+                yield item
+            complete = not self.stopped
+        finally:
+            if self.cache.writer is not None:
+                if complete:
+                    self.cache.finish()
+                else:
+                    self.cache.abort()
+
+    def _row_plan(self):
+        """Returns the RowPlan used to parse rows. When filling the cache, all columns are decoded to be stored"""
+        return RowPlan(
+            self.fieldnames,
+            unused=not self.filling and self.unused or (),
+            encoding=self.csv_encoding,
+            none_value=self.none_value,
         )
-        for item in reader:
+
+    def _check_first_line(self, csv_d, item, row, plan):
+        """Checks fieldnames length on first line. Returns False if the reading must be stopped"""
+        if len(row) > plan.size:
+            log_error(
+                item,
+                u"STOPPING: some columns are not defined in fieldnames: {}".format(item["_rest"]),
+                level="critical",
+            )
+            if self.roe:
+                raise Exception(
+                    u"Some columns for {} are not defined in fieldnames: {}".format(csv_d["fn"], item["_rest"])
+                )
+            self.stopped = True
+            return False
+        if len(row) < plan.size:
+            extra_cols = self.fieldnames[len(row):]
+            log_error(
+                item,
+                u"STOPPING: to much columns defined in fieldnames: {}".format(extra_cols),
+                level="critical",
+            )
+            if self.roe:
+                raise Exception(u"To much columns for {} defined in fieldnames: {}".format(csv_d["fn"], extra_cols))
+            self.stopped = True
+            return False
+        return True
+
+    def _csv_rows(self, csv_d, start):
+        """Yields items from the csv file, from the start offset if given"""
+        o_logger.info(u"Reading '{}'".format(csv_d["fp"]))
+        lines_before = 0
+        if start is not None:
+            csv_d["fh"].seek(start[1])
+            lines_before = start[2]
+        reader = csv.reader(csv_d["fh"], dialect=self.dialect, **self.fmtparam)
+        plan = self._row_plan()
+        fieldnames = [key for key in plan.fieldnames if key not in self.unused]
+        for row in reader:
+            if not row:  # empty line
+                continue
+            item = plan(row)
             item["_bpk"] = self.bp_key
-            item["_ln"] = reader.line_num
-            # check fieldnames length on first line
-            if reader.line_num == 1:
-                reader.restval = u""
-                if "_rest" in item:
-                    log_error(
-                        item,
-                        u"STOPPING: some columns are not defined in fieldnames: {}".format(item["_rest"]),
-                        level="critical",
-                    )
-                    if self.roe:
-                        raise Exception(
-                            u"Some columns for {} are not defined in fieldnames: {}".format(csv_d["fn"], item["_rest"])
-                        )
-                    break
-                extra_cols = [key for (key, val) in item.items() if val == "__NO_CO_LU_MN__"]
-                if extra_cols:
-                    log_error(
-                        item,
-                        u"STOPPING: to much columns defined in fieldnames: {}".format(extra_cols),
-                        level="critical",
-                    )
-                    if self.roe:
-                        raise Exception(
-                            u"To much columns for {} defined in fieldnames: {}".format(csv_d["fn"], extra_cols)
-                        )
+            item["_ln"] = lines_before + reader.line_num
+            if item["_ln"] == 1:
+                if not self._check_first_line(csv_d, item, row, plan):
                     break
                 # pass headers if any
                 if self.csv_headers(None):
                     continue
-            course_store(self, item)
-            # removing useless keys as _A or _AB
-            good_fieldnames = []
-            for key in fieldnames:
-                if re.match(r"_[A-Z]{1,2}$", key):
-                    del item[key]
-                else:
-                    item[key] = safe_unicode(item[key].strip(" "), encoding=self.csv_encoding)
-                    if self.none_value and item[key] == self.none_value:
-                        item[key] = None
-                    good_fieldnames.append(key)
-            csv_d["fd"] = good_fieldnames
+            csv_d["fd"] = fieldnames
             yield item
 
-        if csv_d["fh"] is not None:
-            csv_d["fh"].close()
-            csv_d["fh"] = None
+    def _parallel_rows(self, csv_d, start):
+        """Yields items from the csv file parsed by chunks in worker processes, from the start offset if given"""
+        o_logger.info(u"Reading '{}' with {} workers".format(csv_d["fp"], self.workers))
+        plan = self._row_plan()
+        fieldnames = [key for key in plan.fieldnames if key not in self.unused]
+        # first line is checked here because conditions cannot be passed to workers
+        skip_first = False
+        reader = csv.reader(csv_d["fh"], dialect=self.dialect, **self.fmtparam)
+        row = (start is None or start[1] == 0) and next((row for row in reader if row), None) or None
+        if row is not None and reader.line_num == 1:
+            item = plan(row)
+            item["_bpk"] = self.bp_key
+            item["_ln"] = reader.line_num
+            if not self._check_first_line(csv_d, item, row, plan):
+                return
+            skip_first = bool(self.csv_headers(None))
+        csv_d["fh"].close()
+        csv_d["fh"] = None
+        fmtparam = dict(self.fmtparam, dialect=self.dialect)
+        quotechar = fmtparam.get("quotechar") or csv.get_dialect(self.dialect).quotechar or '"'
+        chunks = split_chunks(self.filename, quotechar=quotechar)
+        if start is not None:
+            offset, lines_before = start[1:]
+            chunks = [
+                (max(c_start, offset), c_end, lines_before if c_start < offset else c_lines)
+                for c_start, c_end, c_lines in chunks
+                if c_end > offset
+            ]
+        checks = not self.filling and self.checks or None
+        for item in parallel_rows(self.filename, self.workers, chunks, fmtparam, plan, self.bp_key, skip_first, checks):
+            csv_d["fd"] = fieldnames
+            yield item
 
 
 def writerow(csv_d, item):
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from collective.transmogrifier.interfaces import ISection
+from collective.transmogrifier.interfaces import ISectionBlueprint
+from imio.pyutils.system import full_path
+from imio.transmogrifier.iadocs import ANNOTATION_KEY
+from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.blueprints.csv_files import get_unused_fieldnames
+from imio.transmogrifier.iadocs.csv_utils import USELESS_KEY
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.fwf_utils import fwf_records
+from imio.transmogrifier.iadocs.fwf_utils import get_delta_files
+from imio.transmogrifier.iadocs.fwf_utils import get_footer_info
+from imio.transmogrifier.iadocs.fwf_utils import get_fwf_cols
+from imio.transmogrifier.iadocs.stores import get_normalizer
+from imio.transmogrifier.iadocs.utils import course_store
+from imio.transmogrifier.iadocs.utils import get_related_parts
+from imio.transmogrifier.iadocs.utils import is_in_part
+from imio.transmogrifier.iadocs.utils import log_error
+from itertools import izip
+from Products.CMFPlone.utils import safe_unicode
+from zope.annotation import IAnnotations
+from zope.interface import classProvides
+from zope.interface import implements
+
+import os
+
+
+class FWFReader(object):
+    """Reads a fixed width file, as produced by sqlcmd, without csv conversion.
+
+    Items are the same as the csv_reader ones on the file converted by fwf_to_csv: text values, useless columns
+    (as _A or _AB) removed, _bpk and _ln keys. _ln is the physical end line number of the record in the fwf file.
+    The {table}_delta_{old}_{new}.fwf files exported by mssqlcmd_to_fwf --incremental are read after the file, ordered
+    by watermark range, as fwf_to_csv appends them: _ln restarts in each delta file.
+
+    Parameters:
+        * b_condition = O, blueprint condition expression (available: filename)
+        * filename = M, relative filename considering csvpath.
+        * fieldnames = M, fieldnames.
+        * bp_key = M, blueprint key representing file
+        * csv_key = O, csv key (default to bp_key)
+        * fwf_encoding = O, file encoding. Default: utf8
+        * fwf_sep = O, columns separator. Default: |
+        * fwf_crlf = O, line termination (lf or crlf). Default: lf
+        * counter_col = O, flag to add a first column with the record number, as fwf_to_csv -oc option (0 or 1).
+          Default: 0
+        * none_value = O, value to replace by None.
+        * raise_on_error = O, raises exception if 1. Default 1. Can be set to 0.
+        * projection = O, fieldnames to keep in item (_eid is always kept). If "auto", fieldnames are kept if they
+          don't start with _ or if they are referenced in the other pipeline sections. Removed fieldnames are logged.
+          Default: all.
+        * intern_fields = O, fieldnames whose repeated values are shared (as codes or user ids).
+        * deltas = O, flag to read the delta files after filename (0 or 1). Default: 1
+    """
+
+    classProvides(ISectionBlueprint)
+    implements(ISection)
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.previous = previous
+        self.name = name
+        self.transmogrifier = transmogrifier
+        self.storage = IAnnotations(transmogrifier).get(ANNOTATION_KEY)
+        self.parts = get_related_parts(name)
+        if not is_in_part(self, self.parts):
+            return
+        self.encoding = safe_unicode(options.get("fwf_encoding") or "utf8")
+        self.sep = safe_unicode(options.get("fwf_sep") or "|")
+        self.crlf = (options.get("fwf_crlf") or "lf") == "crlf" and u"\r\n" or u"\n"
+        self.counter_col = bool(int(options.get("counter_col") or "0"))
+        self.none_value = safe_unicode(options.get("none_value") or transmogrifier["config"].get("none_value"))
+        self.roe = bool(int(options.get("raise_on_error") or "1"))
+        self.deltas = bool(int(options.get("deltas") or "1"))
+        fieldnames = safe_unicode(options["fieldnames"]).split()
+        self.filename = safe_unicode(options["filename"])
+        if not self.filename:
+            return
+        self.filename = full_path(self.storage["csvp"], self.filename)
+        b_condition = Condition(options.get("b_condition") or "python:True", transmogrifier, name, options)
+        if not b_condition(None, filename=self.filename, storage=self.storage):
+            self.filename = None
+            return
+        if not os.path.exists(self.filename):
+            raise Exception("Cannot open file '{}'".format(self.filename))
+        self.bp_key = safe_unicode(options["bp_key"])
+        self.csv_key = safe_unicode(options.get("csv_key", self.bp_key))
+        self.fieldnames = fieldnames
+        self.normalizer = get_normalizer(self.storage, self.csv_key, options, stored=False)
+        unused = get_unused_fieldnames(transmogrifier, name, options, fieldnames)
+        self.indexes = [i for i, key in enumerate(fieldnames) if not USELESS_KEY.match(key) and key not in unused]
+        self.storage["csv"][self.csv_key] = {
+            "fp": self.filename,
+            "fh": None,
+            "fn": os.path.basename(self.filename),
+            "fd": [fieldnames[i] for i in self.indexes],
+        }
+
+    def __iter__(self):
+        for item in self.previous:
+            yield item
+        if not is_in_part(self, self.parts) or not self.filename:
+            return
+        csv_d = self.storage["csv"][self.csv_key]
+        files = self.get_files(csv_d["fn"])
+        cols = files[0][2]
+        # check fieldnames length
+        size = len(cols) + int(self.counter_col)
+        if size != len(self.fieldnames):
+            if size > len(self.fieldnames):
+                msg = u"some columns are not defined in fieldnames: {}".format(list(cols)[len(self.fieldnames):])
+            else:
+                msg = u"to much columns defined in fieldnames: {}".format(self.fieldnames[size:])
+            log_error({"_bpk": self.bp_key, "_eid": u""}, u"STOPPING: {}".format(msg), level="critical")
+            if self.roe:
+                raise Exception(u"Error in {} columns: {}".format(csv_d["fn"], msg))
+            return
+        fieldnames = [self.fieldnames[i] for i in self.indexes]
+        none_value = self.none_value or None
+        # checks registered by a CommonInputChecks section with in_reader option
+        checks = csv_d.get("checks")
+        read = 0
+        for filename, rec_nb, cols, data_offset in files:
+            o_logger.info(u"Reading '{}'".format(filename))
+            f_read = 0
+            line = 2  # header and dashes lines
+            for values in fwf_records(
+                filename, cols, rec_nb, self.sep, self.crlf, encoding=self.encoding, data_offset=data_offset
+            ):
+                read += 1
+                f_read += 1
+                # physical end line of the record, text values can contain line terminations
+                line += 1 + sum(value.count(u"\n") for value in values if isinstance(value, unicode))  # noqa
+                if self.counter_col:
+                    values.insert(0, read)
+                # values are given as text, like after a csv conversion
+                values = [values[i] for i in self.indexes]
+                values = [
+                    None if value == none_value else value if isinstance(value, unicode) else unicode(value)  # noqa
+                    for value in values
+                ]
+                item = dict(izip(fieldnames, values))
+                item["_bpk"] = self.bp_key
+                item["_ln"] = line
+                if checks is not None:
+                    checks[0](item, checks[1])
+                if self.normalizer is not None:
+                    self.normalizer(item)
+                course_store(self, item)
+                yield item
+            if f_read != rec_nb:
+                fn = os.path.basename(filename)
+                o_logger.error(u"'{}': only {} records read on {}".format(fn, f_read, rec_nb))
+                if self.roe:
+                    raise Exception(u"Only {} records read on {} in {}".format(f_read, rec_nb, fn))
+
+    def get_files(self, fn):
+        """Returns the file and its delta files, with their records number, columns and first record offset"""
+        files = [(self.filename,) + self.get_file_info(self.filename)]
+        if not self.deltas:
+            return files
+        try:
+            deltas = get_delta_files(self.filename)
+        except ValueError as err:
+            raise Exception(u"Cannot read fwf file '{}': {}".format(fn, err.message))
+        for filename in deltas:
+            files.append((filename,) + self.get_file_info(filename))
+            if list(files[-1][2]) != list(files[0][2]):
+                raise Exception(u"Columns of delta file '{}' differ from '{}'".format(os.path.basename(filename), fn))
+        return files
+
+    def get_file_info(self, filename):
+        """Returns the records number, the columns and the first record offset of a fwf file"""
+        try:
+            rec_nb = get_footer_info(filename, self.crlf)[0]
+            with open(filename, "rb") as fh:
+                cols, data_offset = get_fwf_cols(fh.readline() + fh.readline(), self.sep, self.crlf, self.encoding)
+        except ValueError as err:
+            raise Exception(u"Cannot read fwf file '{}': {}".format(os.path.basename(filename), err.message))
+        return rec_nb, cols, data_offset
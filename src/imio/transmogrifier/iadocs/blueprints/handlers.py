@@ -13,7 +13,6 @@ from imio.dms.mail import OM_EDITOR_SERVICE_FUNCTIONS
 from imio.dms.mail.utils import create_period_folder
 from imio.helpers.content import uuidToObject
 from imio.helpers.transmogrifier import clean_value
-from imio.helpers.transmogrifier import Condition
 from imio.helpers.transmogrifier import get_correct_id
 from imio.helpers.transmogrifier import get_obj_from_path
 from imio.helpers.transmogrifier import pool_tuples
@@ -25,6 +24,8 @@ from imio.pyutils.utils import one_of_dict_values
 from imio.transmogrifier.iadocs import ANNOTATION_KEY
 from imio.transmogrifier.iadocs import e_logger
 from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.stores import dump_stores
 from imio.transmogrifier.iadocs.utils import add_key_if_value
 from imio.transmogrifier.iadocs.utils import course_store
 from imio.transmogrifier.iadocs.utils import full_name
@@ -49,7 +50,6 @@ from zope.interface import classProvides
 from zope.interface import implements
 from zope.intid import IIntIds
 
-import cPickle
 import csv
 import os
 import re
@@ -2192,11 +2192,7 @@ class PostActions(object):
                 o_logger.info(
                     u"Commit in '{}' at {}".format(item["_bpk"], self.storage["count"]["commit_count"][""]["c"])
                 )
-                for filename, store_key, condition in self.storage["lastsection"]["pkl_dump"]:
-                    if filename and condition(None, storage=self.storage, filename=filename):
-                        o_logger.info(u"Dumping '{}'".format(filename))
-                        with open(filename, "wb") as fh:
-                            cPickle.dump(self.storage["data"][store_key], fh, -1)
+                dump_stores(self.storage)
             yield item
 
 
@@ -16,8 +16,6 @@ from imio.helpers.content import get_from_annotation
 from imio.helpers.content import set_to_annotation
 from imio.helpers.security import generate_password
 from imio.helpers.transmogrifier import clean_value
-from imio.helpers.transmogrifier import Condition
-from imio.helpers.transmogrifier import Expression
 from imio.helpers.transmogrifier import filter_keys
 from imio.helpers.transmogrifier import get_correct_path
 from imio.helpers.transmogrifier import get_main_path
@@ -34,6 +32,23 @@ from imio.pyutils.utils import setup_logger
 from imio.transmogrifier.iadocs import ANNOTATION_KEY
 from imio.transmogrifier.iadocs import e_logger
 from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.csv_utils import row_hash
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.expressions import Expression
+from imio.transmogrifier.iadocs.pipeline import timing_report
+from imio.transmogrifier.iadocs.stores import COMPACT_RATIO
+from imio.transmogrifier.iadocs.stores import dump_stores
+from imio.transmogrifier.iadocs.stores import get_lru_size
+from imio.transmogrifier.iadocs.stores import get_normalizer
+from imio.transmogrifier.iadocs.stores import LazyStore
+from imio.transmogrifier.iadocs.stores import load_keys
+from imio.transmogrifier.iadocs.stores import load_pickle
+from imio.transmogrifier.iadocs.stores import memory_report
+from imio.transmogrifier.iadocs.stores import new_store
+from imio.transmogrifier.iadocs.stores import normalize_report
+from imio.transmogrifier.iadocs.stores import record_class
+from imio.transmogrifier.iadocs.stores import SqliteDict
+from imio.transmogrifier.iadocs.stores import StoreJournal
 from imio.transmogrifier.iadocs.utils import course_print
 from imio.transmogrifier.iadocs.utils import course_store
 from imio.transmogrifier.iadocs.utils import get_categories
@@ -62,7 +77,6 @@ from zope.interface import implements
 from zope.lifecycleevent import ObjectModifiedEvent
 from zope.schema.interfaces import IVocabularyFactory
 
-import cPickle
 import csv
 import json
 import logging
@@ -206,7 +220,7 @@ class Initialization(object):
         self.storage["commit_nb"] = run_options["commit_nb"]
         self.storage["batch_nb"] = run_options["batch_nb"]
         self.storage["plone"] = {}
-        self.storage["lastsection"] = {"pkl_dump": []}
+        self.storage["lastsection"] = {"pkl_dump": [], "journals": {}}
         # store storage on transmogrifier, so it can be used with standard condition
         transmogrifier.storage = self.storage
         if is_in_part(self, "tuv"):
@@ -456,6 +470,8 @@ class CommonInputChecks(object):
         * booleans = O, list of fields to transform in booleans
         * dates = O, list of triplets (fieldname format as_date) to transform in date
         * evals = O, list of fields that will be evaluated
+        * in_reader = O, flag to do the checks in the csv reader (and its workers) instead of here. The condition is
+          then only used for the course count (0 or 1). Default 0
         * raise_on_error = O, raises exception if 1. Default 1. Can be set to 0.
     """
 
@@ -469,6 +485,7 @@ class CommonInputChecks(object):
         self.bp_key = safe_unicode(options["bp_key"])
         self.csv_key = safe_unicode(options.get("csv_key", self.bp_key))
         self.parts = get_related_parts(name)
+        self.in_reader = False
         if not is_in_part(self, self.parts):
             return
         fieldnames = self.storage["csv"].get(self.csv_key, {}).get("fd", [])
@@ -535,64 +552,94 @@ class CommonInputChecks(object):
         self.dates = [cell.decode("utf8") for cell in self.dates]
         self.dates = pool_tuples(self.dates, 3, "dates option")
         self.evals = [key for key in safe_unicode(options.get("evals", "")).split() if key in fieldnames]
+        if bool(int(options.get("in_reader") or "0")) and self.csv_key in self.storage["csv"]:
+            self.in_reader = True
+            self.storage["csv"][self.csv_key]["checks"] = (check_input_values, self.get_checks())
 
-    def __iter__(self):  # noqa C901
+    def __iter__(self):
         for item in self.previous:
             if is_in_part(self, self.parts) and self.condition(item):
                 course_store(self, item)
-                # strip chars
-                for fld, chars, _typ in self.strips:
-                    if not item[fld]:
-                        continue
-                    if _typ == "s":
-                        item[fld] = item[fld].strip(chars)
-                    elif _typ == "l":
-                        item[fld] = item[fld].lstrip(chars)
-                    elif _typ == "r":
-                        item[fld] = item[fld].rstrip(chars)
-                # clean multiline value
-                for fld, isep, strip, patterns, osep in self.cleans:
-                    item[fld] = clean_value(item[fld], isep, strip, patterns, osep)
-                # replace newline by given value on specified fields
-                for fld, val in self.repl_nl:
-                    if u"\n" in (item[fld] or u""):
-                        item[fld] = val.join([part.strip() for part in item[fld].split(u"\n") if part.strip()])
-                # replace invalid values on specified fields
-                for fld, values in self.invalids:
-                    for value in values.split(u"|"):
-                        if item[fld] == value:
-                            item[fld] = None
-                            break
-                # concatenate fields
-                for fld1, fld2, dest_fld, sep in self.concats:
-                    item[dest_fld] = u"{}{}{}".format(item[fld1], sep, item[fld2])
-                # split long value
-                for fld, length, dest_fld, dest_pos, isep, osep, prefix in self.splits:
-                    part1, part2 = split_text(item[fld], length)
-                    if part1 != item[fld] or isep in item[fld]:
-                        item[fld] = part1.replace(isep, " ")
-                        if part2:
-                            remainder = dest_fld in item and item[dest_fld] and item[dest_fld].split(osep) or []
-                            remainder.insert(dest_pos, u"{}{}".format(prefix, part2.replace(isep, osep)))
-                            item[dest_fld] = osep.join(remainder)
-                # to bool
-                for fld in self.booleans:
-                    item[fld] = str_to_bool(item, fld, log_error)
-                # to dates
-                for fld, fmt, as_date in self.dates:
-                    item[fld] = str_to_date(
-                        item,
-                        fld,
-                        log_error,
-                        fmt=fmt,
-                        as_date=bool(int(as_date)),
-                        min_val=bool(int(as_date)) and date(1900, 1, 1) or datetime(1900, 1, 1),
-                    )
-                # evals
-                for fld in self.evals:
-                    item[fld] = eval(item[fld])
+                if not self.in_reader:
+                    check_input_values(item, self.get_checks())
             yield item
 
+    def get_checks(self):
+        """Returns the checks parameters, as used by check_input_values"""
+        return (
+            self.strips,
+            self.cleans,
+            self.repl_nl,
+            self.invalids,
+            self.concats,
+            self.splits,
+            self.booleans,
+            self.dates,
+            self.evals,
+        )
+
+
+def check_input_values(item, checks):  # noqa C901
+    """Applies CommonInputChecks transforms on item.
+
+    Module level function without portal access, so that it can also be run by the csv reader workers.
+
+    :param item: item dict
+    :param checks: checks parameters tuple, as returned by CommonInputChecks.get_checks
+    """
+    strips, cleans, repl_nl, invalids, concats, splits, booleans, dates, evals = checks
+    # strip chars
+    for fld, chars, _typ in strips:
+        if not item[fld]:
+            continue
+        if _typ == "s":
+            item[fld] = item[fld].strip(chars)
+        elif _typ == "l":
+            item[fld] = item[fld].lstrip(chars)
+        elif _typ == "r":
+            item[fld] = item[fld].rstrip(chars)
+    # clean multiline value
+    for fld, isep, strip, patterns, osep in cleans:
+        item[fld] = clean_value(item[fld], isep, strip, patterns, osep)
+    # replace newline by given value on specified fields
+    for fld, val in repl_nl:
+        if u"\n" in (item[fld] or u""):
+            item[fld] = val.join([part.strip() for part in item[fld].split(u"\n") if part.strip()])
+    # replace invalid values on specified fields
+    for fld, values in invalids:
+        for value in values.split(u"|"):
+            if item[fld] == value:
+                item[fld] = None
+                break
+    # concatenate fields
+    for fld1, fld2, dest_fld, sep in concats:
+        item[dest_fld] = u"{}{}{}".format(item[fld1], sep, item[fld2])
+    # split long value
+    for fld, length, dest_fld, dest_pos, isep, osep, prefix in splits:
+        part1, part2 = split_text(item[fld], length)
+        if part1 != item[fld] or isep in item[fld]:
+            item[fld] = part1.replace(isep, " ")
+            if part2:
+                remainder = dest_fld in item and item[dest_fld] and item[dest_fld].split(osep) or []
+                remainder.insert(dest_pos, u"{}{}".format(prefix, part2.replace(isep, osep)))
+                item[dest_fld] = osep.join(remainder)
+    # to bool
+    for fld in booleans:
+        item[fld] = str_to_bool(item, fld, log_error)
+    # to dates
+    for fld, fmt, as_date in dates:
+        item[fld] = str_to_date(
+            item,
+            fld,
+            log_error,
+            fmt=fmt,
+            as_date=bool(int(as_date)),
+            min_val=bool(int(as_date)) and date(1900, 1, 1) or datetime(1900, 1, 1),
+        )
+    # evals
+    for fld in evals:
+        item[fld] = eval(item[fld])
+
 
 class DependencySorter(object):
     """Handles dependencies.
@@ -770,15 +817,13 @@ class LastSection(object):
 
     def __iter__(self):
         for item in self.previous:
+            item["_reached"] = True  # end of pipeline reached, checked by previous sections when control returns
             yield item
         # end of process
         course_store(self, None)
         # dump pkl
-        for filename, store_key, condition in self.storage["lastsection"]["pkl_dump"]:
-            if filename and condition(None, storage=self.storage, filename=filename):
-                o_logger.info(u"Dumping '{}'".format(filename))
-                with open(filename, "wb") as fh:
-                    cPickle.dump(self.storage["data"][store_key], fh, -1)
+        dump_stores(self.storage, final=True)
+        normalize_report(self.storage)
         # activate dv auto convert
         if is_in_part(self, "tuv"):
             gsettings = GlobalSettings(self.portal)
@@ -796,6 +841,8 @@ class LastSection(object):
                 pr_tool._version_policy_mapping = pr_tool._version_policy_mapping
                 del annot["transmo.pr_vpm"]
         course_print(self)
+        timing_report(self.storage)
+        memory_report(self.storage, self.portal, label=u"end")
 
 
 class PickleData(object):
@@ -806,6 +853,14 @@ class PickleData(object):
         * store_key = M, store key in data dicts
         * d_condition = O, dump condition expression (default: False)
         * update = O, int for boolean to update (1) or set (0) storage. (default 0)
+        * journal = O, int for boolean to append only the changes in a journal file at each dump (default 0).
+          The pickle file is rewritten at the end or when the journal is bigger than compact_ratio * store length.
+        * compact_ratio = O, float used with journal (default 1)
+        * backend = O, store backend when not using journal: dict or sqlite (default dict)
+        * lru_size = O, number of values kept in memory with sqlite backend (default 10000)
+        * load = O, eager, lazy or keys (default eager). With lazy, the file is loaded on the first store access.
+          With keys, only a set of keys is loaded (as for "not in" conditions) and the store is never dumped.
+          Only used for a new dict store, without update and journal.
     """
 
     classProvides(ISectionBlueprint)
@@ -827,18 +882,68 @@ class PickleData(object):
             return
         self.store_key = safe_unicode(options["store_key"])
         self.filename = full_path(self.storage["csvp"], self.filename)
-        self.storage["data"].setdefault(self.store_key, {})
         update = bool(int(options.get("update") or "0"))
-        if os.path.exists(self.filename):
-            o_logger.info(u"Loading '{}'".format(self.filename))
-            with open(self.filename, "rb") as fh:
-                if update:
-                    self.storage["data"][self.store_key].update(cPickle.load(fh))
-                else:
-                    self.storage["data"][self.store_key] = cPickle.load(fh)
+        journal = bool(int(options.get("journal") or "0"))
+        backend = safe_unicode(options.get("backend") or u"dict")
+        load = safe_unicode(options.get("load") or u"eager")
+        if load not in (u"eager", u"lazy", u"keys"):
+            raise Exception(u"{}: unknown load value '{}'".format(name, load))
+        store = self.storage["data"].get(self.store_key)
+        if isinstance(store, frozenset):  # keys only store, replaced by a complete one
+            store = None
+        partial = load != u"eager" and not store and not update and not journal and backend == u"dict"
+        if partial and os.path.exists(self.filename):
+            if load == u"keys":
+                o_logger.info(u"Loading keys of '{}'".format(self.filename))
+                self.storage["data"][self.store_key] = load_keys(self.filename)
+                return  # not dumped
+            self.storage["data"][self.store_key] = LazyStore(self.filename)
+        else:
+            backend = journal and u"dict" or backend
+            self.storage["data"][self.store_key] = self._get_store(store, backend, get_lru_size(options))
+            if journal:
+                self._load_journal(float(options.get("compact_ratio") or COMPACT_RATIO), update)
+            elif os.path.exists(self.filename):
+                self._load_pickle(update)
         self.d_condition = Condition(options.get("d_condition") or "python:False", transmogrifier, name, options)
         self.storage["lastsection"]["pkl_dump"].append((self.filename, self.store_key, self.d_condition))
 
+    def _get_store(self, store, backend, lru_size):
+        """Returns the current store, or a new one if there is none or if the current one has another backend"""
+        if store is not None and (backend != u"sqlite" or isinstance(store, SqliteDict)):
+            return store
+        new = new_store(self.storage, self.store_key, backend, lru_size)
+        if store:
+            new.update(store)
+        return new
+
+    def _load_journal(self, compact_ratio, update):
+        """Loads the store from the pickle file and its journal"""
+        journal = StoreJournal(self.filename, compact_ratio)
+        self.storage["lastsection"]["journals"][self.filename] = journal
+        if os.path.exists(self.filename):
+            o_logger.info(u"Loading '{}'".format(self.filename))
+        data = journal.load()
+        if update:
+            existing = self.storage["data"][self.store_key]
+            for key in existing:
+                if key not in data:
+                    data[key] = existing[key]
+        self.storage["data"][self.store_key] = data
+
+    def _load_pickle(self, update):
+        """Loads the store from the pickle file"""
+        o_logger.info(u"Loading '{}'".format(self.filename))
+        store = self.storage["data"][self.store_key]
+        if isinstance(store, SqliteDict):
+            if not update:
+                store.clear()
+            store.bulk_load(load_pickle(self.filename))
+        elif update:
+            store.update(load_pickle(self.filename))
+        else:
+            self.storage["data"][self.store_key] = load_pickle(self.filename)
+
     def __iter__(self):
         for item in self.previous:
             yield item
@@ -913,6 +1018,94 @@ class ReadFromData(object):
                     yield item
 
 
+class RowDiff(object):
+    """Tags csv items as new, changed or unchanged compared to the previous run, and can drop the unchanged ones.
+
+    A compact hash index (eid: 8 bytes digest of the row values) is loaded from and dumped in a pickle file.
+    An item hash is recorded after the item has gone through the next sections, only if it has reached the last section
+    (that sets its _reached key) and if done_condition is matched: an item dropped by a next section or not really
+    imported in this run (by example with batches) is then still considered as new or changed.
+
+    Parameters:
+        * bp_key = M, blueprint key
+        * csv_key = O, csv key to get the hashed fieldnames (default to bp_key)
+        * filename = M, hash index filename to load and dump
+        * store_key = O, store key in data dicts (default: {bp_key}_hashes)
+        * fieldnames = O, hashed fieldnames (default: csv fieldnames)
+        * diff_key = O, item key to store status (default: _diff)
+        * condition = O, condition expression
+        * done_condition = O, condition expression to record the item hash after its process (default: True)
+        * drop_unchanged = O, int for boolean to drop unchanged items (default 0)
+        * d_condition = O, dump condition expression (default: storage['commit'])
+    """
+
+    classProvides(ISectionBlueprint)
+    implements(ISection)
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.previous = previous
+        self.name = name
+        self.transmogrifier = transmogrifier
+        self.storage = IAnnotations(transmogrifier).get(ANNOTATION_KEY)
+        self.parts = get_related_parts(name)
+        if not is_in_part(self, self.parts):
+            self.filename = None
+            return
+        self.filename = safe_unicode(options["filename"])
+        if not self.filename:
+            return
+        self.bp_key = safe_unicode(options["bp_key"])
+        self.csv_key = safe_unicode(options.get("csv_key") or self.bp_key)
+        self.store_key = safe_unicode(options.get("store_key") or u"{}_hashes".format(self.bp_key))
+        self.fieldnames = safe_unicode(options.get("fieldnames") or u"").split()
+        self.diff_key = safe_unicode(options.get("diff_key") or u"_diff")
+        self.condition = Condition(options.get("condition") or "python:True", transmogrifier, name, options)
+        self.done_condition = Condition(options.get("done_condition") or "python:True", transmogrifier, name, options)
+        self.drop_unchanged = bool(int(options.get("drop_unchanged") or "0"))
+        self.filename = full_path(self.storage["csvp"], self.filename)
+        self.storage["data"][self.store_key] = {}
+        if os.path.exists(self.filename):
+            o_logger.info(u"Loading '{}'".format(self.filename))
+            self.storage["data"][self.store_key] = load_pickle(self.filename)
+        d_condition = Condition(options.get("d_condition") or "python:storage['commit']", transmogrifier, name, options)
+        self.storage["lastsection"]["pkl_dump"].append((self.filename, self.store_key, d_condition))
+
+    def __iter__(self):
+        if not is_in_part(self, self.parts) or not self.filename:
+            for item in self.previous:
+                yield item
+            return
+        hashes = self.storage["data"][self.store_key]
+        fieldnames = self.fieldnames
+        counts = {u"new": 0, u"changed": 0, u"unchanged": 0}
+        for item in self.previous:
+            if item.get("_bpk") != self.bp_key or not self.condition(item, storage=self.storage):
+                yield item
+                continue
+            course_store(self, item)
+            if not fieldnames:
+                fieldnames = self.storage["csv"][self.csv_key]["fd"]
+            digest = row_hash([item.get(key) for key in fieldnames])
+            old = hashes.get(item["_eid"])
+            status = old is None and u"new" or old == digest and u"unchanged" or u"changed"
+            counts[status] += 1
+            if status == u"unchanged":
+                if not self.drop_unchanged:
+                    item[self.diff_key] = status
+                    yield item
+                continue
+            item[self.diff_key] = status
+            yield item
+            # the item has been processed by the next sections
+            if item.get("_reached") and self.done_condition(item, storage=self.storage):
+                hashes[item["_eid"]] = digest
+        o_logger.info(
+            u"{}: {} new, {} changed, {} unchanged items".format(
+                self.name, counts[u"new"], counts[u"changed"], counts[u"unchanged"]
+            )
+        )
+
+
 class SetOwner(object):
     """Sets ownership on created object.
 
@@ -1058,6 +1251,13 @@ class StoreInData(object):
         * check_key_uniqueness = O, flag (0 or 1: default 1)
         * check_subkey_uniqueness = O, flag (0 or 1: default 1)
         * yield = O, flag to know if a yield must be done (0 or 1: default 0)
+        * backend = O, store backend: dict or sqlite (default dict)
+        * lru_size = O, number of values kept in memory with sqlite backend (default 10000)
+        * compact = O, flag to store read only records with fixed fieldnames instead of dicts (0 or 1: default 0).
+          The records can be read like dicts.
+        * int_fields = O, fieldnames whose numeric values are converted to int (as "12", not "012") in the stored
+          values. The item and the store keys are not changed.
+        * intern_fields = O, fieldnames whose repeated values are shared in the stored values.
     """
 
     classProvides(ISectionBlueprint)
@@ -1080,13 +1280,23 @@ class StoreInData(object):
         self.cku = bool(int(options.get("check_key_uniqueness") or "1"))
         self.csku = bool(int(options.get("check_subkey_uniqueness") or "1"))
         self.yld = bool(int(options.get("yield") or "0"))
+        self.record = None
+        if bool(int(options.get("compact") or "0")):
+            if not self.fieldnames:
+                raise Exception(u"{}: compact option needs fieldnames".format(name))
+            self.record = record_class(self.fieldnames)
+        self.normalizer = get_normalizer(self.storage, self.bp_key, options)
         if self.bp_key not in self.storage["data"]:
-            self.storage["data"][self.bp_key] = {}
+            self.storage["data"][self.bp_key] = new_store(
+                self.storage, self.bp_key, safe_unicode(options.get("backend") or u"dict"), get_lru_size(options)
+            )
 
     def __iter__(self):
         for item in self.previous:
             if is_in_part(self, self.parts) and self.condition(item, storage=self.storage):
                 course_store(self, item)
+                # the stored copy is normalized: the item keeps its values for the next sections
+                values = item if self.normalizer is None else self.normalizer(dict(item))
                 # if not self.fieldnames and item['_bpk'] == self.bp_key:
                 #     del item['_bpk']
                 # key = get_values_string(item, self.store_key)
@@ -1097,13 +1307,23 @@ class StoreInData(object):
                         log_error(
                             item, u"Subkey '{}' of key '{}' already in '{}' data dict".format(subkey, key, self.bp_key)
                         )
-                    self.storage["data"][self.bp_key].setdefault(key, {}).setdefault(subkey, {}).update(
-                        filter_keys(item, self.fieldnames)
-                    )
+                    if self.record is not None:
+                        sdic = self.storage["data"][self.bp_key].setdefault(key, {})
+                        sdic[subkey] = self.record.from_item(values, sdic.get(subkey))
+                    else:
+                        self.storage["data"][self.bp_key].setdefault(key, {}).setdefault(subkey, {}).update(
+                            filter_keys(values, self.fieldnames)
+                        )
                 else:
                     if self.cku and key in self.storage["data"][self.bp_key]:
                         log_error(item, u"Key '{}' already in '{}' data dict".format(key, self.bp_key))
-                    self.storage["data"][self.bp_key].setdefault(key, {}).update(filter_keys(item, self.fieldnames))
+                    if self.record is not None:
+                        store = self.storage["data"][self.bp_key]
+                        store[key] = self.record.from_item(values, store.get(key))
+                    else:
+                        self.storage["data"][self.bp_key].setdefault(key, {}).update(
+                            filter_keys(values, self.fieldnames)
+                        )
                 if not self.yld:
                     continue
             yield item
@@ -2,13 +2,14 @@
 from collective.transmogrifier.interfaces import ISection
 from collective.transmogrifier.interfaces import ISectionBlueprint
 from collective.transmogrifier.utils import Matcher
-from imio.helpers.transmogrifier import Condition
-from imio.helpers.transmogrifier import Expression
 from imio.helpers.transmogrifier import filter_keys
 from imio.helpers.transmogrifier import get_obj_from_path  # noqa
 from imio.transmogrifier.iadocs import ANNOTATION_KEY
 from imio.transmogrifier.iadocs import e_logger
 from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.expressions import Expression
+from imio.transmogrifier.iadocs.stores import memory_report
 from imio.transmogrifier.iadocs.utils import course_store
 from imio.transmogrifier.iadocs.utils import get_related_parts
 from imio.transmogrifier.iadocs.utils import is_in_part
@@ -123,20 +124,24 @@ class EnhancedCondition(object):
 
     def __iter__(self):
         for item in self.previous:
-            if self.condition1(item, storage=self.storage):
-                course_store(self, item)
-                obj = None
-                if self.get_obj:
-                    obj = get_obj_from_path(self.portal, item)
-                try:
-                    if self.condition2(item, storage=self.storage, obj=obj):
-                        yield item
-                except Exception as msg:
-                    e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
-                    continue
-            else:
+            if self.process(item) is not None:
                 yield item
 
+    def process(self, item):
+        """Returns the item if it must be yielded, None otherwise"""
+        if self.condition1(item, storage=self.storage):
+            course_store(self, item)
+            obj = None
+            if self.get_obj:
+                obj = get_obj_from_path(self.portal, item)
+            try:
+                if self.condition2(item, storage=self.storage, obj=obj):
+                    return item
+            except Exception as msg:
+                e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
+            return None
+        return item
+
 
 class EnhancedInserter(object):
     """Set or append value in key, if condition is matched.
@@ -183,36 +188,37 @@ class EnhancedInserter(object):
 
     def __iter__(self):
         for item in self.previous:
-            key = self.key(item)
-            if self.condition(item, key=key, storage=self.storage):
-                course_store(self, item)
-                obj = None
-                if self.get_obj:
-                    obj = get_obj_from_path(self.portal, item)
-                # if condition2 is defined and not matched, we yield the item
-                if self.condition2 is not None and not self.condition2(item, key=key, storage=self.storage, obj=obj):
-                    yield item
-                    continue
-                try:
-                    value = self.value(item, key=key, storage=self.storage, obj=obj)
-                except Exception as msg:
-                    e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
-                    if self.error_value:
-                        try:
-                            value = self.error_value(item, key=key, storage=self.storage, obj=obj)
-                        except Exception as msg:
-                            e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
-                            yield item
-                            continue
-                    else:
-                        yield item
-                        continue
-                if self.separator and item.get(key):  # with self.separator, we append
-                    if value:
-                        item[key] += u"{}{}".format(self.separator, value)
+            yield self.process(item)
+
+    def process(self, item):
+        """Sets the value in item if condition is matched. Returns the item"""
+        key = self.key(item)
+        if self.condition(item, key=key, storage=self.storage):
+            course_store(self, item)
+            obj = None
+            if self.get_obj:
+                obj = get_obj_from_path(self.portal, item)
+            # if condition2 is defined and not matched, we yield the item
+            if self.condition2 is not None and not self.condition2(item, key=key, storage=self.storage, obj=obj):
+                return item
+            try:
+                value = self.value(item, key=key, storage=self.storage, obj=obj)
+            except Exception as msg:
+                e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
+                if self.error_value:
+                    try:
+                        value = self.error_value(item, key=key, storage=self.storage, obj=obj)
+                    except Exception as msg:
+                        e_logger.error(u"{}: {} ({})".format(self.name, self.error(item), msg))
+                        return item
                 else:
-                    item[key] = value
-            yield item
+                    return item
+            if self.separator and item.get(key):  # with self.separator, we append
+                if value:
+                    item[key] += u"{}{}".format(self.separator, value)
+            else:
+                item[key] = value
+        return item
 
 
 class EnhancedManipulator(object):
@@ -242,16 +248,20 @@ class EnhancedManipulator(object):
 
     def __iter__(self):
         for item in self.previous:
-            if self.condition(item):
-                course_store(self, item)
-                for key in item.keys():
-                    match = self.keys(key)[1]
-                    if match:
-                        dest = self.dest(item, key=key, match=match)
-                        item[dest] = copy.deepcopy(item[key])
-                    if self.delete(key)[1]:
-                        del item[key]
-            yield item
+            yield self.process(item)
+
+    def process(self, item):
+        """Manipulates item keys if condition is matched. Returns the item"""
+        if self.condition(item):
+            course_store(self, item)
+            for key in item.keys():
+                match = self.keys(key)[1]
+                if match:
+                    dest = self.dest(item, key=key, match=match)
+                    item[dest] = copy.deepcopy(item[key])
+                if self.delete(key)[1]:
+                    del item[key]
+        return item
 
 
 class FilterItem(object):
@@ -276,11 +286,14 @@ class FilterItem(object):
 
     def __iter__(self):
         for item in self.previous:
-            if is_in_part(self, self.parts) and self.kept_keys and self.condition(item):
-                course_store(self, item)
-                yield filter_keys(item, self.kept_keys + [fld for fld in item if fld.startswith("_")])
-                continue
-            yield item
+            yield self.process(item)
+
+    def process(self, item):
+        """Returns the filtered item if condition is matched, the item otherwise"""
+        if is_in_part(self, self.parts) and self.kept_keys and self.condition(item):
+            course_store(self, item)
+            return filter_keys(item, self.kept_keys + [fld for fld in item if fld.startswith("_")])
+        return item
 
 
 class ItemFieldSplit(object):
@@ -342,6 +355,36 @@ class ItemFieldSplit(object):
                 yield item2
 
 
+class MemoryReport(object):
+    """Logs data stores sizes, process memory and ZODB cache size.
+
+    Parameters:
+        * condition = O, matching condition to report on an item. Default: False
+        * end = O, flag to report after the previous items (0 or 1). Default: 1
+        * label = O, report label. Default: section name
+    """
+
+    classProvides(ISectionBlueprint)
+    implements(ISection)
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.condition = Condition(options.get("condition") or "python:False", transmogrifier, name, options)
+        self.end = bool(int(options.get("end") or "1"))
+        self.label = safe_unicode(options.get("label") or name)
+        self.previous = previous
+        self.name = name
+        self.portal = transmogrifier.context
+        self.storage = IAnnotations(transmogrifier).get(ANNOTATION_KEY)
+
+    def __iter__(self):
+        for item in self.previous:
+            if self.condition(item, storage=self.storage):
+                memory_report(self.storage, self.portal, label=self.label)
+            yield item
+        if self.end:
+            memory_report(self.storage, self.portal, label=self.label)
+
+
 class NeedOther(object):
     """Stops if needed other part or section is not there.
 
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""Csv helpers not depending on the portal."""
+from bisect import bisect_left
+from collections import deque
+from cStringIO import StringIO
+from itertools import islice
+from itertools import izip
+
+import cPickle
+import csv
+import hashlib
+import multiprocessing
+import os
+import re
+
+
+CACHE_DIR = "_cache"
+CACHE_VERSION = 1
+CACHE_BLOCK = 5000
+CHUNK_SIZE = 8 << 20  # bytes parsed by a worker
+INDEX_STEP = 10000  # records between two index offsets
+INDEX_VERSION = 1
+USELESS_KEY = re.compile(r"_[A-Z]{1,2}$")  # not named columns as _A or _AB
+
+
+def file_hash(filepath, block_size=1 << 20):
+    """Returns md5 hex digest of a file content"""
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def safe_decode(value, encoding="utf8"):
+    """Decodes a str value as safe_unicode does"""
+    try:
+        return unicode(value, encoding)  # noqa
+    except UnicodeDecodeError:
+        return value.decode("utf8", "replace")
+
+
+def file_signature(filepath):
+    """Returns file size and mtime"""
+    stat = os.stat(filepath)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def source_header(filepath):
+    """Returns a dict describing a file, to be stored in a derived file header"""
+    size, mtime = file_signature(filepath)
+    return {"fp": filepath, "size": size, "mtime": mtime, "hash": file_hash(filepath)}
+
+
+def is_same_source(header, filepath):
+    """Checks if a derived file header (see source_header) still corresponds to the file"""
+    size, mtime = file_signature(filepath)
+    if header["size"] != size:
+        return False
+    if header["mtime"] == mtime:
+        return True
+    # file has been touched or copied: we compare the content
+    return header["hash"] == file_hash(filepath)
+
+
+def row_hash(values):
+    """Returns a compact digest (8 bytes) of row values, to detect changed rows between two exports"""
+    return hashlib.md5(repr(values)).digest()[:8]
+
+
+class CsvCache(object):
+    """Columnar cache of an already parsed and decoded csv file.
+
+    The cache file is stored in a _cache subdirectory next to the csv file. Its name depends on the reading options
+    (fieldnames, dialect, encoding, ...) and its content is validated against the csv file size, mtime and md5 hash.
+    It contains a pickled header, followed by pickled blocks of columns and an ending None.
+    """
+
+    def __init__(self, filepath, fieldnames, options):
+        """
+        :param filepath: csv file path
+        :param fieldnames: kept fieldnames (columns stored in cache)
+        :param options: dict of reading options influencing parsed values
+        """
+        self.filepath = filepath
+        self.fieldnames = list(fieldnames)
+        self.options = sorted(options.items())
+        key = hashlib.md5(repr((self.fieldnames, self.options))).hexdigest()[:12]
+        self.cache_path = os.path.join(
+            os.path.dirname(filepath), CACHE_DIR, u"{}.{}.cache".format(os.path.basename(filepath), key)
+        )
+        self.writer = None
+
+    def is_valid(self):
+        """Checks if the cache file corresponds to the csv file"""
+        if not os.path.exists(self.cache_path):
+            return False
+        with open(self.cache_path, "rb") as fh:
+            try:
+                header = cPickle.load(fh)
+            except Exception:
+                return False
+        if (
+            header.get("version") != CACHE_VERSION
+            or header.get("fd") != self.fieldnames
+            or header.get("options") != self.options
+        ):
+            return False
+        return is_same_source(header, self.filepath)
+
+    def rows(self):
+        """Yields (line number, values tuple, rest) from the cache file"""
+        with open(self.cache_path, "rb") as fh:
+            cPickle.load(fh)  # header
+            while True:
+                block = cPickle.load(fh)  # not using an Unpickler instance to avoid memo growing
+                if block is None:
+                    break
+                lns, cols, rests = block
+                for i, row in enumerate(izip(lns, *cols)):
+                    yield row[0], row[1:], rests.get(i)
+
+    def start(self):
+        """Starts writing a new cache file (in a temporary file)"""
+        cache_dir = os.path.dirname(self.cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        header = source_header(self.filepath)
+        header.update({"version": CACHE_VERSION, "fd": self.fieldnames, "options": self.options})
+        self.writer = open(u"{}.tmp".format(self.cache_path), "wb")
+        cPickle.dump(header, self.writer, -1)
+        self._new_block()
+
+    def _new_block(self):
+        self.block = ([], [[] for fd in self.fieldnames], {})
+
+    def _dump_block(self):
+        if self.block[0]:
+            cPickle.dump(self.block, self.writer, -1)
+        self._new_block()
+
+    def add(self, line_num, item):
+        """Adds a parsed row in cache. Must be called before the item is yielded and modified."""
+        lns, cols, rests = self.block
+        if "_rest" in item:
+            rests[len(lns)] = item["_rest"]
+        lns.append(line_num)
+        for col, fd in izip(cols, self.fieldnames):
+            col.append(item[fd])
+        if len(lns) >= CACHE_BLOCK:
+            self._dump_block()
+
+    def finish(self):
+        """Closes and renames the complete cache file"""
+        self._dump_block()
+        cPickle.dump(None, self.writer, -1)
+        self.writer.close()
+        self.writer = None
+        os.rename(u"{}.tmp".format(self.cache_path), self.cache_path)
+
+    def abort(self):
+        """Removes an incomplete cache file"""
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        os.remove(u"{}.tmp".format(self.cache_path))
+
+
+class CsvIndex(object):
+    """Persisted byte offsets of csv records, to start reading at a given record.
+
+    The offset of one record every `step` records is stored, with the number of lines before it. The record end line
+    number (as _ln) of each eid is also stored. The index file is stored in the _cache subdirectory.
+    """
+
+    def __init__(self, filepath, step, options):
+        """
+        :param filepath: csv file path
+        :param step: number of records between two stored offsets
+        :param options: dict of reading options influencing parsing
+        """
+        self.filepath = filepath
+        self.step = step
+        self.options = sorted(options.items())
+        key = hashlib.md5(repr((self.step, self.options))).hexdigest()[:12]
+        self.index_path = os.path.join(
+            os.path.dirname(filepath), CACHE_DIR, u"{}.{}.idx".format(os.path.basename(filepath), key)
+        )
+        self.entries = []  # (lines before record, record offset)
+        self.eids = {}
+
+    def load(self):
+        """Loads the index if it corresponds to the csv file. Returns True if loaded"""
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, "rb") as fh:
+            try:
+                header, entries, eids = cPickle.load(fh)
+            except Exception:
+                return False
+        if (
+            header.get("version") != INDEX_VERSION
+            or header.get("step") != self.step
+            or header.get("options") != self.options
+            or not is_same_source(header, self.filepath)
+        ):
+            return False
+        self.entries, self.eids = entries, eids
+        return True
+
+    def build(self, fmtparam, eid_col=None, encoding="utf8"):
+        """Builds and stores the index by parsing the csv file.
+
+        :param fmtparam: csv.reader parameters dict
+        :param eid_col: index of the eid column in rows
+        :param encoding: csv encoding
+        """
+        self.entries, self.eids = [], {}
+        consumed = [0]
+        count = 0
+        start = lines_before = 0
+        with open(self.filepath, "rb") as fh:
+
+            def lines():
+                for line in fh:
+                    consumed[0] += len(line)
+                    yield line
+
+            reader = csv.reader(lines(), **fmtparam)
+            for row in reader:
+                if row:
+                    if count % self.step == 0:
+                        self.entries.append((lines_before, start))
+                    count += 1
+                    if eid_col is not None and eid_col < len(row):
+                        self.eids[safe_decode(row[eid_col].strip(" "), encoding)] = reader.line_num
+                # the reader consumes lines up to the record end
+                start, lines_before = consumed[0], reader.line_num
+        cache_dir = os.path.dirname(self.index_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        header = source_header(self.filepath)
+        header.update({"version": INDEX_VERSION, "step": self.step, "options": self.options})
+        with open(u"{}.tmp".format(self.index_path), "wb") as fh:
+            cPickle.dump((header, self.entries, self.eids), fh, -1)
+        os.rename(u"{}.tmp".format(self.index_path), self.index_path)
+
+    def lookup(self, start):
+        """Returns where to start reading to get a record.
+
+        :param start: record end line number (int) or record eid (unicode)
+        :return: (line number, offset, lines before offset) or None if eid is not found
+        """
+        if isinstance(start, basestring):  # noqa
+            line_num = self.eids.get(start)
+            if line_num is None:
+                return None
+        else:
+            line_num = int(start)
+        i = bisect_left([entry[0] for entry in self.entries], line_num) - 1
+        if i < 0:
+            return line_num, 0, 0
+        return line_num, self.entries[i][1], self.entries[i][0]
+
+
+class RowPlan(object):
+    """Precompiled processing of a csv row list in an item dict.
+
+    Useless columns (as _A or _AB) and unused ones are dropped. Kept values are stripped, decoded and replaced by
+    None if equal to none_value. A shorter row is completed with empty values, a longer row gives a _rest key.
+    """
+
+    def __init__(self, fieldnames, unused=(), encoding="utf8", none_value=None):
+        self.size = len(fieldnames)
+        self.indexes = [i for i, key in enumerate(fieldnames) if not USELESS_KEY.match(key) and key not in unused]
+        self.fieldnames = [fieldnames[i] for i in self.indexes]
+        self.encoding = encoding
+        self.none_value = none_value
+
+    def __call__(self, row):
+        if len(row) < self.size:
+            row = row + [""] * (self.size - len(row))
+        encoding = self.encoding
+        try:
+            values = [unicode(row[i].strip(" "), encoding) for i in self.indexes]  # noqa
+        except UnicodeDecodeError:
+            values = [safe_decode(row[i].strip(" "), encoding) for i in self.indexes]
+        if self.none_value:
+            none_value = self.none_value
+            values = [None if value == none_value else value for value in values]
+        item = dict(izip(self.fieldnames, values))
+        if len(row) > self.size:
+            item["_rest"] = row[self.size:]
+        return item
+
+
+def split_chunks(filepath, chunk_size=CHUNK_SIZE, quotechar='"', block_size=1 << 20):
+    """Splits a csv file in chunks ending at a record boundary.
+
+    A newline is a record boundary if the number of quotechar before it is even (not in a quoted multiline value).
+    Escaped quotes are doubled, so the parity is kept.
+
+    :param filepath: csv file path
+    :param chunk_size: minimal size of a chunk
+    :param quotechar: csv quote character
+    :param block_size: read size
+    :return: list of (start offset, end offset, number of lines before start)
+    """
+    chunks = []
+    start = start_line = 0
+    pos = quotes = lines = 0  # counters at the beginning of the current block
+    target = chunk_size
+    with open(filepath, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            i = 0
+            while target < pos + len(block):
+                i = max(i, target - pos)
+                j = block.find(b"\n", i)
+                if j < 0:  # boundary is in a next block
+                    break
+                i = j + 1
+                if (quotes + block.count(quotechar, 0, j)) % 2:  # newline in a quoted value
+                    continue
+                end = pos + i
+                chunks.append((start, end, start_line))
+                start, start_line = end, lines + block.count(b"\n", 0, i)
+                target = end + chunk_size
+            quotes += block.count(quotechar)
+            lines += block.count(b"\n")
+            pos += len(block)
+    if pos > start:
+        chunks.append((start, pos, start_line))
+    return chunks
+
+
+def parse_chunk(filepath, chunk, fmtparam, plan, bp_key, skip_first, checks):
+    """Parses a csv file chunk in items. Run in a worker process.
+
+    :param filepath: csv file path
+    :param chunk: tuple as returned by split_chunks
+    :param fmtparam: csv.reader parameters dict
+    :param plan: RowPlan instance
+    :param bp_key: blueprint key
+    :param skip_first: skip the first file line (headers)
+    :param checks: None or (function, parameters) applied on each item
+    :return: list of items
+    """
+    start, end, start_line = chunk
+    with open(filepath, "rb") as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    reader = csv.reader(StringIO(data), **fmtparam)
+    items = []
+    for row in reader:
+        if not row:  # empty line
+            continue
+        line_num = start_line + reader.line_num
+        if line_num == 1 and skip_first:
+            continue
+        item = plan(row)
+        item["_bpk"] = bp_key
+        item["_ln"] = line_num
+        if checks is not None:
+            checks[0](item, checks[1])
+        items.append(item)
+    return items
+
+
+def parallel_rows(filepath, workers, chunks, *args):
+    """Yields items parsed by chunks in a process pool, in the file order.
+
+    Only a few chunks are parsed in advance to limit memory use.
+
+    :param filepath: csv file path
+    :param workers: number of processes
+    :param chunks: list as returned by split_chunks
+    :param args: next parse_chunk parameters
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunks = iter(chunks)
+        pending = deque(
+            pool.apply_async(parse_chunk, (filepath, chunk) + args) for chunk in islice(chunks, workers * 2)
+        )
+        while pending:
+            items = pending.popleft().get()
+            for chunk in islice(chunks, 1):
+                pending.append(pool.apply_async(parse_chunk, (filepath, chunk) + args))
+            for item in items:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -2,10 +2,10 @@
 from AccessControl.SecurityManagement import newSecurityManager
 from collective.transmogrifier.transmogrifier import _load_config
 from collective.transmogrifier.transmogrifier import configuration_registry
-from collective.transmogrifier.transmogrifier import Transmogrifier
 from imio.pyutils.system import stop
 from imio.transmogrifier.iadocs import logger
 from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.pipeline import RoutedTransmogrifier
 from imio.transmogrifier.iadocs.utils import get_related_parts
 
 import argparse
@@ -40,6 +40,13 @@ def main():
     parser.add_argument("pipeline", help="Pipeline file")
     parser.add_argument("-c", "--commit", dest="commit", choices=("0", "1"), help="To commit changes (0, 1)")
     parser.add_argument("-p", "--parts", dest="parts", default="", help="Parts to run (abc...)")
+    parser.add_argument(
+        "-nr", "--no_routing", dest="routing", action="store_false", help="Pass all items in all sections"
+    )
+    parser.add_argument(
+        "-nf", "--no_fusion", dest="fusion", action="store_false", help="Keep one pipeline stage by section"
+    )
+    parser.add_argument("-t", "--timing", dest="timing", action="store_true", help="Log the timing of each section")
     ns = parser.parse_args()
     if not os.path.exists(ns.pipeline):
         stop("Given pipeline file '{}' doesn't exist".format(ns.pipeline), logger=logger)
@@ -75,7 +82,9 @@ def main():
 
     o_logger.info(options)
     portal.REQUEST.set("_transmo_options_", json.dumps(options))
-    transmogrifier = Transmogrifier(portal)
+    transmogrifier = RoutedTransmogrifier(
+        portal, routing=ns.routing, parts=options["parts"], fusion=ns.fusion, timing=ns.timing
+    )
     transmogrifier(PIPELINE_ID)
     #     except Exception as error:
     #         error_msg = u"type: '{}', msg: '{}'".format(type(error), error)
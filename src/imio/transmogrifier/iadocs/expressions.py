@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Expressions evaluated for each item, compiled once."""
+from imio.helpers.transmogrifier import Expression as TalesExpression
+from timeit import default_timer
+
+import importlib
+
+
+COMPILED = {}  # expression text: code object
+
+
+class ModuleImporter(dict):
+    """Modules mapping importing a module on first access, as TALES modules"""
+
+    def __missing__(self, name):
+        module = self[name] = importlib.import_module(name)
+        return module
+
+
+MODULES = ModuleImporter()
+
+
+def compile_python(text):
+    """Returns the cached code object of a stripped python expression (without python: prefix)"""
+    code = COMPILED.get(text)
+    if code is None:
+        if isinstance(text, str):
+            source = text.decode("utf8")
+        else:
+            source = text
+        # newlines are replaced as in tales python expressions
+        code = COMPILED[text] = compile(source.replace(u"\n", u" "), "<python expression>", "eval")
+    return code
+
+
+class Expression(object):
+    """Evaluates an expression with the same parameters as imio.helpers Expression.
+
+    A python: expression is compiled once and evaluated with a minimal namespace: item, transmogrifier, name, options,
+    nothing, modules and the given extras (as storage, obj or key). Other expressions are evaluated with full TALES.
+    """
+
+    def __init__(self, expression, transmogrifier, name, options, **extras):
+        self.expression = expression
+        self.extras = extras
+        self.code = None
+        text = expression.strip()
+        if text.startswith("python:"):
+            try:
+                self.code = compile_python(text[len("python:"):].strip())
+            except SyntaxError:
+                pass
+        if self.code is None:
+            self.tales = TalesExpression(expression, transmogrifier, name, options, **extras)
+            return
+        self.namespace = {
+            "__builtins__": __builtins__,
+            "transmogrifier": transmogrifier,
+            "name": name,
+            "options": options,
+            "nothing": None,
+            "modules": MODULES,
+        }
+
+    def __call__(self, item, **extras):
+        if self.code is None:
+            return self.tales(item, **extras)
+        namespace = self.namespace.copy()
+        namespace["item"] = item
+        if extras:
+            namespace.update(extras)
+        if self.extras:  # as in imio.helpers, init extras are prioritary
+            namespace.update(self.extras)
+        return eval(self.code, namespace)
+
+
+class Condition(Expression):
+    """Evaluates an expression as a boolean"""
+
+    timing = None  # section timing counters, set when the pipeline is timed
+
+    def __call__(self, item, **extras):
+        if self.timing is None:
+            return bool(super(Condition, self).__call__(item, **extras))
+        start = default_timer()
+        try:
+            return bool(super(Condition, self).__call__(item, **extras))
+        finally:
+            self.timing.conditions += default_timer() - start
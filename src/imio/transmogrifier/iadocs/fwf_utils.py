@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Fixed width files (sqlcmd output) helpers not depending on the portal."""
+from collections import OrderedDict
+
+import codecs
+import mmap
+import os
+import re
+
+
+FWF_BLOCK = 16 << 20  # bytes decoded at once
+FOOTER_TAIL = 4096  # bytes read at the end of file when searching the footer
+DELTA_NAME = "{table}_delta_{old}_{new}"  # delta file named by its watermark range, so that it is never overwritten
+DELTA_RE = re.compile(r"^(.+)_delta_([0-9A-Za-z.-]+)_([0-9A-Za-z.-]+)$")
+
+
+def convert_value(value, out_encoding=None):
+    """Converts a fixed width value as done by fwf_to_csv: right aligned values are numbers.
+
+    :param value: unicode column value
+    :param out_encoding: encoding of returned text value (unicode if None)
+    :return: int or stripped value
+    """
+    if value.startswith(u" ") and not value.endswith(u" "):  # number column
+        value = value.lstrip(u" ")
+        try:
+            return int(value)
+        except Exception:
+            pass
+    else:
+        value = value.strip(u" ").replace(u"\r\n", u"\n")
+    if out_encoding:
+        return value.encode(out_encoding)
+    return value
+
+
+def get_delta_name(table, old_wm, new_wm):
+    """Returns the delta file name (without extension) of a table exported between two watermarks.
+
+    :param table: table name
+    :param old_wm: last exported watermark value
+    :param new_wm: current watermark value
+    :return: name like {table}_delta_{old}_{new}, characters other than letters, digits, . and - being replaced by -
+    """
+    values = [re.sub(r"[^0-9A-Za-z.-]+", "-", value) for value in (old_wm, new_wm)]
+    return DELTA_NAME.format(table=table, old=values[0], new=values[1])
+
+
+def find_delta_files(filepath):
+    """Finds the delta files of a fwf file, in the same directory.
+
+    :param filepath: full export file path, like {dir}/{table}.fwf
+    :return: dict of old watermark: (new watermark, delta file path)
+    """
+    dirname, basename = os.path.split(filepath)
+    table, ext = os.path.splitext(basename)
+    deltas = {}
+    for filename in sorted(os.listdir(dirname or ".")):
+        name, f_ext = os.path.splitext(filename)
+        match = DELTA_RE.match(name)
+        if f_ext != ext or match is None or match.group(1) != table:
+            continue
+        if match.group(2) in deltas:
+            raise ValueError(
+                u"Delta files '{}' and '{}' start at the same watermark".format(
+                    os.path.basename(deltas[match.group(2)][1]), filename
+                )
+            )
+        deltas[match.group(2)] = (match.group(3), os.path.join(dirname, filename))
+    return deltas
+
+
+def get_delta_files(filepath):
+    """Gets the delta files exported after a fwf file, ordered by watermark range.
+
+    Each delta must start at the watermark ending the previous one.
+
+    :param filepath: full export file path, like {dir}/{table}.fwf
+    :return: list of delta file paths
+    """
+    deltas = find_delta_files(filepath)
+    names = sorted(os.path.basename(path) for end, path in deltas.values())
+    ends = set(end for end, path in deltas.values())
+    starts = [start for start in deltas if start not in ends]
+    ordered = []
+    current = len(starts) == 1 and starts[0] or None
+    while current in deltas:
+        current, path = deltas.pop(current)
+        ordered.append(path)
+    if deltas:  # several chains or a cycle
+        raise ValueError(
+            u"Delta files of '{}' are not a continuous watermark range: {}".format(os.path.basename(filepath), names)
+        )
+    return ordered
+
+
+def get_footer_info(filepath, crlf=u"\n", tail_size=FOOTER_TAIL):
+    """Gets the records number from the sqlcmd footer, like "(12 rows affected)" or "(12 lignes affectées)".
+
+    Only the file tail is read: the footer line must be the last one, only followed by blank lines.
+
+    :param filepath: fwf file path
+    :param crlf: unicode line termination
+    :param tail_size: bytes read at the end of the file
+    :return: (records number, offset of the line termination before the footer)
+    """
+    footer_re = re.compile(
+        re.escape(crlf.encode("ascii")) + br"\((\d+) (?:rows? affected|lignes? affect[^\r\n]*)\)?[ \t]*[\r\n]*\Z"
+    )
+    size = os.path.getsize(filepath)
+    pos = max(0, size - tail_size)
+    with open(filepath, "rb") as fh:
+        fh.seek(pos)
+        match = footer_re.search(fh.read())
+    if match is None:
+        raise ValueError(u"Footer not found at end of file '{}'".format(filepath))
+    return int(match.group(1)), pos + match.start()
+
+
+def get_fwf_cols(mm, sep, crlf, encoding="utf8"):
+    """Gets columns widths (in characters) from the header and dashes lines.
+
+    :param mm: mmap (or str) of the file
+    :param sep: unicode columns separator
+    :param crlf: unicode line termination
+    :param encoding: file encoding
+    :return: (ordered dict of column: width, offset of the first record)
+    """
+    header_end = mm.find(b"\n")
+    if header_end < 0:
+        raise ValueError(u"File is empty !")
+    header = mm[:header_end + 1].decode(encoding)
+    if not header.endswith(crlf) or (crlf == u"\n" and header.endswith(u"\r\n")):
+        raise ValueError(
+            u"Header line termination is not {}: check the crlf parameter".format(crlf == u"\n" and u"LF" or u"CRLF")
+        )
+    header = header.rstrip(crlf)
+    cols = OrderedDict()
+    for part in header.split(sep):
+        cols[part.strip()] = len(part)
+    dashes_end = mm.find(b"\n", header_end + 1)
+    if dashes_end < 0:
+        dashes_end = len(mm)
+    dashes = mm[header_end + 1:dashes_end + 1].decode(encoding).rstrip(crlf).split(sep)
+    for i, (col, clen) in enumerate(cols.items()):
+        if i >= len(dashes) or dashes[i] != u"-" * clen:
+            raise ValueError(u"Wrong length in second line for col '{}'".format(col))
+    return cols, dashes_end + 1
+
+
+def fwf_records(
+    filepath, cols, rec_nb, sep, crlf, encoding="utf8", out_encoding=None, data_offset=None, block_size=FWF_BLOCK
+):
+    """Yields records values of a fixed width file.
+
+    The file is memory mapped and decoded by big blocks with an incremental decoder (a multibyte character can be cut
+    between blocks). As widths are in characters, a record always has the same decoded length and fields are sliced at
+    precomputed positions. A record not ending at the expected position raises a ValueError.
+
+    :param filepath: fwf file path
+    :param cols: ordered dict of column: width, as returned by get_fwf_cols
+    :param rec_nb: number of records to read
+    :param sep: unicode columns separator
+    :param crlf: unicode line termination
+    :param encoding: file encoding, decoded while reading
+    :param out_encoding: encoding of returned text values (unicode if None)
+    :param data_offset: offset of the first record (after the dashes line if None)
+    :param block_size: number of bytes decoded at once
+    """
+    slices = []
+    pos = 0
+    for clen in cols.values():
+        slices.append((pos, pos + clen))
+        pos += clen + len(sep)
+    rec_len = pos - len(sep) + len(crlf)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(filepath, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data_offset is None:
+                data_offset = get_fwf_cols(mm, sep, crlf, encoding=encoding)[1]
+            size = len(mm)
+            pos = data_offset
+            buf = u""
+            done = 0
+            while done < rec_nb:
+                count = min(len(buf) // rec_len, rec_nb - done)
+                if not count:
+                    if pos >= size:
+                        break
+                    end = min(pos + block_size, size)
+                    buf += decoder.decode(mm[pos:end], end == size)
+                    pos = end
+                    continue
+                for start in xrange(0, count * rec_len, rec_len):  # noqa
+                    rec = buf[start:start + rec_len]
+                    if not rec.endswith(crlf):
+                        raise ValueError(
+                            u"Record {} of '{}' does not end at the expected position: check the crlf and sep "
+                            u"parameters".format(done + start // rec_len + 1, filepath)
+                        )
+                    # inlined convert_value for integers and text values, the most frequent
+                    values = [rec[s:e] for s, e in slices]
+                    if out_encoding:
+                        yield [
+                            (int(value) if value.lstrip(u" ").isdigit() else convert_value(value, out_encoding))
+                            if value[:1] == u" " != value[-1:]
+                            else value.strip(u" ").replace(u"\r\n", u"\n").encode(out_encoding)
+                            for value in values
+                        ]
+                    else:
+                        yield [
+                            (int(value) if value.lstrip(u" ").isdigit() else convert_value(value))
+                            if value[:1] == u" " != value[-1:]
+                            else value.strip(u" ").replace(u"\r\n", u"\n")
+                            for value in values
+                        ]
+                buf = buf[count * rec_len:]
+                done += count
+        finally:
+            mm.close()
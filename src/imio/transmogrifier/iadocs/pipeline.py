@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+"""Pipeline construction and run, with routing of items following their blueprint key (_bpk)."""
+from bisect import bisect_right
+from collective.transmogrifier.interfaces import ISection
+from collective.transmogrifier.interfaces import ISectionBlueprint
+from collective.transmogrifier.transmogrifier import _load_config
+from collective.transmogrifier.transmogrifier import Transmogrifier
+from imio.transmogrifier.iadocs import ANNOTATION_KEY
+from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.stores import stop_dump_writer
+from imio.transmogrifier.iadocs.utils import get_related_parts
+from timeit import default_timer
+from zope.annotation import IAnnotations
+from zope.component import getUtility
+
+import ast
+
+
+# blueprints always built, whatever the section name
+KEPT_BLUEPRINTS = (
+    "collective.transmogrifier.sections.constructor",
+    "imio.transmogrifier.iadocs.init",
+    "imio.transmogrifier.iadocs.last_section",
+)
+
+# blueprints that can be routed: condition option name, options evaluated on each item before the condition.
+# When the condition is false, the item is yielded unchanged and an item gives at most one item.
+ROUTED_BLUEPRINTS = {
+    "imio.transmogrifier.iadocs.add_data_in_item": ("condition", ()),
+    "imio.transmogrifier.iadocs.common_input_checks": ("condition", ()),
+    "imio.transmogrifier.iadocs.condition": ("condition1", ()),
+    "imio.transmogrifier.iadocs.count": ("condition", ()),
+    "imio.transmogrifier.iadocs.csv_writer": ("condition", ()),
+    "imio.transmogrifier.iadocs.filter_item": ("condition", ()),
+    "imio.transmogrifier.iadocs.inserter": ("condition", ("key",)),
+    "imio.transmogrifier.iadocs.manipulator": ("condition", ()),
+    "imio.transmogrifier.iadocs.path_insert": ("condition", ()),
+    "imio.transmogrifier.iadocs.state_set": ("condition", ()),
+    "imio.transmogrifier.iadocs.store_in_data": ("condition", ()),
+}
+
+
+class Marker(dict):
+    """Item passed in a routed block to get back the control when the block waits for a new item"""
+
+
+MARKER = Marker(_bpk=u"__routing_marker__")
+
+
+def _python_tree(expression):
+    """Returns the parsed python expression or None"""
+    text = expression.strip()
+    if not text.startswith("python:"):
+        return None
+    text = text[len("python:"):].strip().replace("\n", " ")
+    try:
+        return ast.parse(text, mode="eval").body
+    except SyntaxError:
+        return None
+
+
+def _uses_item(node):
+    """Checks if item variable is used in the parsed expression"""
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Name) and sub.id == "item":
+            return True
+    return False
+
+
+def _is_bpk_access(node):
+    """Checks if node is item.get('_bpk') or item['_bpk']"""
+    if isinstance(node, ast.Call):
+        func = node.func
+        return (
+            isinstance(func, ast.Attribute)
+            and func.attr == "get"
+            and isinstance(func.value, ast.Name)
+            and func.value.id == "item"
+            and len(node.args) == 1
+            and not node.keywords
+            and isinstance(node.args[0], ast.Str)
+            and node.args[0].s == "_bpk"
+        )
+    if isinstance(node, ast.Subscript):
+        return (
+            isinstance(node.value, ast.Name)
+            and node.value.id == "item"
+            and isinstance(node.slice, ast.Index)
+            and isinstance(node.slice.value, ast.Str)
+            and node.slice.value.s == "_bpk"
+        )
+    return False
+
+
+def _bpk_values(node):
+    """Returns the set of _bpk values tested by a comparison node or None"""
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    left, right, op = node.left, node.comparators[0], node.ops[0]
+    if isinstance(op, ast.Eq):
+        if _is_bpk_access(right):
+            left, right = right, left
+        if _is_bpk_access(left) and isinstance(right, ast.Str):
+            return frozenset([right.s.decode("utf8") if isinstance(right.s, str) else right.s])
+    elif isinstance(op, ast.In) and _is_bpk_access(left) and isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+        if all(isinstance(elt, ast.Str) for elt in right.elts):
+            return frozenset(elt.s.decode("utf8") if isinstance(elt.s, str) else elt.s for elt in right.elts)
+    return None
+
+
+def bpk_guard(expression):
+    """Returns the _bpk values for which a condition can be True, or None if the condition is not recognized.
+
+    The first part of an "and" condition using item must be a _bpk test: `item.get('_bpk') == u'e_mail'`,
+    `item['_bpk'] == u'e_mail'` or `item.get('_bpk') in (u'e_mail_i', u'e_mail_o')`. Previous parts must not use
+    item (as is_in_part calls).
+
+    :param expression: condition expression
+    :return: frozenset of _bpk values or None
+    """
+    node = _python_tree(expression)
+    if node is None:
+        return None
+    parts = [node]
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        parts = node.values
+    for part in parts:
+        if _uses_item(part):
+            return _bpk_values(part)
+    return None
+
+
+def section_guard(blueprint_id, options):
+    """Returns the _bpk values a section can act on, or None if the section cannot be routed"""
+    if blueprint_id not in ROUTED_BLUEPRINTS:
+        return None
+    cond_option, pre_options = ROUTED_BLUEPRINTS[blueprint_id]
+    if not options.get(cond_option):
+        return None
+    for option in pre_options:
+        expression = options.get(option) or ""
+        node = _python_tree(expression)
+        if node is None and "item" in expression or node is not None and _uses_item(node):
+            return None
+    return bpk_guard(options[cond_option])
+
+
+def is_pruned(name, blueprint_id, parts):
+    """Checks if a section can be left out of the pipeline because its related parts are not run.
+
+    :param name: section name, prefixed by its related parts (as 'ab__name')
+    :param blueprint_id: section blueprint
+    :param parts: run parts
+    :return: boolean
+    """
+    if blueprint_id in KEPT_BLUEPRINTS:
+        return False
+    related = get_related_parts(name)
+    if related is None:
+        return False
+    for part in related:
+        if part in parts:
+            return False
+    return True
+
+
+class Feed(object):
+    """Previous iterator of a routed block: gives the fed item, or the marker when the block waits"""
+
+    def __init__(self):
+        self.item = None
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = self.item
+        if item is not None:
+            self.item = None
+            return item
+        if self.closed:
+            raise StopIteration
+        return MARKER
+
+
+class Fused(object):
+    """Consecutive sections applied in one pipeline stage with their process method.
+
+    A process method returns the item to yield or None.
+    """
+
+    def __init__(self, previous, section):
+        self.previous = previous
+        self.sections = [section]
+
+    def __iter__(self):
+        processes = [section.process for section in self.sections]
+        for item in self.previous:
+            for process in processes:
+                item = process(item)
+                if item is None:
+                    break
+            else:
+                yield item
+
+
+def append_section(previous, section, fusion=True):
+    """Returns the pipeline stage following previous: the section or the fused stage including it"""
+    if not fusion or getattr(section, "process", None) is None:
+        return section
+    fused = getattr(previous, "stage", previous)  # previous can be a timed stage
+    if isinstance(fused, Fused):
+        fused.sections.append(section)
+        return previous
+    return Fused(previous, section)
+
+
+class SectionTiming(object):
+    """Timing counters of a section or of a pipeline stage.
+
+    Inclusive time is spent in the section, previous sections included. Exclusive time is spent in the section only.
+    Conditions time is the part of exclusive time spent in the section conditions.
+    """
+
+    __slots__ = ("name", "previous", "items_in", "items_out", "inclusive", "exclusive", "conditions")
+
+    def __init__(self, name, previous=None):
+        self.name = name
+        self.previous = previous  # timing of the previous stage, giving the items in
+        self.items_in = 0
+        self.items_out = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.conditions = 0.0
+
+    def get_items_in(self):
+        if self.previous is not None:
+            return self.previous.items_out
+        return self.items_in
+
+
+class Clock(object):
+    """Charges the elapsed time to the running pipeline stage"""
+
+    def __init__(self):
+        self.timings = []
+        self.stack = []
+        self.last = None
+
+    def add(self, name, previous=None):
+        """Returns new timing counters, following the previous stage timing if given"""
+        stats = SectionTiming(name, getattr(previous, "stats", None))
+        self.timings.append(stats)
+        return stats
+
+    def store(self, transmogrifier):
+        """Keeps the timings in the transmogrifier storage, for timing_report"""
+        storage = IAnnotations(transmogrifier).get(ANNOTATION_KEY)
+        if storage is not None:
+            storage["timing"] = self.timings
+
+    def enter(self, stats):
+        now = default_timer()
+        if self.stack:
+            self.stack[-1].exclusive += now - self.last
+        self.stack.append(stats)
+        self.last = now
+        return now
+
+    def leave(self):
+        now = default_timer()
+        self.stack.pop().exclusive += now - self.last
+        self.last = now
+        return now
+
+    def append_section(self, name, previous, section, fusion=True):
+        """Returns the pipeline stage following previous as append_section, timing the section and its conditions"""
+        stats = self.add(name, previous)
+        for value in getattr(section, "__dict__", {}).values():
+            if isinstance(value, Condition):
+                value.timing = stats
+        if fusion and getattr(section, "process", None) is not None:
+            stats.previous = None  # items in are counted by the timed process
+            section.process = TimedProcess(section.process, stats, self)
+        last = append_section(previous, section, fusion)
+        if last is section:
+            return Timed(section, stats, self)
+        if last is not previous:  # new fused stage
+            return Timed(last, self.add(u"[fused] {}".format(name), previous), self)
+        return last
+
+
+class Timed(object):
+    """Pipeline stage iterator charging its time to the stage timing"""
+
+    def __init__(self, stage, stats, clock):
+        self.stage = stage
+        self.stats = stats
+        self.clock = clock
+        self.iter = None
+
+    def __iter__(self):
+        if self.iter is None:
+            self.iter = iter(self.stage)
+        return self
+
+    def next(self):
+        stats = self.stats
+        start = self.clock.enter(stats)
+        try:
+            item = next(self.iter)
+        finally:
+            stats.inclusive += self.clock.leave() - start
+        if item is not MARKER:
+            stats.items_out += 1
+        return item
+
+
+class TimedProcess(object):
+    """Process method of a fused section charging its time to the section timing"""
+
+    def __init__(self, process, stats, clock):
+        self.process = process
+        self.stats = stats
+        self.clock = clock
+
+    def __call__(self, item):
+        stats = self.stats
+        start = self.clock.enter(stats)
+        try:
+            out = self.process(item)
+        finally:
+            stats.inclusive += self.clock.leave() - start
+        if item is not MARKER:
+            stats.items_in += 1
+            if out is not None:
+                stats.items_out += 1
+        return out
+
+
+def timed_stage(clock, stage, name, previous=None):
+    """Returns the stage, timed with new counters if clock is given"""
+    if clock is None:
+        return stage
+    return Timed(stage, clock.add(name, previous), clock)
+
+
+def timed_section(clock, name, previous, section, fusion=True):
+    """Returns the pipeline stage following previous as append_section, timing the section if clock is given"""
+    if clock is None:
+        return append_section(previous, section, fusion)
+    return clock.append_section(name, previous, section, fusion)
+
+
+def timing_report(storage):
+    """Logs the sections timing, ranked by exclusive time"""
+    timings = storage.get("timing")
+    if not timings:
+        return
+    total = sum(stats.exclusive for stats in timings) or 1.0
+    o_logger.info(u"TIMING: {:.3f}s".format(total))
+    o_logger.info(u">  exclusive      %  inclusive conditions       body       in      out  us/item section")
+    for stats in sorted(timings, key=lambda st: st.exclusive, reverse=True):
+        items_in = stats.get_items_in()
+        if stats.name is None or not items_in and not stats.items_out:
+            continue
+        o_logger.info(
+            u"> {:9.3f}s {:5.1f}% {:9.3f}s {:9.3f}s {:9.3f}s {:>8} {:>8} {:8.1f} {}".format(
+                stats.exclusive,
+                stats.exclusive * 100 / total,
+                stats.inclusive,
+                stats.conditions,
+                stats.exclusive - stats.conditions,
+                items_in,
+                stats.items_out,
+                items_in and stats.exclusive * 1000000 / items_in or 0.0,
+                stats.name,
+            )
+        )
+
+
+class Block(object):
+    """Consecutive sections with the same _bpk guard"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.feed = Feed()
+        self.last = self.feed
+        self.names = []
+        self.iter = None
+        self.processes = None
+        self.fed = 0
+
+    def add(self, name, last):
+        """Adds a section, last being the section or the fused stage including it"""
+        self.names.append(name)
+        self.last = last
+
+    def send(self, item):
+        """Passes an item in the block sections. Returns the resulting item or None if it is not yielded"""
+        self.fed += 1
+        if self.processes is not None:
+            for process in self.processes:
+                item = process(item)
+                if item is None:
+                    return None
+            return item
+        self.feed.item = item
+        out = next(self.iter)
+        if out is MARKER:
+            return None
+        return out
+
+    def start(self):
+        if isinstance(self.last, Fused) and self.last.previous is self.feed:  # no generator needed
+            self.processes = [section.process for section in self.last.sections]
+            return
+        self.iter = iter(self.last)
+        out = next(self.iter)
+        if out is not MARKER:
+            raise Exception(u"Routed section '{}' yields an item at start".format(self.names[0]))
+
+    def finish(self):
+        """Yields remaining items when there is no more item to feed"""
+        if self.iter is None:
+            return
+        self.feed.closed = True
+        for item in self.iter:
+            yield item
+
+
+class Router(object):
+    """Passes items only in the routed blocks that can act on their _bpk, keeping the sections order.
+
+    Routed sections must yield at most one item for each item and yield unchanged the items not matching their guard.
+    """
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.blocks = []
+        self.table = {}  # _bpk: block indexes
+
+    def block(self, keys):
+        """Returns the block where a section with the given _bpk guard is added"""
+        if not self.blocks or self.blocks[-1].keys != keys:
+            self.blocks.append(Block(keys))
+            for key in keys:
+                self.table.setdefault(key, []).append(len(self.blocks) - 1)
+        return self.blocks[-1]
+
+    def route(self, item, start=0):
+        """Passes item in the blocks from start. Returns the resulting item or None"""
+        indexes = self.table.get(item.get("_bpk"))
+        if not indexes:
+            return item
+        i = bisect_right(indexes, start - 1)
+        while i < len(indexes):
+            index = indexes[i]
+            bpk = item.get("_bpk")
+            item = self.blocks[index].send(item)
+            if item is None:
+                return None
+            if item.get("_bpk") != bpk:  # we follow the new _bpk routing
+                indexes = self.table.get(item.get("_bpk"), [])
+                i = bisect_right(indexes, index)
+                continue
+            i += 1
+        return item
+
+    def __iter__(self):
+        # sections start is done from the last as in an usual pipeline
+        for block in reversed(self.blocks):
+            block.start()
+        route = self.route
+        for item in self.previous:
+            item = route(item)
+            if item is not None:
+                yield item
+        for i, block in enumerate(self.blocks):
+            for item in block.finish():
+                item = route(item, i + 1)
+                if item is not None:
+                    yield item
+
+
+def add_fused(fused, last, section_id):
+    """Records the section name if its stage is a fused stage.
+
+    :param fused: list of (fused stage, section names)
+    :param last: pipeline stage of the section
+    :param section_id: section name
+    """
+    stage = getattr(last, "stage", last)
+    if isinstance(stage, Fused):
+        if not fused or fused[-1][0] is not stage:
+            fused.append((stage, []))
+        fused[-1][1].append(section_id)
+
+
+def log_construction(pruned, fused, routed):
+    """Logs the pruned sections, the fused stages and the routers.
+
+    :param pruned: pruned section names
+    :param fused: list of (fused stage, section names)
+    :param routed: routers
+    """
+    if pruned:
+        o_logger.info(u"Pruning: {} sections of not run parts are left out".format(len(pruned)))
+    stages = [names for fused_stage, names in fused if len(names) > 1]
+    if stages:
+        o_logger.info(u"Fusion: {} sections in {} stages".format(sum(len(names) for names in stages), len(stages)))
+        for names in stages:
+            o_logger.info(u"> {}".format(u", ".join(names)))
+    if routed:
+        o_logger.info(
+            u"Routing: {} sections in {} blocks of {} routers".format(
+                sum(len(block.names) for router in routed for block in router.blocks),
+                sum(len(router.blocks) for router in routed),
+                len(routed),
+            )
+        )
+
+
+def construct_pipeline(transmogrifier, sections, routing=True, parts=None, fusion=True, timing=False):
+    """Constructs the pipeline as collective.transmogrifier, routing consecutive routable sections.
+
+    :param transmogrifier: transmogrifier object
+    :param sections: section names
+    :param routing: flag to route items following their _bpk
+    :param parts: run parts. If given, sections of other parts are not built
+    :param fusion: flag to apply consecutive sections having a process method in one stage
+    :param timing: flag to time each section, the timing is kept in storage and logged by timing_report
+    :return: pipeline last section
+    """
+    pipeline = iter(())
+    clock = timing and Clock() or None
+    router = None
+    routed = []
+    pruned = []
+    fused = []  # (fused stage, section names)
+    for section_id in sections:
+        section_id = section_id.strip()
+        if not section_id:
+            continue
+        options = transmogrifier[section_id]
+        blueprint_id = options["blueprint"].decode("ascii")
+        if parts is not None and is_pruned(section_id, blueprint_id, parts):
+            pruned.append(section_id)
+            continue
+        blueprint = getUtility(ISectionBlueprint, blueprint_id)
+        keys = routing and section_guard(blueprint_id, options) or None
+        if keys is None:
+            router = None
+            previous = pipeline
+        else:
+            if router is None:
+                router = Router(pipeline)
+                routed.append(router)
+                pipeline = timed_stage(clock, router, u"[router] {}".format(section_id), pipeline)
+            block = router.block(keys)
+            if not block.names:  # to count the items fed
+                block.last = timed_stage(clock, block.feed, None)
+            previous = block.last
+        section = blueprint(transmogrifier, section_id, options, previous)
+        if not ISection.providedBy(section):
+            raise ValueError("Blueprint %s for section %s did not return an ISection" % (blueprint_id, section_id))
+        last = timed_section(clock, section_id, previous, section, fusion)
+        if keys is None:
+            pipeline = last
+        else:
+            block.add(section_id, last)
+        add_fused(fused, last, section_id)
+    log_construction(pruned, fused, routed)
+    if clock is not None:
+        clock.store(transmogrifier)
+    return pipeline
+
+
+class RoutedTransmogrifier(Transmogrifier):
+    """Transmogrifier constructing the pipeline with construct_pipeline"""
+
+    def __init__(self, context, routing=True, parts=None, fusion=True, timing=False):
+        Transmogrifier.__init__(self, context)
+        self.routing = routing
+        self.parts = parts
+        self.fusion = fusion
+        self.timing = timing
+
+    def __call__(self, configuration_id, **overrides):
+        self.configuration_id = configuration_id
+        self._raw = _load_config(configuration_id, **overrides)
+        self._data = {}
+        sections = self._raw["transmogrifier"]["pipeline"].splitlines()
+        pipeline = construct_pipeline(
+            self, sections, routing=self.routing, parts=self.parts, fusion=self.fusion, timing=self.timing
+        )
+        try:
+            for item in pipeline:
+                pass  # discard once processed
+        finally:
+            # dumps queued after a commit are written even if the pipeline is interrupted
+            storage = IAnnotations(self).get(ANNOTATION_KEY)
+            if storage is not None:
+                stop_dump_writer(storage)
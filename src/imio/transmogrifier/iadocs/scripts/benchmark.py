@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Script to benchmark some hot code paths of the pipeline"""
+from datetime import datetime
+from imio.helpers.transmogrifier import Expression as TalesExpression
+from imio.transmogrifier.iadocs.csv_utils import RowPlan
+from imio.transmogrifier.iadocs.expressions import Expression
+from imio.transmogrifier.iadocs.stores import dump_stores
+from imio.transmogrifier.iadocs.stores import stop_dump_writer
+from itertools import product
+
+import argparse
+import cPickle
+import csv
+import logging
+import os
+import re
+import shutil
+import tempfile
+import timeit
+
+
+logging.basicConfig()
+logger = logging.getLogger("bench")
+logger.setLevel(logging.INFO)
+EXPRESSIONS = [
+    "python:True",
+    "python:item.get('_bpk') == u'e_mail_i' and '_service_id' not in item",
+    "python:not storage['batch_nb'] and True or (item['_eid'] not in storage['data']['e_mail_i'] and "
+    "storage.get('count', {}).get('l__count', {}).get('e_mail_i', {}).get('c', 0) < storage['batch_nb'])",
+    "python:u'{} | {}'.format(item['title'], item['_eid'])",
+]
+
+
+def default_fieldnames(filename, delimiter):
+    """Generates fieldnames like a pipeline: a third of named columns, the others as _A, _B, ..."""
+    with open(filename, "rb") as fh:
+        size = len(next(csv.reader(fh, delimiter=delimiter)))
+    letters = [""] + [chr(i) for i in range(65, 91)]
+    names = ["_{}{}".format(l1, l2) for l1, l2 in product(letters, letters[1:])][:size]
+    return [i % 3 and name or "fld{}".format(i) for i, name in enumerate(names)]
+
+
+def legacy_csv_read(filename, fieldnames, delimiter, none_value):
+    """Former CSVReader loop: DictReader and per row regex"""
+    with open(filename, "rb") as fh:
+        reader = csv.DictReader(fh, fieldnames=fieldnames, restkey="_rest", restval=u"", delimiter=delimiter)
+        for item in reader:
+            for key in fieldnames:
+                if re.match(r"_[A-Z]{1,2}$", key):
+                    del item[key]
+                else:
+                    item[key] = item[key].strip(" ").decode("utf8")
+                    if none_value and item[key] == none_value:
+                        item[key] = None
+
+
+def plan_csv_read(filename, fieldnames, delimiter, none_value):
+    """Current CSVReader loop: csv reader and precompiled row plan"""
+    plan = RowPlan(fieldnames, none_value=none_value)
+    with open(filename, "rb") as fh:
+        for row in csv.reader(fh, delimiter=delimiter):
+            if row:
+                plan(row)
+
+
+def bench_csv(ns):
+    fieldnames = ns.fieldnames and ns.fieldnames.split() or default_fieldnames(ns.filename, ns.delimiter)
+    for func in (legacy_csv_read, plan_csv_read):
+        duration = min(
+            timeit.repeat(
+                lambda: func(ns.filename, fieldnames, ns.delimiter, ns.none_value), number=1, repeat=ns.repeat
+            )
+        )
+        logger.info("{}: {:.3f}s".format(func.__name__, duration))
+
+
+def bench_expr(ns):
+    item = {"_bpk": u"e_mail_i", "_eid": u"12", "title": u"Title"}
+    storage = {"batch_nb": 10, "data": {u"e_mail_i": {}}, "count": {}}
+    for text in ns.expressions or EXPRESSIONS:
+        for cls in (TalesExpression, Expression):
+            expr = cls(text, {}, "bench", {})
+            duration = min(timeit.repeat(lambda: expr(item, storage=storage), number=ns.number, repeat=ns.repeat))
+            logger.info("{}: {:.2f}us '{}'".format(cls.__module__, duration / ns.number * 1e6, text[:70]))
+
+
+def bench_dump(ns):
+    store = dict(
+        (u"{}".format(i), {u"_eid": u"{}".format(i), u"title": u"Title {}".format(i), u"id": i}) for i in range(ns.keys)
+    )
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, "bench.pkl")
+    storage = {"data": {u"bench": store}, "lastsection": {"pkl_dump": [(filename, u"bench", lambda *a, **k: True)]}}
+    try:
+        pickling = min(timeit.repeat(lambda: cPickle.dumps(store, -1), number=1, repeat=ns.repeat))
+        logger.info("pickling pause (previous dump): {:.3f}s".format(pickling))
+        pauses = []
+        for i in range(ns.repeat):
+            pauses.append(timeit.timeit(lambda: dump_stores(storage), number=1))
+            stop_dump_writer(storage)
+        logger.info("dump_stores pause: {:.3f}s".format(min(pauses)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline code paths.")
+    subparsers = parser.add_subparsers(dest="command")
+    csv_parser = subparsers.add_parser("csv", help="Compare csv reading loops.")
+    csv_parser.add_argument("filename", help="Csv file.")
+    csv_parser.add_argument("-f", "--fieldnames", dest="fieldnames", help="Fieldnames (space separated).")
+    csv_parser.add_argument("-d", "--delimiter", dest="delimiter", default=",", help='Delimiter. Default ","')
+    csv_parser.add_argument("-n", "--none_value", dest="none_value", default="NULL", help='None value. Default NULL')
+    csv_parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3, help="Repetitions. Default 3")
+    expr_parser = subparsers.add_parser("expr", help="Compare tales and compiled expressions evaluation.")
+    expr_parser.add_argument(
+        "-e", "--expression", dest="expressions", action="append", help="Expression (can be repeated)."
+    )
+    expr_parser.add_argument(
+        "-n", "--number", dest="number", type=int, default=10000, help="Evaluations. Default 10000"
+    )
+    expr_parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3, help="Repetitions. Default 3")
+    dump_parser = subparsers.add_parser("dump", help="Measure the pipeline pause when dumping a store.")
+    dump_parser.add_argument(
+        "-k", "--keys", dest="keys", type=int, default=300000, help="Store keys number. Default 300000"
+    )
+    dump_parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3, help="Repetitions. Default 3")
+    ns = parser.parse_args()
+    start = datetime.now()
+    if ns.command == "csv":
+        bench_csv(ns)
+    elif ns.command == "expr":
+        bench_expr(ns)
+    elif ns.command == "dump":
+        bench_dump(ns)
+    logger.info("Script duration: %s" % (datetime.now() - start))
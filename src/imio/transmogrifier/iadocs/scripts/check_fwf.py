@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Script to check sqlcmd output files before conversion: footer, columns and records number"""
+from datetime import datetime
+from imio.pyutils.system import read_dir
+from imio.pyutils.system import stop
+from imio.transmogrifier.iadocs.fwf_utils import fwf_records
+from imio.transmogrifier.iadocs.fwf_utils import get_footer_info
+from imio.transmogrifier.iadocs.fwf_utils import get_fwf_cols
+
+import argparse
+import logging
+import os
+import re
+
+
+logging.basicConfig()
+logger = logging.getLogger("check")
+logger.setLevel(logging.INFO)
+sqlcmd_ext = ".fwf"
+
+
+def main(input_dir, input_filter, input_sep, input_encoding, input_crlf, only_footer):
+    start = datetime.now()
+    crlf = input_crlf == "crlf" and u"\r\n" or u"\n"
+    files = read_dir(input_dir, with_path=False, only_folders=False, only_files=True)
+    errors = 0
+    for filename in files:
+        if not filename.endswith(sqlcmd_ext) or (input_filter and not re.match(input_filter, filename)):
+            continue
+        input_name = os.path.join(input_dir, filename)
+        try:
+            rec_nb, footer_pos = get_footer_info(input_name, crlf)
+            with open(input_name, "rb") as ifh:
+                cols, data_offset = get_fwf_cols(ifh.readline() + ifh.readline(), input_sep, crlf, input_encoding)
+        except ValueError as err:
+            errors += 1
+            logger.error(u"'{}': {}".format(filename, err.message))
+            continue
+        if only_footer:
+            logger.info("'{}': {} columns, {} records".format(filename, len(cols), rec_nb))
+            continue
+        found = 0
+        try:
+            for values in fwf_records(
+                input_name, cols, rec_nb, input_sep, crlf, input_encoding, data_offset=data_offset
+            ):
+                found += 1
+        except ValueError as err:
+            errors += 1
+            logger.error(u"'{}': {}".format(filename, err.message))
+            continue
+        if found != rec_nb:
+            errors += 1
+            logger.error("'{}': {} columns, only {} records read on {}".format(filename, len(cols), found, rec_nb))
+        else:
+            logger.info("'{}': {} columns, {} records".format(filename, len(cols), rec_nb))
+    logger.info("Script duration: %s" % (datetime.now() - start))
+    if errors:
+        stop("{} files with errors".format(errors), logger)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check sqlcmd files.")
+    parser.add_argument("input_dir", help="Input directory.")
+    parser.add_argument("-if", "--input_filter", dest="input_filter", help="Input filter.")
+    parser.add_argument("-is", "--input_sep", dest="input_sep", help='Input delimiter. Default "|"', default="|")
+    parser.add_argument(
+        "-ie", "--input_encoding", dest="input_encoding", help="Input encoding. Default: utf8", default="utf8"
+    )
+    parser.add_argument(
+        "-il",
+        "--input_crlf",
+        dest="input_crlf",
+        default="lf",
+        choices=("lf", "crlf"),
+        help="Line termination. Default: lf",
+    )
+    parser.add_argument(
+        "-of", "--only_footer", dest="only_footer", action="store_true", help="Only check footer and columns."
+    )
+    ns = parser.parse_args()
+    main(ns.input_dir, ns.input_filter, ns.input_sep.decode(), ns.input_encoding, ns.input_crlf, ns.only_footer)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Script to compare two csv exports by eid and to write a delta file with only the new and changed rows"""
+from datetime import datetime
+from imio.pyutils.system import stop
+from imio.transmogrifier.iadocs.csv_utils import row_hash
+
+import argparse
+import csv
+import logging
+import os
+
+
+logging.basicConfig()
+logger = logging.getLogger("diff")
+logger.setLevel(logging.INFO)
+
+
+def read_hashes(filename, eid_col, delimiter, has_header):
+    """Returns a dict of eid: row digest"""
+    hashes = {}
+    with open(filename, "rb") as fh:
+        reader = csv.reader(fh, delimiter=delimiter)
+        if has_header:
+            next(reader, None)
+        for row in reader:
+            hashes[row[eid_col]] = row_hash(row)
+    return hashes
+
+
+def main(old_file, new_file, eid_col, delimiter, has_header, output_file):
+    start = datetime.now()
+    for filename in (old_file, new_file):
+        if not os.path.exists(filename):
+            stop("File '{}' doesn't exist".format(filename), logger)
+    old_hashes = read_hashes(old_file, eid_col, delimiter, has_header)
+    logger.info("'{}': {} rows".format(old_file, len(old_hashes)))
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+    ofh = writer = None
+    if output_file:
+        ofh = open(output_file, "wb")
+        writer = csv.writer(ofh, delimiter=delimiter, lineterminator="\n")
+    try:
+        with open(new_file, "rb") as fh:
+            reader = csv.reader(fh, delimiter=delimiter)
+            if has_header:
+                header = next(reader, None)
+                if writer and header:
+                    writer.writerow(header)
+            for row in reader:
+                old = old_hashes.pop(row[eid_col], None)
+                if old is None:
+                    counts["new"] += 1
+                elif old == row_hash(row):
+                    counts["unchanged"] += 1
+                    continue
+                else:
+                    counts["changed"] += 1
+                if writer:
+                    writer.writerow(row)
+    finally:
+        if ofh:
+            ofh.close()
+    logger.info(
+        "'{}': {} new, {} changed, {} unchanged, {} deleted rows".format(
+            new_file, counts["new"], counts["changed"], counts["unchanged"], len(old_hashes)
+        )
+    )
+    logger.info("Script duration: %s" % (datetime.now() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two csv exports by eid.")
+    parser.add_argument("old_file", help="Previous csv export.")
+    parser.add_argument("new_file", help="New csv export.")
+    parser.add_argument("-e", "--eid_col", dest="eid_col", type=int, default=0, help="Eid column index. Default 0")
+    parser.add_argument("-d", "--delimiter", dest="delimiter", default=",", help='Csv delimiter. Default ","')
+    parser.add_argument("-nh", "--no_header", dest="no_header", action="store_true", help="Files have no header.")
+    parser.add_argument("-o", "--output_file", dest="output_file", help="Delta file with new and changed rows.")
+    ns = parser.parse_args()
+    main(ns.old_file, ns.new_file, ns.eid_col, ns.delimiter, not ns.no_header, ns.output_file)
@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
-"""Script to convert sqlcmd output files to double-quoted csv"""
+"""Script to convert sqlcmd output files to double-quoted csv.
+
+The {table}_delta_{old}_{new}.fwf files exported by mssqlcmd_to_fwf --incremental are appended, ordered by watermark
+range, to the {table}.csv file converted from {table}.fwf.
+"""
 from collections import OrderedDict
 from datetime import datetime
 from imio.pyutils.system import read_dir
-from imio.pyutils.system import runCommand
 from imio.pyutils.system import stop
 from imio.pyutils.utils import safe_encode
+from imio.transmogrifier.iadocs.fwf_utils import DELTA_RE
+from imio.transmogrifier.iadocs.fwf_utils import fwf_records
+from imio.transmogrifier.iadocs.fwf_utils import get_delta_files
+from imio.transmogrifier.iadocs.fwf_utils import get_footer_info
+from imio.transmogrifier.iadocs.fwf_utils import get_fwf_cols
 
 import argparse
 import codecs
 import csv
 import logging
+import multiprocessing
 import os
 import re
 
@@ -21,7 +30,9 @@ logger.setLevel(logging.INFO)
 sqlcmd_ext = ".fwf"
 
 
-def main(input_dir, output_dir, counter_col, input_filter, input_sep, only_new, iconv, input_crlf):
+def main(
+    input_dir, output_dir, counter_col, input_filter, input_sep, only_new, iconv, input_crlf, engine="mmap", jobs=1
+):
     start = datetime.now()
     logger.info("Start: {}".format(start.strftime("%Y%m%d-%H%M")))
     if input_crlf == "crlf":
@@ -29,43 +40,159 @@ def main(input_dir, output_dir, counter_col, input_filter, input_sep, only_new,
     else:
         crlf = u"\n"
     files = read_dir(input_dir, with_path=False, only_folders=False, only_files=True)
+    tasks = []
     for filename in files:
         if not filename.endswith(sqlcmd_ext) or (input_filter and not re.match(input_filter, filename)):
             continue
+        if DELTA_RE.match(filename[:-len(sqlcmd_ext)]):
+            continue  # converted after the full export file
         input_name = os.path.join(input_dir, filename)
         output_name = os.path.join(output_dir, filename.replace(sqlcmd_ext, ".csv"))
+        try:
+            deltas = get_delta_files(input_name)
+        except ValueError as err:
+            stop(err.message, logger)
+        # a csv older than a delta is converted again
         if only_new and os.path.exists(output_name):
+            csv_time = os.path.getmtime(output_name)
+            if all(os.path.getmtime(delta) <= csv_time for delta in deltas):
+                continue
+        tasks.append((input_name, output_name, counter_col, input_sep, iconv, crlf, engine, deltas))
+    if jobs > 1:
+        # largest files first, so that a big file is not started last
+        tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = list(pool.imap_unordered(convert_job, tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [convert_file(*task) for task in tasks]
+    total_size = 0
+    errors = []
+    logger.info("Converted files:")
+    for res in sorted(results, key=lambda res: res["input"]):
+        if res.get("error"):
+            errors.append(res)
+            logger.error("  '{}': {}".format(res["input"], res["error"]))
             continue
-        logger.info("Reading '{}'".format(input_name))
-        if iconv:
-            new_name = input_name.replace(".fwf", ".fwf.{}".format(iconv))
-            if not os.path.exists(new_name):
-                logger.info("Renaming '{}' to '{}'".format(input_name, new_name))
-                os.rename(input_name, new_name)
-                cmd = 'iconv -f {} -t utf8 "{}" -o "{}"'.format(iconv, new_name, input_name)
-                (out, err, code) = runCommand(cmd)
-                if code != 0:
-                    stop(u"Error while converting file '{}' with iconv: {}".format(input_name, err), logger)
-        with codecs.open(input_name, "r", encoding="utf8") as ifh, open(output_name, "wb") as ofh:
-            csvh = csv.writer(ofh, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
-            rec_nb, last_rec_pos = get_records_info(ifh, crlf)
-            cols = get_cols(ifh, input_sep, crlf)
+        total_size += res["size"]
+        logger.info(
+            "  '{}': {}/{} records in {}".format(
+                res["input"], res["writed"], res["rec_nb"], throughput(res["size"], res["duration"])
+            )
+        )
+    logger.info("Script duration: %s" % (datetime.now() - start))
+    logger.info("Converted files: {}".format(throughput(total_size, datetime.now() - start)))
+    if errors:
+        stop(u"Errors in {} files".format(len(errors)), logger)
+
+
+def convert_file(input_name, output_name, counter_col, input_sep, iconv, crlf, engine, deltas=()):
+    """Converts a fwf file in csv, followed by its delta files records. Returns a result dict"""
+    logger.info("Reading '{}'".format(input_name))
+    encoding = "utf8"
+    if iconv:
+        # the file is decoded while read. A former version renamed the original file and wrote an utf8 copy
+        if os.path.exists(input_name.replace(".fwf", ".fwf.{}".format(iconv))):
+            logger.info("'{}' has already been converted to utf8".format(input_name))
+        else:
+            encoding = iconv
+    f_start = datetime.now()
+    if engine == "mmap":
+        writed, rec_nb = mmap_convert(input_name, output_name, counter_col, input_sep, crlf, encoding, deltas=deltas)
+    elif deltas:
+        stop(u"Delta files of '{}' can only be converted with the mmap engine".format(input_name), logger)
+    else:
+        writed, rec_nb = codecs_convert(input_name, output_name, counter_col, input_sep, crlf, encoding)
+    if writed != rec_nb:
+        logger.error(
+            "We don't have the correct records number in '{}': writed {}, must have {}".format(
+                input_name, writed, rec_nb
+            )
+        )
+    size = sum(os.path.getsize(name) for name in [input_name] + list(deltas))
+    duration = datetime.now() - f_start
+    logger.info("Converted {} records of '{}' in {}".format(writed, input_name, throughput(size, duration)))
+    return {"input": input_name, "writed": writed, "rec_nb": rec_nb, "size": size, "duration": duration}
+
+
+def convert_job(task):
+    """Converts a fwf file in a pool process. Errors are returned, so that the pool is not blocked"""
+    try:
+        return convert_file(*task)
+    except BaseException as exc:  # stop raises SystemExit
+        return {"input": task[0], "error": repr(exc)}
+
+
+def throughput(size, duration):
+    """Returns a text with duration and MB/s"""
+    seconds = duration.total_seconds() or 0.000001
+    return "{} ({:.1f} MB, {:.1f} MB/s)".format(duration, size / 1048576.0, size / 1048576.0 / seconds)
+
+
+def codecs_convert(input_name, output_name, counter_col, input_sep, crlf, encoding="utf8"):
+    """Converts a fwf file, reading it as a codecs stream. Returns written and expected records numbers"""
+    with codecs.open(input_name, "r", encoding=encoding) as ifh, open(output_name, "wb") as ofh:
+        csvh = csv.writer(ofh, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        rec_nb, last_rec_pos = get_records_info(ifh, crlf)
+        cols = get_cols(ifh, input_sep, crlf)
+        if counter_col:
+            csvh.writerow([u"Line"] + list(cols.keys()))
+        else:
+            csvh.writerow(list(cols.keys()))
+        counters = {"read": 0, "max": rec_nb}
+        ctn, values = get_values(cols, ifh, counters, input_sep)
+        writed = 0
+        while ctn:
             if counter_col:
-                csvh.writerow([u"Line"] + list(cols.keys()))
-            else:
-                csvh.writerow(list(cols.keys()))
-            counters = {"read": 0, "max": rec_nb}
+                values.insert(0, counters["read"])
+            csvh.writerow(values)
+            writed += 1
             ctn, values = get_values(cols, ifh, counters, input_sep)
-            writed = 0
-            while ctn:
+    return writed, rec_nb
+
+
+def mmap_convert(input_name, output_name, counter_col, input_sep, crlf, encoding="utf8", deltas=()):
+    """Converts a fwf file, memory mapped and sliced by records. Returns written and expected records numbers.
+
+    The records of the delta files, having the same columns, are written after the full export ones."""
+    header = None
+    writed = rec_nb = 0
+    with open(output_name, "wb") as ofh:
+        csvh = csv.writer(ofh, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        for name in [input_name] + list(deltas):
+            with open(name, "rb") as ifh:
+                file_nb, last_rec_pos = get_records_info(ifh, crlf)
+                try:
+                    cols, data_offset = get_fwf_cols(
+                        ifh.readline() + ifh.readline(), input_sep, crlf, encoding=encoding
+                    )
+                except ValueError as err:
+                    stop(err.message, logger)
+            if header is None:
+                header = list(cols.keys())
                 if counter_col:
-                    values.insert(0, counters["read"])
-                csvh.writerow(values)
-                writed += 1
-                ctn, values = get_values(cols, ifh, counters, input_sep)
-            if writed != rec_nb:
-                logger.error("We don't have the correct records number: writed {}, must have {}".format(writed, rec_nb))
-    logger.info("Script duration: %s" % (datetime.now() - start))
+                    csvh.writerow([u"Line"] + header)
+                else:
+                    csvh.writerow(header)
+            elif list(cols.keys()) != header:
+                stop(u"Columns of delta file '{}' differ from '{}'".format(name, input_name), logger)
+            rec_nb += file_nb
+            records = fwf_records(
+                name, cols, file_nb, input_sep, crlf, encoding=encoding, out_encoding="utf8", data_offset=data_offset
+            )
+            try:
+                for values in records:
+                    writed += 1
+                    if counter_col:
+                        values.insert(0, writed)
+                    csvh.writerow(values)
+            except ValueError as err:
+                stop(err.message, logger)
+    return writed, rec_nb
 
 
 def get_values(cols, fh, count_dic, input_sep):
@@ -129,23 +256,10 @@ def get_cols(fh, input_sep, crlf):
 
 def get_records_info(fh, crlf):
     """Get records number and last record position."""
-    fh.seek(0, 2)  # at the end
-    file_len = fh.tell()
-    for offset in range(-15, -50, -1):
-        fh.seek(offset, 2)
-        buf = fh.read()
-        if re.match(u" (rows? affected|lignes? affectées?)", buf):
-            break
-    else:
-        stop(u"End of file not as expected '{}'".format(buf), logger)
-    offset -= 3
-    while not re.match(r"{}\(\d+ (rows?|lignes?) ".format(crlf), buf) and abs(offset) <= file_len:
-        fh.seek(offset, 2)
-        buf = fh.read()
-        offset -= 1
-    match = re.match(r"{}\((\d+) (rows?|lignes?) ".format(crlf), buf)
-    fh.seek(0)  # start of file
-    return int(match.group(1)), file_len + offset  # offset is neg
+    try:
+        return get_footer_info(fh.name, crlf)
+    except ValueError as err:
+        stop(err.message, logger)
 
 
 if __name__ == "__main__":
@@ -153,7 +267,7 @@ if __name__ == "__main__":
     parser.add_argument("input_dir", help="Input directory.")
     parser.add_argument("-if", "--input_filter", dest="input_filter", help="Input filter.")
     parser.add_argument("-is", "--input_sep", dest="input_sep", help='Input delimiter. Default "|"', default="|")
-    parser.add_argument("-ic", "--iconv", dest="iconv", help="Transform with iconv from given encoding to utf8.")
+    parser.add_argument("-ic", "--iconv", dest="iconv", help="Input encoding, decoded while reading. Default: utf8")
     parser.add_argument(
         "-il",
         "--input_crlf",
@@ -162,12 +276,27 @@ if __name__ == "__main__":
         choices=("lf", "crlf"),
         help="Line termination. Default: lf",
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        dest="engine",
+        default="mmap",
+        choices=("mmap", "codecs"),
+        help="Conversion engine: memory mapped records slicing or former codecs stream reading. Default: mmap",
+    )
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1, help="Number of files converted concurrently. Default: 1"
+    )
     parser.add_argument("-od", "--output_dir", dest="output_dir", help="Output directory. Default: same as input")
     parser.add_argument(
         "-oc", "--count_col", action="store_true", dest="count_col", help="Add in output a counter column."
     )
     parser.add_argument(
-        "-on", "--only_new", dest="only_new", action="store_true", help="Export only not existing csv files."
+        "-on",
+        "--only_new",
+        dest="only_new",
+        action="store_true",
+        help="Convert only not existing csv files, or older than a delta file.",
     )
     ns = parser.parse_args()
     if not ns.output_dir:
@@ -181,4 +310,6 @@ if __name__ == "__main__":
         ns.only_new,
         ns.iconv,
         ns.input_crlf,
+        engine=ns.engine,
+        jobs=ns.jobs,
     )
@@ -3,8 +3,12 @@
 from collections import OrderedDict
 from datetime import datetime
 from imio.pyutils.system import runCommand
+from imio.transmogrifier.iadocs.fwf_utils import find_delta_files
+from imio.transmogrifier.iadocs.fwf_utils import get_delta_name
+from multiprocessing.pool import ThreadPool
 
 import argparse
+import json
 import logging
 import os
 import re
@@ -15,6 +19,8 @@ logging.basicConfig()
 logger = logging.getLogger("sqlcmd")
 logger.setLevel(logging.INFO)
 sqlcmd_ext = ".fwf"
+# c: where condition, o: order by, w: increasing watermark column used for incremental export. A related table
+# uses its own id, not the parent one, so that a row added later to an already exported parent is in the next delta
 tables = OrderedDict(
     [
         ("XeAdresses", {}),
@@ -36,7 +42,7 @@ tables = OrderedDict(
         #                 'o': "isnull(DateEncodage, dateentree), dateentree"}),
         ('eCourriers', {'c': "isnull(Supprime, '0') != '1' and (dateentree != 0 "
                              "and DateEntree >= 20200101 or (dateencodage is not NULL and dateencodage >= 20200101))",
-                        'o': "isnull(DateEncodage, dateentree), dateentree"}),
+                        'o': "isnull(DateEncodage, dateentree), dateentree", 'w': "Id"}),
         # ('eCourriers', {'c': "TypeEntrantSortant in ('E', 'S') and isnull(Supprime, '0') != '1'",
         #                 'o': "isnull(DateEncodage, dateentree), dateentree"}),
         # ('eCourriers', {'c': "TypeEntrantSortant = 'I' and isnull(Supprime, '0') != '1'",
@@ -48,13 +54,13 @@ tables = OrderedDict(
         #                      "where description like 'Délibération%' or description like 'Séance%') ) and "
         #                      "isnull(Supprime, '0') != '1'",
         #                 'o': "isnull(DateEncodage, dateentree), dateentree"}),
-        ("eCourriersDestinataires", {}),
-        ("eCourriersFichiers", {"o": "CourrierID, OrdreAffichage, DateUpload"}),
+        ("eCourriersDestinataires", {"w": "Id"}),
+        ("eCourriersFichiers", {"o": "CourrierID, OrdreAffichage, DateUpload", "w": "Id"}),
         # when no addresses view
         # ("eCourriersFichiers", {"o": "CourrierID, DateUpload"}),
-        ("eCourriersDossiers", {"o": "CourrierID, Principal desc"}),
+        ("eCourriersDossiers", {"o": "CourrierID, Principal desc", "w": "Id"}),
         ("eCourriersLiens", {}),
-        ("eCourriersServices", {"o": "CourrierID, Principal desc"}),
+        ("eCourriersServices", {"o": "CourrierID, Principal desc", "w": "Id"}),
         # ('eGroupes', {}), ('eGroupesContacts', {}), ('eGroupesMembres', {}),
         ("eNatures", {}),
         ("XeRues", {}),
@@ -67,50 +73,188 @@ tables = OrderedDict(
 )
 fwf_cmd = (
     'docker exec -u root -it {dock} /opt/mssql-tools/bin/sqlcmd -S localhost -d {db} -U SA -P "{pwd}" '
-    '-Q "select * from {table}{where}{order}" -o "/srv/sqlcmd.fwf" -s"{sep}"'
+    '-Q "select * from {table}{where}{order}" -o "{tmp}" -s"{sep}"'
 )
-cp_cmd = 'docker cp {dock}:/srv/sqlcmd.fwf "{of}"'
+cp_cmd = 'docker cp {dock}:{tmp} "{of}"'
+wm_cmd = (
+    'docker exec -u root {dock} /opt/mssql-tools/bin/sqlcmd -S localhost -d {db} -U SA -P "{pwd}" -h -1 -W '
+    '-Q "set nocount on; select max({w}) from {table}{where}"'
+)
+watermarks_file = "watermarks.json"  # in output dir, last exported watermark value by table
+tmp_path = "/srv/sqlcmd_{table}.fwf"  # in container, one by table to allow concurrent exports
 
 
-def main(docker, db_name, pwd, delim, input_filter, output_dir, only_new, simulate):
+def main(
+    docker,
+    db_name,
+    pwd,
+    delim,
+    input_filter,
+    output_dir,
+    only_new,
+    simulate,
+    jobs=1,
+    fwf_tmpl=None,
+    cp_tmpl=None,
+    incremental=False,
+    wm_tmpl=None,
+):
     start = datetime.now()
     logger.info("Start: {}".format(start.strftime("%Y%m%d-%H%M")))
+    templates = {"export": fwf_tmpl or fwf_cmd, "copy": cp_tmpl or cp_cmd, "watermark": wm_tmpl or wm_cmd}
+    wm_file = os.path.join(output_dir, watermarks_file)
+    watermarks = {}
+    if os.path.exists(wm_file):
+        with open(wm_file) as fh:
+            watermarks = json.load(fh)
+    tasks = []
     for table in tables:
         if table.startswith("X"):
             continue
         if input_filter and not re.match(input_filter, table):
             continue
+        # delta export if a watermark is known. The delta file name is known after getting the new watermark
+        old_wm = incremental and tables[table].get("w") and watermarks.get(table) or None
         out_file = os.path.join(output_dir, "{}{}".format(table, sqlcmd_ext))
-        if only_new and os.path.exists(out_file):
+        if old_wm is None and only_new and os.path.exists(out_file):
             continue
-        where = ""
-        if tables[table].get("c"):
-            where = " where {}".format(tables[table]["c"])
-        order = ""
+        params = {
+            "dock": docker,
+            "db": db_name,
+            "pwd": pwd,
+            "table": table,
+            "sep": delim,
+            "where": get_where(tables[table].get("c")),
+            "order": "",
+            "w": tables[table].get("w"),
+            "tmp": tmp_path.format(table=table),
+            "of": os.path.join(output_dir, "sqlcmd_{}.tmp".format(table)),
+        }
         if tables[table].get("o"):
-            order = " order by {}".format(tables[table]["o"])
-        cmd = fwf_cmd.format(
-            **{"dock": docker, "db": db_name, "pwd": pwd, "table": table, "sep": delim, "where": where, "order": order}
-        )
+            params["order"] = " order by {}".format(tables[table]["o"])
         if simulate:
-            logger.info(cmd)
+            if params["w"]:
+                logger.info(templates["watermark"].format(**params))
+            logger.info(templates["export"].format(**params))
             continue
-        else:
-            logger.info("ON sql table or view '{}'".format(table))
-        logger.debug("cmdsql='{}'".format(cmd))
-        (out, err, code) = runCommand(cmd)
-        if code or err:
-            logger.error("Problem in command '{}': {}".format(cmd, err))
+        tasks.append((table, out_file, params, old_wm, templates))
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(export_table, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [export_table(task) for task in tasks]
+    if results:
+        logger.info("Exported tables:")
+    total_size = 0
+    for res in results:
+        if res.get("error"):
+            logger.error("  '{}': {} in {}".format(res["table"], res["error"], res["duration"]))
             continue
-        tmp_file = os.path.join(output_dir, "sqlcmd.fwf")
-        cmd = cp_cmd.format(**{"dock": docker, "of": tmp_file})
-        logger.debug("cp cmd='{}'".format(cmd))
-        (out, err, code) = runCommand(cmd)
-        if code or err:
-            logger.error("Problem in command '{}': {}".format(cmd, err))
-            continue
-        shutil.move(tmp_file, out_file)
-    logger.info("Script duration: %s" % (datetime.now() - start))
+        total_size += res["size"]
+        wm_txt = ""
+        if res.get("watermark") is not None:
+            watermarks[res["table"]] = res["watermark"]
+            wm_txt = ", {} watermark {}".format(res["delta"] and "delta until" or "full until", res["watermark"])
+        logger.info(
+            "  '{}': {:.1f} MB in {}{}".format(res["table"], res["size"] / 1048576.0, res["duration"], wm_txt)
+        )
+    if any(res.get("watermark") is not None for res in results):
+        with open(wm_file, "w") as fh:
+            json.dump(watermarks, fh, indent=2, separators=(",", ": "), sort_keys=True)
+    logger.info("Script duration: %s (%.1f MB)" % (datetime.now() - start, total_size / 1048576.0))
+
+
+def get_where(*conditions):
+    """Returns a where clause with the given conditions"""
+    conditions = ["({})".format(cond) for cond in conditions if cond]
+    if not conditions:
+        return ""
+    return " where {}".format(" and ".join(conditions))
+
+
+def sql_value(value):
+    """Returns a watermark value as sql literal"""
+    if re.match(r"^-?\d+$", value):
+        return value
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def get_watermark(params, template):
+    """Gets the current max value of the watermark column. Returns None if empty or on error"""
+    cmd = template.format(**params)
+    logger.debug("wm cmd='{}'".format(cmd))
+    (out, err, code) = runCommand(cmd)
+    if code or err:
+        logger.error("Problem in command '{}': {}".format(cmd, err))
+        return None
+    if isinstance(out, (list, tuple)):
+        out = "".join(out)
+    lines = [line.strip() for line in out.splitlines() if line.strip()]
+    if not lines or lines[-1] == "NULL":
+        return None
+    return lines[-1]
+
+
+def get_delta_file(out_file, table, old_wm, new_wm):
+    """Returns the delta file path, named by the exported watermark range"""
+    name = get_delta_name(table, old_wm, new_wm)
+    return os.path.join(os.path.dirname(out_file), "{}{}".format(name, sqlcmd_ext))
+
+
+def export_table(task):
+    """Runs the export and copy commands of a table. Returns a result dict"""
+    table, out_file, params, old_wm, templates = task
+    t_start = datetime.now()
+    res = {"table": table, "delta": old_wm is not None}
+    logger.info("ON sql table or view '{}'".format(table))
+    new_wm = None
+    if params["w"]:
+        # the max is got before the export, so that rows added meanwhile are in the next delta
+        new_wm = get_watermark(params, templates["watermark"])
+        if old_wm is not None:
+            if new_wm is None:
+                res.update({"error": "watermark error", "duration": datetime.now() - t_start})
+                return res
+            if new_wm == old_wm:  # no new row
+                res.update({"size": 0, "duration": datetime.now() - t_start, "watermark": new_wm})
+                return res
+            out_file = get_delta_file(out_file, table, old_wm, new_wm)
+            if os.path.exists(out_file):
+                logger.error("Delta file '{}' already exists".format(out_file))
+                res.update({"error": "existing delta", "duration": datetime.now() - t_start})
+                return res
+        conditions = [params["where"][len(" where "):]]
+        if old_wm is not None:
+            conditions.append("{} > {}".format(params["w"], sql_value(old_wm)))
+        if new_wm is not None:
+            conditions.append("{} <= {}".format(params["w"], sql_value(new_wm)))
+        params = dict(params, where=get_where(*conditions))
+    cmd = templates["export"].format(**params)
+    logger.debug("cmdsql='{}'".format(cmd))
+    (out, err, code) = runCommand(cmd)
+    if code or err:
+        logger.error("Problem in command '{}': {}".format(cmd, err))
+        res.update({"error": "export error", "duration": datetime.now() - t_start})
+        return res
+    cp = templates["copy"].format(**params)
+    logger.debug("cp cmd='{}'".format(cp))
+    (out, err, code) = runCommand(cp)
+    if code or err:
+        logger.error("Problem in command '{}': {}".format(cp, err))
+        res.update({"error": "copy error", "duration": datetime.now() - t_start})
+        return res
+    shutil.move(params["of"], out_file)
+    if params["w"] and old_wm is None:
+        # a full export contains the rows of the previous deltas, that would be read twice
+        for end, delta_file in find_delta_files(out_file).values():
+            logger.info("Removing delta file '{}' included in the full export".format(delta_file))
+            os.remove(delta_file)
+    res.update({"size": os.path.getsize(out_file), "duration": datetime.now() - t_start, "watermark": new_wm})
+    return res
 
 
 if __name__ == "__main__":
@@ -125,7 +269,52 @@ if __name__ == "__main__":
         "-on", "--only_new", dest="only_new", action="store_true", help="Export only not existing fwf files."
     )
     parser.add_argument("-s", "--simulate", dest="simulate", action="store_true", help="Simulate operation")
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1, help="Number of tables exported concurrently. Default: 1"
+    )
+    parser.add_argument(
+        "-ec",
+        "--export_cmd",
+        dest="export_cmd",
+        help="Export command template, replacing the docker sqlcmd one (variables: dock, db, pwd, table, sep, where, "
+        "order, tmp). Can be used to test with a local command.",
+    )
+    parser.add_argument(
+        "-cc",
+        "--copy_cmd",
+        dest="copy_cmd",
+        help="Copy command template, replacing the docker cp one (variables: dock, tmp, of).",
+    )
+    parser.add_argument(
+        "-in",
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Export in a {table}_delta_{old}_{new}.fwf file only the rows after the last exported watermark until the "
+        "current one, for the tables having a watermark column.",
+    )
+    parser.add_argument(
+        "-wc",
+        "--watermark_cmd",
+        dest="watermark_cmd",
+        help="Watermark command template printing the max value, replacing the docker sqlcmd one (variables: dock, "
+        "db, pwd, table, w, where).",
+    )
     ns = parser.parse_args()
     if not ns.database:
         ns.database = ns.docker
-    main(ns.docker, ns.database, ns.password, ns.output_sep, ns.input_filter, ns.output_dir, ns.only_new, ns.simulate)
+    main(
+        ns.docker,
+        ns.database,
+        ns.password,
+        ns.output_sep,
+        ns.input_filter,
+        ns.output_dir,
+        ns.only_new,
+        ns.simulate,
+        jobs=ns.jobs,
+        fwf_tmpl=ns.export_cmd,
+        cp_tmpl=ns.copy_cmd,
+        incremental=ns.incremental,
+        wm_tmpl=ns.watermark_cmd,
+    )
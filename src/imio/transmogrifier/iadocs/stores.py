@@ -0,0 +1,902 @@
+# -*- coding: utf-8 -*-
+"""Data stores helpers not depending on the portal."""
+from collections import MutableMapping
+from collections import OrderedDict
+from imio.transmogrifier.iadocs import o_logger
+from imio.transmogrifier.iadocs.csv_utils import CACHE_DIR
+from imio.transmogrifier.iadocs.csv_utils import is_same_source
+from imio.transmogrifier.iadocs.csv_utils import source_header
+from itertools import islice
+from itertools import izip
+
+import cPickle
+import json
+import os
+import re
+import resource
+import sqlite3
+import sys
+
+
+JOURNAL_EXT = ".jnl"
+COMPACT_RATIO = 1.0  # journaled keys, relatively to the store length, triggering a snapshot rewrite
+STORES_DIR = "_stores"  # sqlite stores subdirectory, next to the csv files
+LRU_SIZE = 10000  # values kept unpickled in front of a sqlite store
+ITER_BLOCK = 1000  # rows read at once when iterating a sqlite store
+MAX_INT_KEY = 1 << 63  # sqlite integer limit
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))  # noqa
+RECORD_CLASSES = {}  # fields: record class
+MEMORY_FILE = "_dt_memory.json"  # last memory report, in working path
+SIZE_SAMPLE = 1000  # entries measured to estimate a store size
+INT_ID = re.compile(r"(0|[1-9][0-9]*)$")  # numeric id converted to int without loosing a leading 0
+
+
+class Normalizer(object):
+    """Normalizes item values: numeric ids are converted to int and repeated text values are interned.
+
+    The values are changed in the given dict, which must be the stored copy of an item when ints are converted: the
+    items keep their text values for the next sections. The interned values table is shared by all the normalizers of
+    a run. Saved memory is estimated.
+    """
+
+    def __init__(self, table, int_fields=(), intern_fields=()):
+        self.table = table
+        self.int_fields = int_fields
+        self.intern_fields = intern_fields
+        self.ints = 0
+        self.interned = 0
+        self.saved = 0
+
+    def __call__(self, item):
+        for key in self.int_fields:
+            value = item.get(key)
+            if isinstance(value, basestring) and INT_ID.match(value):  # noqa
+                item[key] = int(value)
+                self.ints += 1
+                self.saved += sys.getsizeof(value) - sys.getsizeof(item[key])
+        for key in self.intern_fields:
+            value = item.get(key)
+            if type(value) is not unicode:  # noqa
+                continue
+            kept = self.table.setdefault(value, value)
+            if kept is not value:
+                item[key] = kept
+                self.interned += 1
+                self.saved += sys.getsizeof(value)
+        return item
+
+
+def get_normalizer(storage, key, options, stored=True):
+    """Returns a Normalizer following int_fields and intern_fields section options, or None.
+
+    :param storage: transmogrifier storage
+    :param key: csv or store key, used in the report
+    :param options: section options
+    :param stored: normalized values are a stored copy (int_fields is not allowed on items)
+    """
+    int_fields = (options.get("int_fields") or "").decode("utf8").split()
+    intern_fields = (options.get("intern_fields") or "").decode("utf8").split()
+    if int_fields and not stored:
+        raise Exception(u"'{}': int_fields option can only be used when storing items".format(key))
+    if not int_fields and not intern_fields:
+        return None
+    normalize = storage.setdefault("normalize", {"table": {}, "stores": OrderedDict()})
+    normalizer = Normalizer(normalize["table"], int_fields, intern_fields)
+    normalize["stores"].setdefault(key, []).append(normalizer)
+    return normalizer
+
+
+def normalize_report(storage):
+    """Logs the values normalized and the memory saved per store"""
+    normalize = storage.get("normalize")
+    if not normalize:
+        return
+    for key, normalizers in normalize["stores"].items():
+        o_logger.info(
+            u"Normalized '{}': {} ints, {} interned values, {} KB saved".format(
+                key,
+                sum(nor.ints for nor in normalizers),
+                sum(nor.interned for nor in normalizers),
+                sum(nor.saved for nor in normalizers) // 1024,
+            )
+        )
+    o_logger.info(u"Interned values: {}".format(len(normalize["table"])))
+
+
+class Record(object):
+    """Read only record with fixed fields, stored in slots, with a dict like read access.
+
+    A subclass is created for each fields tuple by record_class. It is pickled with its fields.
+    """
+
+    __slots__ = ()
+    fields = ()
+    slots = {}  # field: slot name
+
+    def __init__(self, values):
+        for slot, value in izip(self.__slots__, values):
+            setattr(self, slot, value)
+
+    @classmethod
+    def from_item(cls, item, old=None):
+        """Returns a record from item values. Missing values are taken from an old record"""
+        if old is None:
+            return cls([item.get(field) for field in cls.fields])
+        return cls([item[field] if field in item else old.get(field) for field in cls.fields])
+
+    def __reduce__(self):
+        return make_record, (self.fields, self.values())
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.slots[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        slot = self.slots.get(key)
+        if slot is None:
+            return default
+        return getattr(self, slot)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def items(self):
+        return zip(self.fields, self.values())
+
+    def iterkeys(self):
+        return iter(self.fields)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return izip(self.fields, self.values())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+
+def record_class(fields):
+    """Returns the Record subclass for the given fields"""
+    fields = tuple(fields)
+    cls = RECORD_CLASSES.get(fields)
+    if cls is None:
+        slots = tuple("_v{}".format(i) for i in range(len(fields)))
+        cls = type("Record", (Record,), {"__slots__": slots, "fields": fields, "slots": dict(izip(fields, slots))})
+        RECORD_CLASSES[fields] = cls
+    return cls
+
+
+def make_record(fields, values):
+    """Unpickles a record"""
+    return record_class(fields)(values)
+
+
+class JournalDict(dict):
+    """Dict recording the keys set or deleted since the last journal flush.
+
+    A mutable value got with [], get, setdefault or the values and items accessors is recorded as changed because it
+    can be modified in place. It is pickled as a plain dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(JournalDict, self).__init__(*args, **kwargs)
+        self.changed = set()
+        self.deleted = set()
+
+    def __reduce__(self):
+        return dict, (), None, None, dict.iteritems(self)
+
+    def __getitem__(self, key):
+        value = super(JournalDict, self).__getitem__(key)
+        if not isinstance(value, IMMUTABLE_TYPES) and not isinstance(value, Record):
+            self.changed.add(key)
+        return value
+
+    def iteritems(self):
+        for key, value in super(JournalDict, self).iteritems():
+            if not isinstance(value, IMMUTABLE_TYPES) and not isinstance(value, Record):
+                self.changed.add(key)
+            yield key, value
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super(JournalDict, self).__setitem__(key, value)
+        self.changed.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        super(JournalDict, self).__delitem__(key)
+        self.changed.discard(key)
+        self.deleted.add(key)
+
+    def setdefault(self, key, default=None):
+        self.changed.add(key)
+        self.deleted.discard(key)
+        return super(JournalDict, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def pop(self, key, *args):
+        if key in self:
+            self.changed.discard(key)
+            self.deleted.add(key)
+        return super(JournalDict, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(JournalDict, self).popitem()
+        self.changed.discard(key)
+        self.deleted.add(key)
+        return key, value
+
+    def clear(self):
+        self.deleted.update(self)
+        self.changed.clear()
+        super(JournalDict, self).clear()
+
+    def reset_changes(self):
+        self.changed = set()
+        self.deleted = set()
+
+
+class StoreJournal(object):
+    """Append-only journal of a pickled store.
+
+    The store is kept in a snapshot file (the usual pickled dict, followed by a random generation id) and in a journal
+    file (filename + .jnl) starting with the same generation id and followed by pickled (changed values, deleted keys)
+    records. A flush appends only the changes since the last flush. When the journaled keys exceed
+    compact_ratio * store length, a new snapshot is written (atomic rename) with a new generation: an older journal
+    is then ignored when loading. The snapshot can still be loaded as an usual pickle file.
+    """
+
+    def __init__(self, filename, compact_ratio=COMPACT_RATIO):
+        self.filename = filename
+        self.journal = filename + JOURNAL_EXT
+        self.compact_ratio = compact_ratio
+        self.generation = None  # None when no snapshot or an usual pickle file
+        self.journaled = 0  # keys written in the journal since the snapshot
+        self.valid_size = None  # journal size to keep (None: new journal to write)
+
+    def load(self):
+        """Loads the snapshot and replays the journal. Returns a JournalDict"""
+        data = JournalDict()
+        if not os.path.exists(self.filename):
+            return data
+        with open(self.filename, "rb") as fh:
+            dict.update(data, cPickle.load(fh))
+            try:
+                self.generation = cPickle.load(fh)
+            except EOFError:  # usual pickle file: a journal is not related
+                return data
+        if not os.path.exists(self.journal):
+            return data
+        with open(self.journal, "rb") as fh:
+            try:
+                if cPickle.load(fh) != self.generation:
+                    o_logger.warning(u"Ignoring old journal '{}'".format(self.journal))
+                    return data
+            except Exception:
+                return data
+            self.valid_size = fh.tell()
+            records = 0
+            while True:
+                try:
+                    changed, deleted = cPickle.load(fh)
+                except EOFError:
+                    break
+                except Exception:
+                    o_logger.warning(u"Ignoring truncated record in '{}'".format(self.journal))
+                    break
+                for key in deleted:
+                    dict.pop(data, key, None)
+                dict.update(data, changed)
+                self.journaled += len(changed) + len(deleted)
+                self.valid_size = fh.tell()
+                records += 1
+        o_logger.info(u"Replayed {} records of '{}'".format(records, self.journal))
+        return data
+
+    def flush(self, data, compact=False):
+        """Writes the changes since the last flush, or a new snapshot if needed or asked.
+
+        :param data: JournalDict
+        :param compact: force a snapshot rewrite
+        :return: True if a snapshot has been written
+        """
+        count = len(data.changed) + len(data.deleted)
+        if (
+            compact
+            or self.generation is None
+            or self.journaled + count > self.compact_ratio * max(len(data), 1)
+        ):
+            self.write_snapshot(data)
+            return True
+        if not count:
+            return False
+        record = (dict((key, data[key]) for key in data.changed if key in data), list(data.deleted))
+        if self.valid_size is None:
+            fh = open(self.journal, "wb")
+            cPickle.dump(self.generation, fh, -1)
+        else:
+            fh = open(self.journal, "r+b")
+            fh.seek(self.valid_size)
+            fh.truncate()
+        try:
+            cPickle.dump(record, fh, -1)
+            fh.flush()
+            os.fsync(fh.fileno())
+            self.valid_size = fh.tell()
+        finally:
+            fh.close()
+        self.journaled += count
+        data.reset_changes()
+        return False
+
+    def write_snapshot(self, data):
+        generation = os.urandom(8)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as fh:
+            cPickle.dump(data, fh, -1)
+            cPickle.dump(generation, fh, -1)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self.filename)
+        self.generation = generation
+        self.journaled = 0
+        self.valid_size = None
+        data.reset_changes()
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+
+def load_pickle(filename):
+    """Loads a pickled store, replaying its journal if any"""
+    if os.path.exists(filename + JOURNAL_EXT):
+        return StoreJournal(filename).load()
+    with open(filename, "rb") as fh:
+        return cPickle.load(fh)
+
+
+def load_keys(filename):
+    """Returns the keys of a pickled store, as a frozenset.
+
+    The keys are kept in a _cache subdirectory file, rebuilt when the pickle file changes.
+    """
+    keys_path = os.path.join(os.path.dirname(filename), CACHE_DIR, os.path.basename(filename) + ".keys")
+    journaled = os.path.exists(filename + JOURNAL_EXT)
+    if not journaled and os.path.exists(keys_path):
+        try:
+            with open(keys_path, "rb") as fh:
+                if is_same_source(cPickle.load(fh), filename):
+                    return frozenset(cPickle.load(fh))
+        except Exception:
+            pass
+    keys = frozenset(load_pickle(filename))
+    if not journaled:
+        if not os.path.exists(os.path.dirname(keys_path)):
+            os.makedirs(os.path.dirname(keys_path))
+        with open(keys_path + ".tmp", "wb") as fh:
+            cPickle.dump(source_header(filename), fh, -1)
+            cPickle.dump(list(keys), fh, -1)
+        os.rename(keys_path + ".tmp", keys_path)
+    return keys
+
+
+class LazyStore(MutableMapping):
+    """Store loaded from its pickle file on first access. It is pickled as a plain dict."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.loaded = None
+
+    @property
+    def data(self):
+        if self.loaded is None:
+            o_logger.info(u"Loading '{}'".format(self.filename))
+            self.loaded = load_pickle(self.filename)
+        return self.loaded
+
+    def __reduce__(self):
+        return dict, (), None, None, self.data.iteritems()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        return self.data.items()
+
+    def values(self):
+        return self.data.values()
+
+    def iteritems(self):
+        return self.data.iteritems()
+
+    def itervalues(self):
+        return self.data.itervalues()
+
+    def setdefault(self, key, default=None):
+        return self.data.setdefault(key, default)
+
+
+class SqliteDict(MutableMapping):
+    """Mapping stored in a sqlite file, with a bounded LRU cache of unpickled values in front of it.
+
+    The file is a working copy, recreated at each run. A mutable value got from the mapping is considered as modified:
+    it is written back when it leaves the cache or at sync. A value modified after leaving the cache is not saved
+    (don't keep references on many values). Values are pickled. Keys are stored with a canonical sqlite value, so that
+    equal keys are the same row as in a dict (1, 1L and True, or ascii str and unicode): only int, long, bool, unicode
+    and str keys are accepted. It is pickled as a plain dict.
+    """
+
+    def __init__(self, filename, lru_size=LRU_SIZE):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.filename = filename
+        self.lru_size = max(lru_size, 1)
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("CREATE TABLE data (key BLOB PRIMARY KEY, value BLOB) WITHOUT ROWID")
+        self.cache = OrderedDict()
+        self.dirty = set()
+
+    def __reduce__(self):
+        return dict, (), None, None, self.iteritems()
+
+    @staticmethod
+    def _key(key):
+        """Returns the sqlite value of a key: an integer, a text for unicode or ascii str, or a blob for other str"""
+        if isinstance(key, (int, long)):  # noqa
+            if -MAX_INT_KEY <= key < MAX_INT_KEY:
+                return int(key)
+        elif isinstance(key, unicode):  # noqa
+            return key
+        elif isinstance(key, str):
+            try:
+                return key.decode("ascii")
+            except UnicodeDecodeError:
+                return buffer(key)  # noqa
+        raise TypeError(u"Unsupported sqlite store key {!r}".format(key))
+
+    @staticmethod
+    def _from_key(value):
+        """Returns the key of a sqlite value"""
+        if isinstance(value, buffer):  # noqa
+            return str(value)
+        return value
+
+    def _cache(self, key, value):
+        self.cache[key] = value
+        if not isinstance(value, IMMUTABLE_TYPES) and not isinstance(value, Record):
+            self.dirty.add(key)
+        while len(self.cache) > self.lru_size:
+            old_key, old_value = self.cache.popitem(last=False)
+            if old_key in self.dirty:
+                self.dirty.discard(old_key)
+                self._write(old_key, old_value)
+
+    def _write(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO data VALUES (?, ?)", (self._key(key), buffer(cPickle.dumps(value, -1)))  # noqa
+        )
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            value = self.cache.pop(key)
+        else:
+            row = self.conn.execute("SELECT value FROM data WHERE key = ?", (self._key(key),)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            value = cPickle.loads(str(row[0]))
+        self._cache(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._key(key)  # checked now: the key is written later
+        self.cache.pop(key, None)
+        self._cache(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        cached = key in self.cache
+        if cached:
+            del self.cache[key]
+            self.dirty.discard(key)
+        cursor = self.conn.execute("DELETE FROM data WHERE key = ?", (self._key(key),))
+        if not cached and not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.cache:
+            return True
+        return self.conn.execute("SELECT 1 FROM data WHERE key = ?", (self._key(key),)).fetchone() is not None
+
+    def __len__(self):
+        """Counts the stored keys and the modified cached keys not yet stored, without writing them"""
+        count = self.conn.execute("SELECT COUNT(*) FROM data").fetchone()[0]
+        dirty = [self._key(key) for key in self.dirty]
+        for i in range(0, len(dirty), ITER_BLOCK // 2):
+            block = dirty[i:i + ITER_BLOCK // 2]
+            stored = self.conn.execute(
+                "SELECT COUNT(*) FROM data WHERE key IN ({})".format(", ".join("?" * len(block))), block
+            ).fetchone()[0]
+            count += len(block) - stored
+        return count
+
+    def _rows(self, columns):
+        """Yields rows by blocks, in key order, allowing modifications while iterating"""
+        self.sync()
+        last = None
+        while True:
+            if last is None:
+                rows = self.conn.execute(
+                    "SELECT {} FROM data ORDER BY key LIMIT ?".format(columns), (ITER_BLOCK,)
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT {} FROM data WHERE key > ? ORDER BY key LIMIT ?".format(columns), (last, ITER_BLOCK)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last = rows[-1][0]
+
+    def __iter__(self):
+        for row in self._rows("key"):
+            yield self._from_key(row[0])
+
+    def iteritems(self):
+        for row in self._rows("key, value"):
+            key = self._from_key(row[0])
+            if key in self.cache:
+                yield key, self[key]
+                continue
+            value = cPickle.loads(str(row[1]))
+            self._cache(key, value)
+            yield key, value
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def bulk_load(self, dic):
+        """Inserts many items without going through the cache"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO data VALUES (?, ?)",
+            ((self._key(key), buffer(cPickle.dumps(value, -1))) for key, value in dic.iteritems()),  # noqa
+        )
+        for key in dic:
+            if key in self.cache:
+                del self.cache[key]
+                self.dirty.discard(key)
+        self.conn.commit()
+
+    def clear(self):
+        self.cache.clear()
+        self.dirty.clear()
+        self.conn.execute("DELETE FROM data")
+        self.conn.commit()
+
+    def sync(self):
+        """Writes the modified cached values"""
+        for key in self.dirty:
+            self._write(key, self.cache[key])
+        self.dirty.clear()
+        self.conn.commit()
+
+    def close(self):
+        self.sync()
+        self.conn.close()
+
+
+def get_lru_size(options):
+    """Gets lru_size section option"""
+    return int(options.get("lru_size") or LRU_SIZE)
+
+
+def new_store(storage, store_key, backend=u"dict", lru_size=LRU_SIZE):
+    """Returns a new data store for storage["data"][store_key]
+
+    :param storage: transmogrifier storage
+    :param store_key: store key in data dicts
+    :param backend: "dict" or "sqlite" (stored on disk in a _stores subdirectory of csvpath)
+    :param lru_size: number of values kept unpickled in front of a sqlite store
+    """
+    if backend == u"sqlite":
+        filename = os.path.join(storage["csvp"], STORES_DIR, u"{}.sqlite".format(store_key))
+        o_logger.info(u"Using sqlite store '{}'".format(filename))
+        return SqliteDict(filename, lru_size=lru_size)
+    elif backend != u"dict":
+        raise Exception(u"Unknown store backend '{}'".format(backend))
+    return {}
+
+
+def write_file(filename, content):
+    """Writes a file content in a temporary file, synced and renamed: a crash never leaves a truncated file"""
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(content)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp, filename)
+
+
+class DumpWriter(object):
+    """Dumps stores in a forked process, so that the pipeline is not paused by the pickling.
+
+    The child process gets a copy-on-write snapshot of the stores at the dump time: it pickles and writes them with
+    write_file while the pipeline continues. Only one child runs at a time: a next dump waits the previous one.
+    Sqlite stores are pickled before forking because their connection cannot be used in the child. Without fork,
+    the stores are written directly. The writer is stopped by the final dump_stores or, when the pipeline is
+    interrupted, by stop_dump_writer.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.filenames = []
+        self.errors = 0
+
+    def put(self, dumps):
+        """Writes the dumps in a new child process.
+
+        :param dumps: list of (filename, store or already pickled str)
+        """
+        self.wait()
+        self.filenames = [filename for filename, data in dumps]
+        if not hasattr(os, "fork"):
+            self.errors += write_dumps(dumps)
+            return
+        pid = os.fork()
+        if pid == 0:  # child: never returns in the pipeline
+            errors = 255
+            try:
+                errors = min(write_dumps(dumps), 254)
+            finally:
+                os._exit(errors)
+        self.pid = pid
+
+    def wait(self):
+        """Waits the running child process"""
+        if self.pid is None:
+            return
+        status = os.waitpid(self.pid, 0)[1]
+        self.pid = None
+        if not status:
+            return
+        errors = os.WIFEXITED(status) and os.WEXITSTATUS(status) or 255
+        if errors == 255:  # killed or crashed
+            errors = len(self.filenames)
+            o_logger.error(u"Dump process of '{}' has failed".format(u"', '".join(self.filenames)))
+        self.errors += errors
+
+
+def write_dumps(dumps):
+    """Pickles and writes the dumps. Returns the number of dumps that cannot be written"""
+    errors = 0
+    for filename, data in dumps:
+        try:
+            write_file(filename, isinstance(data, str) and data or cPickle.dumps(data, -1))
+        except Exception as exc:
+            errors += 1
+            o_logger.error(u"Cannot write '{}': {}".format(filename, exc))
+    return errors
+
+
+def dump_stores(storage, final=False):
+    """Dumps the registered stores (storage["lastsection"]["pkl_dump"]).
+
+    Stores are pickled and written by a DumpWriter child process. At the end, the outstanding dump is waited and
+    an exception is raised if some dumps cannot be written.
+
+    :param storage: transmogrifier storage
+    :param final: end of process (journaled stores are compacted)
+    """
+    journals = storage["lastsection"].get("journals", {})
+    dumps = []
+    for filename, store_key, condition in storage["lastsection"]["pkl_dump"]:
+        if not filename or not condition(None, storage=storage, filename=filename):
+            continue
+        data = storage["data"][store_key]
+        if isinstance(data, LazyStore) and data.loaded is None:  # unchanged
+            continue
+        journal = journals.get(filename)
+        if journal is not None and isinstance(data, JournalDict):
+            o_logger.info(u"Flushing '{}'".format(filename))
+            journal.flush(data, compact=final)
+            continue
+        o_logger.info(u"Dumping '{}'".format(filename))
+        if isinstance(data, SqliteDict):
+            data = cPickle.dumps(data, -1)
+        dumps.append((filename, data))
+    if dumps:
+        writer = storage["lastsection"].get("writer")
+        if writer is None:
+            writer = storage["lastsection"]["writer"] = DumpWriter()
+        writer.put(dumps)
+    if final and stop_dump_writer(storage):
+        raise Exception(u"Some dumps cannot be written: see log")
+
+
+def stop_dump_writer(storage):
+    """Waits the outstanding dump and stops the writer.
+
+    :param storage: transmogrifier storage
+    :return: number of dumps that cannot be written
+    """
+    writer = storage.get("lastsection", {}).get("writer")
+    if writer is None:
+        return 0
+    writer.wait()
+    storage["lastsection"]["writer"] = None
+    return writer.errors
+
+
+def deep_size(obj, seen):
+    """Returns the approximate size of an object and of its contained objects (not yet seen)"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, Record)):
+        # a JournalDict would record its values as changed
+        items = dict.iteritems(obj) if isinstance(obj, dict) else obj.iteritems()
+        for key, value in items:
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_size(value, seen)
+    return size
+
+
+def store_stats(store, sample=SIZE_SAMPLE):
+    """Returns the entries number and the approximate memory size of a store.
+
+    The size of a big dict is extrapolated from a sample of entries. Only the cache of a sqlite store is in memory.
+    """
+    if isinstance(store, SqliteDict):
+        return len(store), deep_size(store.cache, set())
+    if isinstance(store, LazyStore):
+        if store.loaded is None:
+            return None, 0
+        store = store.loaded
+    if isinstance(store, (set, frozenset)):  # keys only store
+        return len(store), deep_size(store, set())
+    if not isinstance(store, dict):
+        return None, deep_size(store, set())
+    count = len(store)
+    if count <= sample:
+        return count, deep_size(store, set())
+    seen = set()
+    part = 0
+    for key, value in islice(dict.iteritems(store), sample):
+        part += deep_size(key, seen) + deep_size(value, seen)
+    return count, sys.getsizeof(store) + part * count // sample
+
+
+def process_rss():
+    """Returns the current resident memory of the process in bytes (max one if not available)"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_report(storage, portal=None, label=u""):
+    """Logs entries number, approximate size and growth since the previous report of each data store,
+    the process memory and the ZODB cache size.
+
+    The previous report is kept in storage or read from the file written at the end of the previous run.
+
+    :param storage: transmogrifier storage
+    :param portal: portal object, to get the ZODB cache size
+    :param label: report label
+    """
+    previous = storage.get("memory")
+    filename = os.path.join(storage.get("wp") or u"", MEMORY_FILE)
+    if previous is None:
+        previous = {}
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                previous = json.load(fh)
+
+    def growth(key, size):
+        if key not in previous:
+            return u""
+        return u", {:+d} KB".format((size - previous[key]) // 1024)
+
+    current = {}
+    o_logger.info(u"MEMORY{}:".format(label and u" ({})".format(label) or u""))
+    for key in sorted(storage["data"]):
+        count, size = store_stats(storage["data"][key])
+        current[key] = size
+        o_logger.info(
+            u"> {}: {} entries, {} KB{}".format(key, count is None and u"?" or count, size // 1024, growth(key, size))
+        )
+    rss = process_rss()
+    current[u"__rss__"] = rss
+    o_logger.info(u"> process rss: {} MB{}".format(rss >> 20, growth(u"__rss__", rss)))
+    jar = getattr(portal, "_p_jar", None)
+    if jar is not None:
+        cache = getattr(jar, "_cache", None)
+        o_logger.info(
+            u"> ZODB cache: {} objects, {} KB estimated in this connection".format(
+                jar.db().cacheSize(), getattr(cache, "total_estimated_size", 0) // 1024
+            )
+        )
+    storage["memory"] = current
+    if storage.get("wp"):
+        with open(filename, "w") as fh:
+            json.dump(current, fh)
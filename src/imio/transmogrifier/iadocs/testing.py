@@ -8,6 +8,8 @@ from plone.app.testing import PloneSandboxLayer
 from plone.app.testing import setRoles
 from plone.app.testing import TEST_USER_ID
 from zope.annotation import IAnnotations
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.interface import implements
 
 import imio.transmogrifier.iadocs
 
@@ -32,6 +34,23 @@ def get_storage(portal):
     return annot.setdefault(ANNOTATION_KEY, {"course": OrderedDict()})
 
 
+class FakeTransmogrifier(dict):
+    """Transmogrifier sections dict, annotatable to keep the storage"""
+
+    implements(IAttributeAnnotatable)
+
+    def __init__(self, context, pipeline=u"", config=None):
+        super(FakeTransmogrifier, self).__init__(config=config or {}, transmogrifier={"pipeline": pipeline})
+        self.context = context
+
+
+def reach_end(previous):
+    """Yields the items marked as having reached the end of the pipeline, as LastSection"""
+    for item in previous:
+        item["_reached"] = True
+        yield item
+
+
 IMIO_TRANSMOGRIFIER_IADOCS_FIXTURE = ImioTransmogrifierIadocsLayer()
 
 
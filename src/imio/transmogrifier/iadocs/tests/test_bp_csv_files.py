@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Blueprints tests for this package."""
+from imio.transmogrifier.iadocs.blueprints.csv_files import CSVReader
+from imio.transmogrifier.iadocs.blueprints.main import CommonInputChecks
+from imio.transmogrifier.iadocs.testing import FakeTransmogrifier
+from imio.transmogrifier.iadocs.testing import get_storage
+from imio.transmogrifier.iadocs.testing import IMIO_TRANSMOGRIFIER_IADOCS_INTEGRATION_TESTING  # noqa
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+CSV_CONTENT = u"Id,Titre,Num\n1,Élève,12\n2,café,-3\n3,noël,0\n4,été,7\n"
+
+
+class TestBluePrintCsvFiles(unittest.TestCase):
+
+    layer = IMIO_TRANSMOGRIFIER_IADOCS_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.transmogrifier = FakeTransmogrifier(self.portal)
+        self.storage = get_storage(self.transmogrifier)
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, "test.csv"), "wb") as fh:
+            fh.write(CSV_CONTENT.encode("utf8"))
+        self.storage.update({"parts": "a", "csvp": self.tmp_dir, "csv": {}, "data": {}})
+        self.options = {"filename": "test.csv", "fieldnames": "_eid title num", "bp_key": "c"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def reader(self, **options):
+        return CSVReader(self.transmogrifier, "a__csv_reader", dict(self.options, **options), [])
+
+    def test_csv_reader_cache(self):
+        items = list(self.reader())
+        # first reading fills the cache
+        bp = self.reader(cache="1")
+        self.assertFalse(bp.cache.is_valid())
+        self.assertListEqual(list(bp), items)
+        self.assertTrue(bp.filling)
+        self.assertTrue(bp.cache.is_valid())
+        # next reading uses the cache
+        bp = self.reader(cache="1")
+        self.assertListEqual(list(bp), items)
+        self.assertFalse(bp.filling)
+        self.assertIsNone(self.storage["csv"][u"c"]["fh"])
+        # the projection is applied on cached rows
+        bp = self.reader(cache="1", projection="title")
+        self.assertTrue(bp.cache.is_valid())
+        self.assertDictEqual(next(iter(bp)), {u"_bpk": u"c", u"_ln": 2, u"_eid": u"1", u"title": u"Élève"})
+        # a changed file invalidates the cache
+        with open(os.path.join(self.tmp_dir, "test.csv"), "ab") as fh:
+            fh.write(b"5,x,1\n")
+        bp = self.reader(cache="1")
+        self.assertFalse(bp.cache.is_valid())
+        self.assertEqual(len(list(bp)), 5)
+        self.assertTrue(bp.cache.is_valid())
+
+    def test_csv_reader_cursor(self):
+        # without cursor option, no cursor is stored
+        self.assertListEqual([item[u"_eid"] for item in self.reader()], [u"1", u"2", u"3", u"4"])
+        self.assertNotIn("csv_cursors", self.storage["data"])
+        # interrupted run: the cursor is the last item processed by the next sections
+        for item in self.reader(cursor="1"):
+            if item[u"_eid"] == u"2":
+                break
+        self.assertDictEqual(self.storage["data"]["csv_cursors"], {u"c": 2})
+        # next run restarts after the cursor
+        items = list(self.reader(cursor="1"))
+        self.assertListEqual([(item[u"_ln"], item[u"_eid"]) for item in items], [(3, u"2"), (4, u"3"), (5, u"4")])
+        self.assertDictEqual(items[0], {u"_bpk": u"c", u"_ln": 3, u"_eid": u"2", u"title": u"café", u"num": u"-3"})
+        self.assertDictEqual(self.storage["data"]["csv_cursors"], {u"c": 5})
+        # start_at has priority on cursor
+        self.assertListEqual([item[u"_eid"] for item in self.reader(cursor="1", start_at="python:4")], [u"3", u"4"])
+
+    def test_csv_reader_projection(self):
+        self.transmogrifier.update(
+            {
+                "transmogrifier": {"pipeline": u"a__csv_reader\na__other"},
+                "a__other": {"blueprint": "x", "condition": "python:item['_zref']"},
+            }
+        )
+        bp = self.reader(fieldnames="_eid _zref _zcol", projection="auto")
+        self.assertSetEqual(bp.unused, {u"_zcol"})
+        self.assertListEqual(self.storage["csv"][u"c"]["fd"], [u"_eid", u"_zref"])
+        self.assertDictEqual(next(iter(bp)), {u"_bpk": u"c", u"_ln": 2, u"_eid": u"1", u"_zref": u"Élève"})
+        bp = self.reader(fieldnames="_eid _zref _zcol", projection="_zcol")
+        self.assertSetEqual(bp.unused, {u"_zref"})
+
+    def test_csv_reader_workers(self):
+        items = list(self.reader())
+        self.assertListEqual(list(self.reader(workers="2")), items)
+        self.assertListEqual(self.storage["csv"][u"c"]["fd"], [u"_eid", u"title", u"num"])
+        # starting at a record
+        self.assertListEqual(list(self.reader(workers="2", start_at="python:u'3'")), items[2:])
+        # checks are done by the workers
+        bp = self.reader(workers="2")
+        CommonInputChecks(self.transmogrifier, "a__cip", {"bp_key": "c", "invalids": "num -3|0", "in_reader": "1"}, bp)
+        self.assertListEqual([item[u"num"] for item in bp], [u"12", None, None, u"7"])
+        # cache filled from workers items
+        self.assertListEqual(list(self.reader(workers="2", cache="1")), items)
+        bp = self.reader(workers="2", cache="1")
+        self.assertTrue(bp.cache.is_valid())
+        self.assertListEqual(list(bp), items)
+
+    def test_csv_reader_normalizer(self):
+        items = list(self.reader(intern_fields="title"))
+        self.assertListEqual([item[u"_eid"] for item in items], [u"1", u"2", u"3", u"4"])
+        # ints are only converted in stored values
+        self.assertRaises(Exception, self.reader, int_fields="_eid")
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Blueprints tests for this package."""
+from imio.transmogrifier.iadocs.blueprints.fwf_files import FWFReader
+from imio.transmogrifier.iadocs.blueprints.main import CommonInputChecks
+from imio.transmogrifier.iadocs.testing import get_storage
+from imio.transmogrifier.iadocs.testing import IMIO_TRANSMOGRIFIER_IADOCS_INTEGRATION_TESTING  # noqa
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+FWF_CONTENT = (
+    u"Id  |Titre     |Num  \n"
+    u"----|----------|-----\n"
+    u"1   |Élève     |   12\n"
+    u"2   |café\r\nnoël|   -3\n"
+    u"3   |NULL      |    0\n"
+    u"\n"
+    u"(3 rows affected)\n"
+)
+
+
+class TestBluePrintFwfFiles(unittest.TestCase):
+
+    layer = IMIO_TRANSMOGRIFIER_IADOCS_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.storage = get_storage(self.portal)
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, "test.fwf"), "wb") as fh:
+            fh.write(FWF_CONTENT.encode("utf8"))
+        self.storage.update({"parts": "a", "csvp": self.tmp_dir, "csv": {}, "data": {}})
+        self.options = {"filename": "test.fwf", "fieldnames": "_eid title num", "bp_key": "f", "none_value": "NULL"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fwf_reader(self):
+        bp = FWFReader(self.portal, "a__fwf_reader", self.options, [])
+        self.assertListEqual(self.storage["csv"][u"f"]["fd"], [u"_eid", u"title", u"num"])
+        self.assertListEqual(
+            list(bp),
+            [
+                {u"_bpk": u"f", u"_ln": 3, u"_eid": u"1", u"title": u"Élève", u"num": u"12"},
+                {u"_bpk": u"f", u"_ln": 5, u"_eid": u"2", u"title": u"café\nnoël", u"num": u"-3"},
+                {u"_bpk": u"f", u"_ln": 6, u"_eid": u"3", u"title": None, u"num": u"0"},
+            ],
+        )
+        # projection
+        bp = FWFReader(self.portal, "a__fwf_reader", dict(self.options, projection="title"), [])
+        self.assertListEqual(self.storage["csv"][u"f"]["fd"], [u"_eid", u"title"])
+        self.assertListEqual(sorted(next(iter(bp))), [u"_bpk", u"_eid", u"_ln", u"title"])
+        # wrong fieldnames
+        bp = FWFReader(self.portal, "a__fwf_reader", dict(self.options, fieldnames="_eid title"), [])
+        self.assertRaises(Exception, list, bp)
+
+    def test_fwf_reader_checks(self):
+        bp = FWFReader(self.portal, "a__fwf_reader", self.options, [])
+        # checks registered by common_input_checks are done in the reader
+        CommonInputChecks(self.portal, "a__cip", {"bp_key": "f", "invalids": "num -3|0", "in_reader": "1"}, bp)
+        self.assertIn("checks", self.storage["csv"][u"f"])
+        self.assertListEqual([item[u"num"] for item in bp], [u"12", None, None])
+
+    def test_fwf_reader_deltas(self):
+        delta = u"Id  |Titre     |Num  \n----|----------|-----\n{}\n({} rows affected)\n"
+        with open(os.path.join(self.tmp_dir, "test_delta_5_6.fwf"), "wb") as fh:
+            fh.write(delta.format(u"6   |six       |    6\n", 1).encode("utf8"))
+        with open(os.path.join(self.tmp_dir, "test_delta_3_5.fwf"), "wb") as fh:
+            fh.write(delta.format(u"4   |quatre    |    4\n5   |cinq      |    5\n", 2).encode("utf8"))
+        # delta files are read after the file, ordered by watermark range
+        bp = FWFReader(self.portal, "a__fwf_reader", dict(self.options, counter_col="1", fieldnames="_c _eid t n"), [])
+        self.assertListEqual(
+            [(item[u"_ln"], item[u"_eid"]) for item in bp],
+            [(3, u"1"), (5, u"2"), (6, u"3"), (3, u"4"), (4, u"5"), (3, u"6")],
+        )
+        bp = FWFReader(self.portal, "a__fwf_reader", dict(self.options, deltas="0"), [])
+        self.assertListEqual([item[u"_eid"] for item in bp], [u"1", u"2", u"3"])
+        # other columns
+        with open(os.path.join(self.tmp_dir, "test_delta_5_6.fwf"), "wb") as fh:
+            fh.write(u"Id  |Titre     \n----|----------\n6   |six       \n\n(1 rows affected)\n".encode("utf8"))
+        bp = FWFReader(self.portal, "a__fwf_reader", self.options, [])
+        self.assertRaises(Exception, list, bp)
@@ -3,9 +3,21 @@
 from datetime import date
 from datetime import datetime
 from imio.transmogrifier.iadocs.blueprints.main import CommonInputChecks
+from imio.transmogrifier.iadocs.blueprints.main import PickleData
+from imio.transmogrifier.iadocs.blueprints.main import RowDiff
+from imio.transmogrifier.iadocs.blueprints.main import StoreInData
+from imio.transmogrifier.iadocs.blueprints.various import EnhancedCondition
+from imio.transmogrifier.iadocs.stores import dump_stores
+from imio.transmogrifier.iadocs.stores import LazyStore
+from imio.transmogrifier.iadocs.stores import Record
+from imio.transmogrifier.iadocs.stores import SqliteDict
 from imio.transmogrifier.iadocs.testing import get_storage
 from imio.transmogrifier.iadocs.testing import IMIO_TRANSMOGRIFIER_IADOCS_INTEGRATION_TESTING  # noqa
+from imio.transmogrifier.iadocs.testing import reach_end
 
+import os
+import shutil
+import tempfile
 import unittest
 
 
@@ -17,6 +29,14 @@ class TestBluePrintMain(unittest.TestCase):
         self.portal = self.layer["portal"]
         self.storage = get_storage(self.portal)
 
+    def set_data_storage(self):
+        """Sets a storage with data stores dumped in a temporary csv path"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.portal.context = self.portal
+        self.storage.update({"parts": "a", "csvp": tmp_dir, "data": {}, "lastsection": {"pkl_dump": []}})
+        return tmp_dir
+
     def test_common_input_checks(self):
         self.storage.update({"parts": "a", "csv": {"cip": {"fd": [u"1", u"2"]}}})
         # without options
@@ -129,3 +149,156 @@ class TestBluePrintMain(unittest.TestCase):
         )
         bp.previous = [{u"_bpk": "cip", u"_eid": u"0", u"1": u"!néant\n"}]
         self.assertDictEqual(next(iter(bp)), {u"_bpk": "cip", u"_eid": u"0", u"1": False})
+
+    def test_row_diff(self):
+        tmp_dir = self.set_data_storage()
+        self.storage.update({"commit": False, "csv": {"rd": {"fd": [u"_eid", u"title"]}}})
+        options = {"bp_key": "rd", "filename": "rd_hashes.pkl", "drop_unchanged": "1"}
+        # item b is dropped by a next section
+        drop = {"condition1": "python:item['title'] == u'b'", "condition2": "python:False"}
+
+        def run(rows):
+            bp = RowDiff(self.portal, "a__row_diff", options, None)
+            bp.previous = [{u"_bpk": u"rd", u"_eid": eid, u"title": title} for eid, title in rows]
+            cond = EnhancedCondition(self.portal, "a__drop", drop, bp)
+            return [(item[u"_eid"], item[u"_diff"]) for item in reach_end(cond)]
+
+        self.assertListEqual(run([(u"1", u"a"), (u"2", u"b")]), [(u"1", u"new")])
+        self.assertListEqual(sorted(self.storage["data"][u"rd_hashes"]), [u"1"])
+        # hashes are not dumped without commit
+        dump_stores(self.storage, final=True)
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, "rd_hashes.pkl")))
+        self.storage["commit"] = True
+        dump_stores(self.storage, final=True)
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, "rd_hashes.pkl")))
+        # unchanged item is dropped, the item dropped in the previous run is still new
+        self.assertListEqual(run([(u"1", u"a"), (u"2", u"b"), (u"3", u"c")]), [(u"3", u"new")])
+        self.assertListEqual(run([(u"1", u"z"), (u"2", u"b")]), [(u"1", u"changed")])
+        # the hash of a dropped item is not recorded, even if an item with the same eid has reached the end before
+        self.assertListEqual(run([(u"4", u"d"), (u"4", u"b")]), [(u"4", u"new")])
+        dump_stores(self.storage, final=True)
+        self.assertListEqual(run([(u"4", u"d")]), [])
+
+    def test_pickle_data_sqlite(self):
+        tmp_dir = self.set_data_storage()
+        options = {"filename": "sq.pkl", "store_key": "sq", "backend": "sqlite", "d_condition": "python:True"}
+        PickleData(self.portal, "a__pickle_data", options, None)
+        self.assertIsInstance(self.storage["data"][u"sq"], SqliteDict)
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, "_stores", "sq.sqlite")))
+        bp = StoreInData(self.portal, "a__store_in_data", {"bp_key": "sq", "store_key": "_eid"}, None)
+        bp.previous = [{u"_eid": u"1", u"title": u"a"}, {u"_eid": u"2", u"title": u"b"}]
+        self.assertListEqual(list(bp), [])
+        dump_stores(self.storage, final=True)
+        # the dumped file is an usual pickle file, loaded in a new sqlite store
+        self.storage.update({"data": {}, "lastsection": {"pkl_dump": []}})
+        PickleData(self.portal, "a__pickle_data", options, None)
+        store = self.storage["data"][u"sq"]
+        self.assertIsInstance(store, SqliteDict)
+        self.assertDictEqual(
+            dict(store.iteritems()), {u"1": {u"_eid": u"1", u"title": u"a"}, u"2": {u"_eid": u"2", u"title": u"b"}}
+        )
+        # update mode keeps the existing values
+        self.storage["data"][u"sq"] = {u"3": {u"_eid": u"3"}}
+        PickleData(self.portal, "a__pickle_data", dict(options, update="1"), None)
+        store = self.storage["data"][u"sq"]
+        self.assertIsInstance(store, SqliteDict)
+        self.assertListEqual(sorted(store.keys()), [u"1", u"2", u"3"])
+        # unknown backend
+        self.storage["data"] = {}
+        self.assertRaises(Exception, PickleData, self.portal, "a__pickle_data", dict(options, backend="x"), None)
+
+    def test_store_in_data_compact(self):
+        self.set_data_storage()
+        options = {
+            "bp_key": "sc",
+            "store_key": "_eid",
+            "fieldnames": "_eid title",
+            "compact": "1",
+            "check_key_uniqueness": "0",
+        }
+        bp = StoreInData(self.portal, "a__store_in_data", options, None)
+        bp.previous = [{u"_eid": u"1", u"title": u"a", u"other": 1}, {u"_eid": u"2"}]
+        self.assertListEqual(list(bp), [])
+        store = self.storage["data"][u"sc"]
+        self.assertIsInstance(store[u"1"], Record)
+        self.assertEqual(store[u"1"][u"title"], u"a")
+        self.assertDictEqual(store[u"1"].copy(), {u"_eid": u"1", u"title": u"a"})
+        self.assertIsNone(store[u"2"].get(u"title"))
+        self.assertRaises(KeyError, lambda: store[u"1"][u"other"])
+        # an existing record is completed by a new item
+        bp.previous = [{u"_eid": u"2", u"title": u"b"}, {u"_eid": u"1", u"other": 2}]
+        list(bp)
+        self.assertEqual(store[u"1"], {u"_eid": u"1", u"title": u"a"})
+        self.assertEqual(store[u"2"], {u"_eid": u"2", u"title": u"b"})
+        # with subkey
+        bp = StoreInData(self.portal, "a__store_in_data", dict(options, bp_key="ss", store_subkey="title"), None)
+        bp.previous = [{u"_eid": u"1", u"title": u"a"}, {u"_eid": u"1", u"title": u"b"}]
+        list(bp)
+        self.assertListEqual(sorted(self.storage["data"][u"ss"][u"1"]), [u"a", u"b"])
+        self.assertIsInstance(self.storage["data"][u"ss"][u"1"][u"b"], Record)
+        # records are pickled with their fields
+        pkl_options = {"filename": "sc.pkl", "store_key": "sc", "d_condition": "python:True"}
+        PickleData(self.portal, "a__pickle_data", pkl_options, None)
+        self.assertIs(self.storage["data"][u"sc"], store)
+        dump_stores(self.storage, final=True)
+        self.storage["data"] = {}
+        PickleData(self.portal, "a__pickle_data", pkl_options, None)
+        self.assertIsInstance(self.storage["data"][u"sc"][u"1"], Record)
+        self.assertEqual(self.storage["data"][u"sc"][u"1"], {u"_eid": u"1", u"title": u"a"})
+        # fieldnames are needed
+        del options["fieldnames"]
+        self.assertRaises(Exception, StoreInData, self.portal, "a__store_in_data", options, None)
+
+    def test_pickle_data_load(self):
+        tmp_dir = self.set_data_storage()
+        options = {"filename": "ld.pkl", "store_key": "ld", "d_condition": "python:True"}
+        PickleData(self.portal, "a__pickle_data", options, None)
+        self.storage["data"][u"ld"].update({u"1": {u"title": u"a"}, u"2": {u"title": u"b"}})
+        dump_stores(self.storage, final=True)
+        # lazy: loaded on first access, not dumped if not loaded
+        self.storage.update({"data": {}, "lastsection": {"pkl_dump": []}})
+        PickleData(self.portal, "a__pickle_data", dict(options, load="lazy"), None)
+        store = self.storage["data"][u"ld"]
+        self.assertIsInstance(store, LazyStore)
+        self.assertIsNone(store.loaded)
+        dump_stores(self.storage, final=True)
+        self.assertIsNone(store.loaded)
+        self.assertDictEqual(store[u"1"], {u"title": u"a"})
+        self.assertEqual(len(store.loaded), 2)
+        # keys: only the keys are loaded and the store is not dumped
+        self.storage.update({"data": {}, "lastsection": {"pkl_dump": []}})
+        PickleData(self.portal, "a__pickle_data", dict(options, load="keys"), None)
+        self.assertEqual(self.storage["data"][u"ld"], frozenset([u"1", u"2"]))
+        self.assertListEqual(self.storage["lastsection"]["pkl_dump"], [])
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, "_cache", "ld.pkl.keys")))
+        # a keys store is replaced by a complete one
+        PickleData(self.portal, "a__pickle_data", options, None)
+        self.assertDictEqual(self.storage["data"][u"ld"], {u"1": {u"title": u"a"}, u"2": {u"title": u"b"}})
+        # update is always eager
+        self.storage["data"] = {u"ld": {u"3": {}}}
+        PickleData(self.portal, "a__pickle_data", dict(options, load="lazy", update="1"), None)
+        self.assertListEqual(sorted(self.storage["data"][u"ld"]), [u"1", u"2", u"3"])
+        # unknown load value
+        self.assertRaises(Exception, PickleData, self.portal, "a__pickle_data", dict(options, load="x"), None)
+
+    def test_store_in_data_normalized(self):
+        self.set_data_storage()
+        options = {"bp_key": "sn", "store_key": "_eid", "fieldnames": "_eid _mail_id", "yield": "1"}
+        bp = StoreInData(self.portal, "a__store_in_data", dict(options, int_fields="_eid _mail_id"), None)
+        bp.previous = [{u"_eid": u"12", u"_mail_id": u"3"}, {u"_eid": u"13", u"_mail_id": u"03"}]
+        # an unnormalized section looks up the normalized store with the item values
+        lookup = StoreInData(
+            self.portal,
+            "a__store_in_data",
+            dict(options, bp_key="sl", condition="python:item['_eid'] in storage['data']['sn']"),
+            bp,
+        )
+        items = list(lookup)
+        self.assertListEqual(items, bp.previous)
+        self.assertListEqual(sorted(self.storage["data"][u"sl"]), [u"12", u"13"])
+        # only the stored values are normalized, not the keys
+        self.assertDictEqual(
+            self.storage["data"][u"sn"],
+            {u"12": {u"_eid": 12, u"_mail_id": 3}, u"13": {u"_eid": 13, u"_mail_id": u"03"}},
+        )
+        self.assertDictEqual(self.storage["data"][u"sl"][u"12"], {u"_eid": u"12", u"_mail_id": u"3"})
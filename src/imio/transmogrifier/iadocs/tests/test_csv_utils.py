@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Csv utils tests for this package."""
+from imio.transmogrifier.iadocs.csv_utils import CsvCache
+from imio.transmogrifier.iadocs.csv_utils import CsvIndex
+from imio.transmogrifier.iadocs.csv_utils import parallel_rows
+from imio.transmogrifier.iadocs.csv_utils import parse_chunk
+from imio.transmogrifier.iadocs.csv_utils import RowPlan
+from imio.transmogrifier.iadocs.csv_utils import row_hash
+from imio.transmogrifier.iadocs.csv_utils import split_chunks
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestCsvUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.tmp_dir, "test.csv")
+        with open(self.csv_file, "wb") as fh:
+            fh.write('"1","a"\n"2","b"\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_csv_cache(self):
+        cache = CsvCache(self.csv_file, [u"_eid", u"title"], {"none_value": u"NULL"})
+        self.assertFalse(cache.is_valid())
+        cache.start()
+        cache.add(1, {u"_eid": u"1", u"title": u"a"})
+        cache.add(2, {u"_eid": u"2", u"title": None, u"_rest": ["x"]})
+        # not yet finished
+        self.assertFalse(cache.is_valid())
+        cache.finish()
+        self.assertTrue(cache.is_valid())
+        self.assertListEqual(list(cache.rows()), [(1, (u"1", u"a"), None), (2, (u"2", None), ["x"])])
+        # other options or fieldnames use another cache file
+        self.assertFalse(CsvCache(self.csv_file, [u"_eid", u"title"], {"none_value": u""}).is_valid())
+        self.assertFalse(CsvCache(self.csv_file, [u"_eid"], {"none_value": u"NULL"}).is_valid())
+        # csv modification invalidates cache
+        with open(self.csv_file, "ab") as fh:
+            fh.write('"3","c"\n')
+        self.assertFalse(cache.is_valid())
+        # aborted cache
+        cache.start()
+        cache.add(1, {u"_eid": u"1", u"title": u"a"})
+        cache.abort()
+        self.assertFalse(cache.is_valid())
+
+    def test_row_plan(self):
+        plan = RowPlan([u"_A", u"_eid", u"title", u"_remark"], unused=[u"_remark"], none_value=u"NULL")
+        self.assertListEqual(plan.fieldnames, [u"_eid", u"title"])
+        self.assertDictEqual(plan(["a", " 1 ", "NULL", "r"]), {u"_eid": u"1", u"title": None})
+        # shorter row
+        self.assertDictEqual(plan(["a", "1"]), {u"_eid": u"1", u"title": u""})
+        # longer row
+        self.assertDictEqual(
+            plan(["a", "1", "Premi\xc3\xa8re", "r", "x"]), {u"_eid": u"1", u"title": u"Première", "_rest": ["x"]}
+        )
+        # wrong encoding
+        plan = RowPlan([u"_eid", u"title"], encoding="ascii")
+        self.assertDictEqual(plan(["1", "Premi\xc3\xa8re"]), {u"_eid": u"1", u"title": u"Première"})
+
+    def test_split_chunks(self):
+        with open(self.csv_file, "wb") as fh:
+            fh.write('"id","title"\n"1","a\nb\nc"\n\n"2","b ""x""\nd"\n"3","c"\n')
+        chunks = split_chunks(self.csv_file, chunk_size=1, block_size=4)
+        # no split in quoted multilines values
+        self.assertListEqual(chunks, [(0, 13, 0), (13, 25, 1), (25, 42, 4), (42, 50, 7)])
+        plan = RowPlan([u"_eid", u"title"])
+        items = []
+        for chunk in chunks:
+            items.extend(parse_chunk(self.csv_file, chunk, {}, plan, u"bpk", True, None))
+        self.assertListEqual([(item["_ln"], item["_eid"]) for item in items], [(4, u"1"), (7, u"2"), (8, u"3")])
+        self.assertEqual(items[1]["title"], u'b "x"\nd')
+        # same result with one chunk and with workers
+        one_chunk = split_chunks(self.csv_file)[0]
+        self.assertListEqual(parse_chunk(self.csv_file, one_chunk, {}, plan, u"bpk", True, None), items)
+        self.assertListEqual(list(parallel_rows(self.csv_file, 2, chunks, {}, plan, u"bpk", True, None)), items)
+
+    def test_csv_index(self):
+        with open(self.csv_file, "wb") as fh:
+            fh.write('"id","title"\n"1","a\nb"\n\n"2","b"\n"3","c"\n"4","d"\n')
+        index = CsvIndex(self.csv_file, 2, {"dialect": "excel"})
+        self.assertFalse(index.load())
+        index.build({}, eid_col=0)
+        self.assertListEqual(index.entries, [(0, 0), (4, 24), (6, 40)])
+        self.assertEqual(index.eids[u"3"], 6)
+        index = CsvIndex(self.csv_file, 2, {"dialect": "excel"})
+        self.assertTrue(index.load())
+        self.assertEqual(index.lookup(3), (3, 0, 0))
+        self.assertEqual(index.lookup(u"3"), (6, 24, 4))
+        self.assertEqual(index.lookup(7), (7, 40, 6))
+        self.assertIsNone(index.lookup(u"9"))
+        # reading from the offset
+        plan = RowPlan([u"_eid", u"title"])
+        items = parse_chunk(self.csv_file, (24, os.path.getsize(self.csv_file), 4), {}, plan, u"bpk", True, None)
+        self.assertListEqual([(item["_ln"], item["_eid"]) for item in items], [(5, u"2"), (6, u"3"), (7, u"4")])
+        # other step
+        self.assertFalse(CsvIndex(self.csv_file, 3, {"dialect": "excel"}).load())
+
+    def test_row_hash(self):
+        digest = row_hash([u"1", u"a", None])
+        self.assertEqual(len(digest), 8)
+        self.assertEqual(digest, row_hash([u"1", u"a", None]))
+        self.assertNotEqual(digest, row_hash([u"1", u"a", u""]))
+        self.assertNotEqual(digest, row_hash([u"1", u"b", None]))
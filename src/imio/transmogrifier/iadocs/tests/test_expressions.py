@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Expressions tests for this package."""
+from imio.transmogrifier.iadocs.expressions import COMPILED
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.expressions import Expression
+
+import unittest
+
+
+class TestExpressions(unittest.TestCase):
+
+    def test_expression(self):
+        expr = Expression("python: item['_eid'] in storage['data'] and modules['os'].sep", {}, "sec", {})
+        self.assertEqual(expr({"_eid": u"1"}, storage={"data": {u"1": {}}}), "/")
+        self.assertFalse(expr({"_eid": u"2"}, storage={"data": {}}))
+        # extras are not kept between calls
+        self.assertRaises(NameError, expr, {"_eid": u"2"})
+        # code is compiled once
+        other = Expression("python:item['_eid'] in storage['data'] and modules['os'].sep", {}, "other", {})
+        self.assertIs(other.code, expr.code)
+        self.assertIn("item['_eid'] in storage['data'] and modules['os'].sep", COMPILED)
+        expr = Expression("python:u'é {}'.format(\n[k for k in item][0])", {"config": {}}, "sec", {})
+        self.assertEqual(expr({"a": 1}), u"é a")
+        expr = Expression("python:(transmogrifier, name, options, nothing, obj)", {"config": {}}, "sec", {}, obj=1)
+        self.assertTupleEqual(expr(None, obj=2), ({"config": {}}, "sec", {}, None, 1))
+        # modules are imported on demand
+        expr = Expression("python:(modules['colorsys'].rgb_to_yiq(0, 0, 0)[0], modules['os.path'].sep)", {}, "sec", {})
+        self.assertTupleEqual(expr(None), (0, "/"))
+
+    def test_condition(self):
+        cond = Condition("python:item.get('_bpk') == u'e_mail_i' and item", {}, "sec", {})
+        self.assertIs(cond({"_bpk": u"e_mail_i"}), True)
+        self.assertIs(cond({}), False)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Fwf utils tests for this package."""
+from imio.transmogrifier.iadocs.fwf_utils import fwf_records
+from imio.transmogrifier.iadocs.fwf_utils import get_delta_files
+from imio.transmogrifier.iadocs.fwf_utils import get_delta_name
+from imio.transmogrifier.iadocs.fwf_utils import get_footer_info
+from imio.transmogrifier.iadocs.fwf_utils import get_fwf_cols
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+FWF_CONTENT = (
+    u"Id  |Titre     |Num  \n"
+    u"----|----------|-----\n"
+    u"1   |Élève     |   12\n"
+    u"2   |café\r\nnoël|   -3\n"
+    u"3   |          |    0\n"
+    u"\n"
+    u"(3 rows affected)\n"
+)
+
+
+class TestFwfUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fwf_file = os.path.join(self.tmp_dir, "test.fwf")
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.encode("utf8"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_footer_info(self):
+        self.assertEqual(get_footer_info(self.fwf_file), (3, 114))
+        self.assertEqual(get_footer_info(self.fwf_file, tail_size=30), (3, 114))
+        # the footer must be in the read tail
+        self.assertRaises(ValueError, get_footer_info, self.fwf_file, tail_size=10)
+        # trailing blank lines are accepted
+        with open(self.fwf_file, "ab") as fh:
+            fh.write("\n\n")
+        self.assertEqual(get_footer_info(self.fwf_file), (3, 114))
+        with open(self.fwf_file, "ab") as fh:
+            fh.write("\n(12 lignes affect\xc3\xa9es)\n")
+        self.assertEqual(get_footer_info(self.fwf_file), (12, 135))
+        self.assertRaises(ValueError, get_footer_info, self.fwf_file, crlf=u"\r\n")
+        # missing footer: a footer like text in a record is not the end of file
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.replace(u"\n(3 rows affected)\n", u"").encode("utf8"))
+            fh.write(b"4   |\n(5 rows affected) |    1\n")
+        self.assertRaises(ValueError, get_footer_info, self.fwf_file)
+        # truncated file
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.encode("utf8")[:100] * 100)
+        self.assertRaises(ValueError, get_footer_info, self.fwf_file)
+
+    def test_get_fwf_cols(self):
+        cols, offset = get_fwf_cols(FWF_CONTENT.encode("utf8"), u"|", u"\n")
+        self.assertListEqual(cols.items(), [(u"Id", 4), (u"Titre", 10), (u"Num", 5)])
+        self.assertEqual(offset, 44)
+        self.assertRaises(ValueError, get_fwf_cols, "Id  |Titre\n----|--\n", u"|", u"\n")
+        # wrong line termination
+        crlf_content = FWF_CONTENT.replace(u" \n", u" \r\n").replace(u"-\n", u"-\r\n").encode("utf8")
+        self.assertRaises(ValueError, get_fwf_cols, crlf_content, u"|", u"\n")
+        self.assertEqual(get_fwf_cols(crlf_content, u"|", u"\r\n")[1], 46)
+        self.assertRaises(ValueError, get_fwf_cols, FWF_CONTENT.encode("utf8"), u"|", u"\r\n")
+
+    def test_fwf_records(self):
+        cols, offset = get_fwf_cols(FWF_CONTENT.encode("utf8"), u"|", u"\n")
+        expected = [[u"1", u"Élève", 12], [u"2", u"café\nnoël", -3], [u"3", u"", 0]]
+        self.assertListEqual(list(fwf_records(self.fwf_file, cols, 3, u"|", u"\n")), expected)
+        # multibyte characters cut between small blocks
+        self.assertListEqual(list(fwf_records(self.fwf_file, cols, 3, u"|", u"\n", block_size=7)), expected)
+        # other encoding decoded while reading
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.encode("cp1252"))
+        self.assertListEqual(list(fwf_records(self.fwf_file, cols, 3, u"|", u"\n", encoding="cp1252")), expected)
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.encode("utf8"))
+        self.assertListEqual(
+            list(fwf_records(self.fwf_file, cols, 1, u"|", u"\n", out_encoding="utf8", data_offset=offset)),
+            [["1", "\xc3\x89l\xc3\xa8ve", 12]],
+        )
+        # a misaligned record raises instead of stopping silently
+        with open(self.fwf_file, "wb") as fh:
+            fh.write(FWF_CONTENT.replace(u"|   -3\n", u"|   -33\n").encode("utf8"))
+        records = fwf_records(self.fwf_file, cols, 3, u"|", u"\n")
+        self.assertListEqual(next(records), expected[0])
+        self.assertRaises(ValueError, next, records)
+
+    def test_get_delta_files(self):
+        self.assertEqual(get_delta_name("eCourriers", "2024-01-02 10:00", "12"), "eCourriers_delta_2024-01-02-10-00_12")
+        self.assertListEqual(get_delta_files(self.fwf_file), [])
+        for name in ("test_delta_9_12", "test_delta_3_9", "test_delta_12_100", "other_delta_1_3"):
+            open(os.path.join(self.tmp_dir, "{}.fwf".format(name)), "wb").close()
+        open(os.path.join(self.tmp_dir, "test_delta_1_3.csv"), "wb").close()
+        # ordered by watermark range, not by name
+        self.assertListEqual(
+            [os.path.basename(path) for path in get_delta_files(self.fwf_file)],
+            ["test_delta_3_9.fwf", "test_delta_9_12.fwf", "test_delta_12_100.fwf"],
+        )
+        # a missing delta breaks the range
+        os.remove(os.path.join(self.tmp_dir, "test_delta_9_12.fwf"))
+        self.assertRaises(ValueError, get_delta_files, self.fwf_file)
+        # two deltas starting at the same watermark
+        open(os.path.join(self.tmp_dir, "test_delta_9_12.fwf"), "wb").close()
+        open(os.path.join(self.tmp_dir, "test_delta_9_11.fwf"), "wb").close()
+        self.assertRaises(ValueError, get_delta_files, self.fwf_file)
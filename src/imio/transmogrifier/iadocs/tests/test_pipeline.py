@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Pipeline tests for this package."""
+from imio.transmogrifier.iadocs.expressions import Condition
+from imio.transmogrifier.iadocs.pipeline import bpk_guard
+from imio.transmogrifier.iadocs.pipeline import Clock
+from imio.transmogrifier.iadocs.pipeline import Fused
+from imio.transmogrifier.iadocs.pipeline import is_pruned
+from imio.transmogrifier.iadocs.pipeline import Router
+from imio.transmogrifier.iadocs.pipeline import section_guard
+from imio.transmogrifier.iadocs.pipeline import timed_section
+from imio.transmogrifier.iadocs.pipeline import timed_stage
+from imio.transmogrifier.iadocs.pipeline import timing_report
+
+import unittest
+
+
+class Section(object):
+    """Sets or drops items of a _bpk, as a blueprint with a _bpk condition"""
+
+    def __init__(self, previous, name, bpk, log, drop=False, new_bpk=None):
+        self.previous = previous
+        self.name = name
+        self.condition = Condition(u"python: item.get('_bpk') == u'{}'".format(bpk), None, name, {})
+        self.log = log
+        self.drop = drop
+        self.new_bpk = new_bpk
+
+    def __iter__(self):
+        self.log.append((self.name, u"start"))
+        for item in self.previous:
+            item = self.apply(item)
+            if item is not None:
+                yield item
+        self.log.append((self.name, u"end"))
+
+    def apply(self, item):
+        if self.condition(item):
+            self.log.append((self.name, item["_eid"]))
+            if self.drop:
+                return None
+            item.setdefault(u"course", []).append(self.name)
+            if self.new_bpk:
+                item["_bpk"] = self.new_bpk
+        return item
+
+
+class FusableSection(Section):
+    """Section that can be fused"""
+
+    def process(self, item):
+        return self.apply(item)
+
+
+SECTIONS = [
+    (u"s1", u"a", {}),
+    (u"s2", u"a", {}),
+    (u"s3", u"b", {}),
+    (u"s4", u"a", {"drop": True}),
+    (u"s5", u"c", {"new_bpk": u"a"}),
+    (u"s6", u"b", {}),
+    (u"s7", u"a", {}),
+]
+FUSABLE = (u"s1", u"s2", u"s4", u"s5")
+
+
+def build(log, routing=False, fusion=False, clock=None):
+    """Returns the pipeline last stage, as construct_pipeline"""
+    pipeline = timed_stage(clock, iter(get_items()), None)  # as a source section
+    router = None
+    for name, bpk, kwargs in SECTIONS:
+        cls = name in FUSABLE and FusableSection or Section
+        if routing:
+            if router is None:
+                router = Router(pipeline)
+                pipeline = timed_stage(clock, router, u"[router]", pipeline)
+            block = router.block(frozenset([bpk]))
+            if not block.names:
+                block.last = timed_stage(clock, block.feed, None)
+            previous = block.last
+        else:
+            previous = pipeline
+        section = cls(previous, name, bpk, log, **kwargs)
+        last = timed_section(clock, name, previous, section, fusion)
+        if routing:
+            block.add(name, last)
+        else:
+            pipeline = last
+    return pipeline
+
+
+def get_items():
+    return [{u"_eid": i, u"_bpk": bpk} for i, bpk in enumerate([u"a", u"b", u"c", u"d", u"a", u"c", u"b"])]
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_bpk_guard(self):
+        self.assertEqual(bpk_guard(u"python: item.get('_bpk') == u'e_mail'"), frozenset([u"e_mail"]))
+        self.assertEqual(bpk_guard(u"python:u'e_mail' == item['_bpk'] and item['_eid']"), frozenset([u"e_mail"]))
+        self.assertEqual(
+            bpk_guard(
+                u"python: modules['imio.transmogrifier.iadocs.utils'].is_in_part(transmogrifier, 'e') and\n"
+                u"  item.get('_bpk') in (u'e_mail_i', 'e_mail_o') and item['_type'] == u'x'"
+            ),
+            frozenset([u"e_mail_i", u"e_mail_o"]),
+        )
+        self.assertIsNone(bpk_guard(u"python: item['_type'] == u'x' and item.get('_bpk') == u'e_mail'"))
+        self.assertIsNone(bpk_guard(u"python: item.get('_bpk') == u'e_mail' or item['_type'] == u'x'"))
+        self.assertIsNone(bpk_guard(u"python: item.get('_bpk', u'e_mail') == u'e_mail'"))
+        self.assertIsNone(bpk_guard(u"python: storage['data']"))
+        self.assertIsNone(bpk_guard(u"python:True"))
+        self.assertIsNone(bpk_guard(u"string:${item/_bpk}"))
+
+    def test_section_guard(self):
+        condition = u"python: item.get('_bpk') == u'e_mail'"
+        bp_id = "imio.transmogrifier.iadocs.inserter"
+        self.assertEqual(section_guard(bp_id, {"key": "string:title", "condition": condition}), frozenset([u"e_mail"]))
+        self.assertIsNone(section_guard(bp_id, {"key": "python:item['_key']", "condition": condition}))
+        self.assertIsNone(section_guard(bp_id, {"key": "string:title"}))
+        self.assertIsNone(section_guard("imio.transmogrifier.iadocs.condition", {"condition": condition}))
+        self.assertEqual(
+            section_guard("imio.transmogrifier.iadocs.condition", {"condition1": condition}), frozenset([u"e_mail"])
+        )
+        self.assertIsNone(section_guard("imio.transmogrifier.iadocs.csv_reader", {"condition": condition}))
+
+    def test_is_pruned(self):
+        bp_id = "imio.transmogrifier.iadocs.inserter"
+        self.assertTrue(is_pruned("a__title_insert", bp_id, "bc"))
+        self.assertFalse(is_pruned("a__title_insert", bp_id, "abc"))
+        self.assertFalse(is_pruned("xa__title_insert", bp_id, "a"))
+        self.assertTrue(is_pruned("xa__title_insert", bp_id, ""))
+        self.assertFalse(is_pruned("creators_insert", bp_id, ""))
+        self.assertFalse(is_pruned("a__lastsection", "imio.transmogrifier.iadocs.last_section", "b"))
+
+    def test_router(self):
+        log = []
+        expected = list(build(log))
+        r_log = []
+        router = build(r_log, routing=True)
+        self.assertEqual(len(router.blocks), 6)
+        self.assertListEqual(list(router), expected)
+        self.assertListEqual(r_log, log)
+        self.assertListEqual([block.fed for block in router.blocks], [2, 2, 2, 2, 2, 2])
+
+    def test_fusion(self):
+        log = []
+        expected = list(build(log))
+        # fused sections are not iterated
+        log = [entry for entry in log if entry[0] not in FUSABLE or entry[1] not in (u"start", u"end")]
+        f_log = []
+        pipeline = build(f_log, fusion=True)
+        self.assertIsInstance(pipeline.previous.previous, Fused)
+        self.assertListEqual([section.name for section in pipeline.previous.previous.sections], [u"s4", u"s5"])
+        self.assertListEqual(list(pipeline), expected)
+        self.assertListEqual(f_log, log)
+        # fused and routed
+        r_log = []
+        router = build(r_log, routing=True, fusion=True)
+        self.assertListEqual(list(router), expected)
+        self.assertListEqual(r_log, log)
+        self.assertListEqual(
+            [block.processes is not None for block in router.blocks], [True, False, True, True, False, False]
+        )
+
+    def test_timing(self):
+        log = []
+        expected = list(build(log))
+        for routing, fusion in ((False, False), (False, True), (True, False), (True, True)):
+            clock = Clock()
+            pipeline = build([], routing=routing, fusion=fusion, clock=clock)
+            self.assertListEqual(list(pipeline), expected)
+            self.assertListEqual(clock.stack, [])
+            timings = dict((stats.name, stats) for stats in clock.timings)
+            counts = [(timings[name].get_items_in(), timings[name].items_out) for name, b, k in SECTIONS]
+            if routing:  # items not matching the guard are not passed
+                self.assertListEqual(counts, [(2, 2), (2, 2), (2, 2), (2, 0), (2, 2), (2, 2), (2, 2)])
+            else:
+                self.assertListEqual(counts, [(7, 7), (7, 7), (7, 7), (7, 5), (5, 5), (5, 5), (5, 5)])
+            # exclusive times are charged once
+            self.assertAlmostEqual(sum(st.exclusive for st in clock.timings), pipeline.stats.inclusive, places=6)
+            for name, b, k in SECTIONS:
+                self.assertGreater(timings[name].conditions, 0)
+                self.assertLessEqual(timings[name].conditions, timings[name].exclusive)
+                self.assertLessEqual(timings[name].exclusive, timings[name].inclusive)
+        storage = {}
+        timing_report(storage)
+        storage["timing"] = clock.timings
+        timing_report(storage)
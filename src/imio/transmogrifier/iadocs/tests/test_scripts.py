@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Scripts tests for this package."""
+from imio.transmogrifier.iadocs.scripts import fwf_to_csv
+from imio.transmogrifier.iadocs.scripts import mssqlcmd_to_fwf
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+# stands for sqlcmd: prints the max Id or exports the rows in the Id range of the where clause
+FAKE_SQLCMD = """import json, re, sys
+rows = json.load(open(sys.argv[1]))
+low = re.search(r"Id > (\\d+)", sys.argv[2])
+high = re.search(r"Id <= (\\d+)", sys.argv[2])
+rows = [row for row in rows if (not low or row[0] > int(low.group(1))) and (not high or row[0] <= int(high.group(1)))]
+if sys.argv[3] == "max":
+    print(rows and max(row[0] for row in rows) or "NULL")
+else:
+    with open(sys.argv[3], "w") as fh:
+        fh.write("Id  |Val  \\n----|-----\\n")
+        for row in rows:
+            fh.write("{:>4}|{:<5}\\n".format(*row))
+        fh.write("\\n({} rows affected)\\n".format(len(rows)))
+"""
+
+
+class TestScripts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)  # runCommand writes its output files in the current directory
+        self.rows_file = os.path.join(self.tmp_dir, "rows.json")
+        script = os.path.join(self.tmp_dir, "sqlcmd.py")
+        with open(script, "w") as fh:
+            fh.write(FAKE_SQLCMD)
+        prefix = "{} {} {}".format(sys.executable, script, self.rows_file)
+        self.templates = {
+            "fwf_tmpl": prefix + ' "{where}" "{of}"',
+            "cp_tmpl": "true",
+            "wm_tmpl": prefix + ' "{where}" max',
+        }
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def export(self, rows, incremental=True):
+        with open(self.rows_file, "w") as fh:
+            json.dump(rows, fh)
+        mssqlcmd_to_fwf.main(
+            "dock", "db", "pwd", "|", "eCourriersServices$", self.tmp_dir, False, False, incremental=incremental,
+            **self.templates
+        )
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.tmp_dir) if name.startswith("eCourriersServices"))
+
+    def convert(self):
+        fwf_to_csv.main(self.tmp_dir, self.tmp_dir, False, "eCourriersServices", u"|", False, None, "lf")
+        with open(os.path.join(self.tmp_dir, "eCourriersServices.csv")) as fh:
+            return fh.read().splitlines()
+
+    def test_incremental_export(self):
+        rows = [[1, "a"], [2, "b"]]
+        self.export(rows)
+        self.assertListEqual(self.files(), ["eCourriersServices.fwf"])
+        with open(os.path.join(self.tmp_dir, "watermarks.json")) as fh:
+            self.assertDictEqual(json.load(fh), {"eCourriersServices": "2"})
+        rows += [[3, "c"], [4, "d"]]
+        self.export(rows)
+        self.export(rows)  # no new row, no delta
+        rows.append([5, "e"])
+        self.export(rows)
+        self.assertListEqual(
+            self.files(),
+            ["eCourriersServices.fwf", "eCourriersServices_delta_2_4.fwf", "eCourriersServices_delta_4_5.fwf"],
+        )
+        # the csv contains the full export rows followed by the deltas ones
+        expected = ['"Id","Val"', '1,"a"', '2,"b"', '3,"c"', '4,"d"', '5,"e"']
+        self.assertListEqual(self.convert(), expected)
+        # a full export includes the deltas rows, that are removed
+        self.export(rows, incremental=False)
+        self.assertListEqual(self.files(), ["eCourriersServices.csv", "eCourriersServices.fwf"])
+        self.assertListEqual(self.convert(), expected)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""Stores tests for this package."""
+from imio.transmogrifier.iadocs.stores import dump_stores
+from imio.transmogrifier.iadocs.stores import get_normalizer
+from imio.transmogrifier.iadocs.stores import JournalDict
+from imio.transmogrifier.iadocs.stores import LazyStore
+from imio.transmogrifier.iadocs.stores import load_keys
+from imio.transmogrifier.iadocs.stores import memory_report
+from imio.transmogrifier.iadocs.stores import record_class
+from imio.transmogrifier.iadocs.stores import SqliteDict
+from imio.transmogrifier.iadocs.stores import stop_dump_writer
+from imio.transmogrifier.iadocs.stores import store_stats
+from imio.transmogrifier.iadocs.stores import StoreJournal
+
+import cPickle
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestStores(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pkl_file = os.path.join(self.tmp_dir, "2_test.pkl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_journal_dict(self):
+        dic = JournalDict({1: u"a"})
+        self.assertSetEqual(dic.changed, set())
+        dic[2] = u"b"
+        dic.setdefault(3, {}).update({u"x": 1})
+        dic.update({4: u"d"})
+        del dic[1]
+        self.assertSetEqual(dic.changed, {2, 3, 4})
+        self.assertSetEqual(dic.deleted, {1})
+        dic.pop(2)
+        self.assertSetEqual(dic.changed, {3, 4})
+        self.assertSetEqual(dic.deleted, {1, 2})
+        loaded = cPickle.loads(cPickle.dumps(dic, -1))
+        self.assertIs(type(loaded), dict)
+        self.assertDictEqual(loaded, {3: {u"x": 1}, 4: u"d"})
+        # mutable values got can be modified in place
+        dic.reset_changes()
+        self.assertEqual(dic[4], u"d")
+        self.assertIsNone(dic.get(5))
+        self.assertSetEqual(dic.changed, set())
+        dic[3][u"y"] = 2
+        dic.get(3)[u"z"] = 3
+        self.assertSetEqual(dic.changed, {3})
+        # and through the values and items accessors
+        dic[5] = [u"e"]
+        dic.reset_changes()
+        self.assertListEqual(sorted(dic.keys()), [3, 4, 5])
+        self.assertSetEqual(dic.changed, set())
+        for accessor in (dic.values, dic.itervalues, dic.items, dic.iteritems):
+            dic.reset_changes()
+            self.assertEqual(len(list(accessor())), 3)
+            self.assertSetEqual(dic.changed, {3, 5})
+        # pickling or measuring does not record changes
+        dic.reset_changes()
+        cPickle.dumps(dic, -1)
+        store_stats(dic)
+        self.assertSetEqual(dic.changed, set())
+
+    def test_store_journal(self):
+        with open(self.pkl_file, "wb") as fh:
+            cPickle.dump({1: u"a", 2: u"b"}, fh, -1)
+        journal = StoreJournal(self.pkl_file, compact_ratio=10)
+        dic = journal.load()
+        self.assertDictEqual(dic, {1: u"a", 2: u"b"})
+        # usual pickle file: a snapshot is written first
+        self.assertTrue(journal.flush(dic))
+        dic[3] = u"c"
+        self.assertFalse(journal.flush(dic))
+        del dic[1]
+        dic.setdefault(2, {})
+        self.assertFalse(journal.flush(dic))
+        self.assertTrue(os.path.exists(self.pkl_file + ".jnl"))
+        # snapshot is still readable as an usual pickle file
+        with open(self.pkl_file, "rb") as fh:
+            self.assertDictEqual(cPickle.load(fh), {1: u"a", 2: u"b"})
+        journal = StoreJournal(self.pkl_file, compact_ratio=10)
+        dic = journal.load()
+        self.assertDictEqual(dic, {2: u"b", 3: u"c"})
+        self.assertEqual(journal.journaled, 3)
+        # truncated last record is ignored and overwritten
+        with open(self.pkl_file + ".jnl", "ab") as fh:
+            fh.write(cPickle.dumps(({4: u"d"}, []), -1)[:-3])
+        journal = StoreJournal(self.pkl_file, compact_ratio=10)
+        dic = journal.load()
+        self.assertDictEqual(dic, {2: u"b", 3: u"c"})
+        dic[5] = u"e"
+        journal.flush(dic)
+        self.assertDictEqual(StoreJournal(self.pkl_file).load(), {2: u"b", 3: u"c", 5: u"e"})
+        # compaction
+        self.assertTrue(journal.flush(dic, compact=True))
+        self.assertFalse(os.path.exists(self.pkl_file + ".jnl"))
+        with open(self.pkl_file, "rb") as fh:
+            self.assertDictEqual(cPickle.load(fh), {2: u"b", 3: u"c", 5: u"e"})
+        journal.compact_ratio = 0.3
+        dic[6] = u"f"
+        dic[7] = u"g"
+        self.assertTrue(journal.flush(dic))
+        # value modified in place is journaled
+        journal.compact_ratio = 10
+        dic[8] = {u"x": 1}
+        self.assertFalse(journal.flush(dic))
+        dic[8][u"y"] = 2
+        self.assertFalse(journal.flush(dic))
+        self.assertDictEqual(StoreJournal(self.pkl_file).load()[8], {u"x": 1, u"y": 2})
+
+    def test_sqlite_dict(self):
+        dic = SqliteDict(os.path.join(self.tmp_dir, "_stores", "test.sqlite"), lru_size=2)
+        dic[u"a"] = 1
+        dic.setdefault(u"b", {}).update({u"x": 1})
+        dic.setdefault(u"c", {}).setdefault(u"s", {})[u"y"] = 2
+        dic[u"d"] = [1]
+        # values modified in place are saved when leaving the cache
+        self.assertNotIn(u"a", dic.cache)
+        self.assertEqual(dic["a"], 1)
+        self.assertDictEqual(dic[u"b"], {u"x": 1})
+        dic[u"b"][u"z"] = 3
+        self.assertIn(u"c", dic)
+        self.assertNotIn(u"e", dic)
+        self.assertEqual(len(dic), 4)
+        self.assertListEqual(sorted(dic), [u"a", u"b", u"c", u"d"])
+        self.assertDictEqual(
+            dict(dic.items()), {u"a": 1, u"b": {u"x": 1, u"z": 3}, u"c": {u"s": {u"y": 2}}, u"d": [1]}
+        )
+        del dic[u"a"]
+        self.assertRaises(KeyError, dic.__delitem__, u"a")
+        self.assertIsNone(dic.get(u"a"))
+        self.assertEqual(dic.pop(u"d"), [1])
+        dic.bulk_load({u"e": 5, u"b": 2})
+        self.assertDictEqual(cPickle.loads(cPickle.dumps(dic, -1)), {u"b": 2, u"c": {u"s": {u"y": 2}}, u"e": 5})
+        dic.clear()
+        self.assertEqual(len(dic), 0)
+        # equal keys are the same row, as in a dict
+        dic[1] = u"a"
+        dic[1L] = u"b"  # noqa
+        dic[True] = u"c"
+        dic["x"] = 1
+        dic[u"x"] = 2
+        dic["\xc3\xa9"] = 3
+        dic[u"\xe9"] = 4
+        # items are in sqlite key order: integers, texts, blobs
+        self.assertListEqual(dic.items(), [(1, u"c"), (u"x", 2), (u"\xe9", 4), ("\xc3\xa9", 3)])
+        self.assertIn(1L, dic)  # noqa
+        self.assertRaises(TypeError, dic.__setitem__, (1, 2), u"a")
+        self.assertRaises(TypeError, dic.__setitem__, 1 << 64, u"a")
+        # len counts the modified cached values without writing them
+        dic.setdefault(u"n1", {})
+        dic.setdefault(u"n2", {})
+        self.assertEqual(len(dic), 6)
+        self.assertSetEqual(dic.dirty, {u"n1", u"n2"})
+        dic.close()
+
+    def test_record(self):
+        cls = record_class([u"_etype", u"title"])
+        self.assertIs(record_class((u"_etype", u"title")), cls)
+        rec = cls.from_item({u"_etype": u"a", u"other": 1})
+        self.assertEqual(rec[u"_etype"], u"a")
+        self.assertIsNone(rec[u"title"])
+        self.assertRaises(KeyError, rec.__getitem__, u"other")
+        self.assertEqual(rec.get(u"other", 2), 2)
+        self.assertIn(u"title", rec)
+        self.assertNotIn(u"other", rec)
+        self.assertListEqual(list(rec), [u"_etype", u"title"])
+        self.assertEqual(rec, {u"_etype": u"a", u"title": None})
+        self.assertDictEqual(dict(rec), {u"_etype": u"a", u"title": None})
+        rec = cls.from_item({u"title": u"t"}, rec)
+        self.assertDictEqual(rec.copy(), {u"_etype": u"a", u"title": u"t"})
+        self.assertRaises(AttributeError, setattr, rec, u"other", 1)
+        loaded = cPickle.loads(cPickle.dumps({1: rec, 2: cls([u"b", u"c"])}, -1))
+        self.assertIs(type(loaded[1]), cls)
+        self.assertEqual(loaded[1], rec)
+        self.assertEqual(loaded[2][u"title"], u"c")
+
+    def test_normalizer(self):
+        storage = {}
+        self.assertIsNone(get_normalizer(storage, u"e_mail", {}))
+        nor1 = get_normalizer(storage, u"e_mail", {"int_fields": "_eid _mail_id", "intern_fields": "_user"})
+        nor2 = get_normalizer(storage, u"e_files", {"intern_fields": "_user"})
+        item = nor1({u"_eid": u"12", u"_mail_id": u"012", u"_user": u"".join([u"us", u"er"]), u"title": u"12"})
+        self.assertDictEqual(item, {u"_eid": 12, u"_mail_id": u"012", u"_user": u"user", u"title": u"12"})
+        self.assertEqual(nor1.ints, 1)
+        self.assertEqual(nor1.interned, 0)
+        other = nor2({u"_user": u"".join([u"us", u"er"])})
+        self.assertIs(other[u"_user"], item[u"_user"])
+        self.assertEqual(nor2.interned, 1)
+        self.assertGreater(nor2.saved, 0)
+        self.assertListEqual(storage["normalize"]["stores"].keys(), [u"e_mail", u"e_files"])
+
+    def test_memory_report(self):
+        big = dict((i, {u"path": u"/a/b/{}".format(i)}) for i in range(5000))
+        count, size = store_stats(big, sample=100)
+        self.assertEqual(count, 5000)
+        self.assertAlmostEqual(size, store_stats(big, sample=5000)[1], delta=size / 10)
+        self.assertEqual(store_stats([u"a", u"a"])[0], None)
+        storage = {"wp": self.tmp_dir, "data": {u"big": big, u"small": {}}}
+        memory_report(storage)
+        with open(os.path.join(self.tmp_dir, "_dt_memory.json")) as fh:
+            self.assertEqual(json.load(fh)[u"big"], store_stats(big)[1])
+        # previous report is read from the file
+        del storage["memory"]
+        storage["data"][u"other"] = {}
+        memory_report(storage)
+        self.assertListEqual(sorted(storage["memory"]), [u"__rss__", u"big", u"other", u"small"])
+
+    def test_lazy_loading(self):
+        with open(self.pkl_file, "wb") as fh:
+            cPickle.dump({u"1": {u"path": u"/a"}, u"2": {u"path": u"/b"}}, fh, -1)
+        store = LazyStore(self.pkl_file)
+        self.assertIsNone(store.loaded)
+        self.assertIn(u"1", store)
+        self.assertIsNotNone(store.loaded)
+        store[u"3"] = {}
+        self.assertDictEqual(cPickle.loads(cPickle.dumps(store, -1)), store.loaded)
+        keys = load_keys(self.pkl_file)
+        self.assertEqual(keys, frozenset([u"1", u"2"]))
+        keys_path = os.path.join(self.tmp_dir, "_cache", "2_test.pkl.keys")
+        self.assertTrue(os.path.exists(keys_path))
+        self.assertEqual(load_keys(self.pkl_file), keys)
+        # keys file is rebuilt when the store file changes
+        with open(self.pkl_file, "wb") as fh:
+            cPickle.dump({u"4": {}}, fh, -1)
+        self.assertEqual(load_keys(self.pkl_file), frozenset([u"4"]))
+        # journaled changes are considered
+        journal = StoreJournal(self.pkl_file)
+        dic = journal.load()
+        journal.flush(dic)
+        dic[u"5"] = {}
+        journal.flush(dic)
+        self.assertEqual(load_keys(self.pkl_file), frozenset([u"4", u"5"]))
+
+    def test_dump_stores(self):
+        def condition(item, **kwargs):
+            return True
+
+        other_file = os.path.join(self.tmp_dir, "2_other.pkl")
+        storage = {
+            "data": {u"test": {1: u"a"}, u"other": {}},
+            "lastsection": {"pkl_dump": [(self.pkl_file, u"test", condition), (other_file, u"other", condition)]},
+        }
+        dump_stores(storage)
+        writer = storage["lastsection"]["writer"]
+        self.assertIsNotNone(writer.pid)
+        # the dumped content is the one at dump time
+        storage["data"][u"test"][2] = u"b"
+        writer.wait()
+        with open(self.pkl_file, "rb") as fh:
+            self.assertDictEqual(cPickle.load(fh), {1: u"a"})
+        dump_stores(storage)
+        writer.wait()
+        self.assertIsNone(writer.pid)
+        with open(self.pkl_file, "rb") as fh:
+            self.assertDictEqual(cPickle.load(fh), {1: u"a", 2: u"b"})
+        storage["data"][u"test"][3] = u"c"
+        dump_stores(storage, final=True)
+        self.assertIsNone(writer.pid)
+        self.assertIsNone(storage["lastsection"]["writer"])
+        with open(self.pkl_file, "rb") as fh:
+            self.assertDictEqual(cPickle.load(fh), {1: u"a", 2: u"b", 3: u"c"})
+        self.assertListEqual(sorted(os.listdir(self.tmp_dir)), ["2_other.pkl", "2_test.pkl"])
+        # write errors are raised at the end
+        storage["lastsection"]["pkl_dump"] = [(self.tmp_dir, u"test", condition)]
+        self.assertRaises(Exception, dump_stores, storage, final=True)
+        self.assertIsNone(storage["lastsection"]["writer"])
+        self.assertEqual(stop_dump_writer(storage), 0)